@@ -0,0 +1,103 @@
+"""
+bench_codec.py
+
+Measures the storage size and encode/decode throughput of QA pair payloads with each redis
+codec: uncompressed JSON, zstd, and zstd with a dictionary trained on other payloads.
+
+With `--redis`, the payloads are also written to redis and the memory used is read back with
+`MEMORY USAGE`, using the redis settings from the environment.
+
+Usage:
+    python -m benchmarks.bench_codec --size-kb 100 --num-payloads 200
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.payloads import make_qa_pair
+from commons.cache.codec import PayloadCodec, train_dictionary
+
+
+def measure(codec: PayloadCodec, payloads: list[bytes]) -> dict:
+    start_time = time.perf_counter()
+    values = [codec.encode(payload) for payload in payloads]
+    encode_sec = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for value in values:
+        codec.decode(value)
+    decode_sec = time.perf_counter() - start_time
+
+    raw_mb = sum(len(payload) for payload in payloads) / 1024 / 1024
+    return {
+        "values": values,
+        "stored_mb": sum(len(value) for value in values) / 1024 / 1024,
+        "ratio": sum(len(p) for p in payloads) / sum(len(v) for v in values),
+        "encode_mb_per_sec": raw_mb / encode_sec,
+        "decode_mb_per_sec": raw_mb / decode_sec,
+    }
+
+
+async def redis_memory_usage(name: str, values: list[bytes]) -> float:
+    """Bytes of redis memory used by `values`, including per key overhead, in MB."""
+    from commons.cache import RedisCache
+
+    redis = RedisCache().redis
+    keys = [f"synthetic:bench_codec:{name}:{i}" for i in range(len(values))]
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for key, value in zip(keys, values, strict=True):
+                pipe.set(key, value)
+            await pipe.execute()
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key)
+            usages = await pipe.execute()
+        return sum(usages) / 1024 / 1024
+    finally:
+        await redis.delete(*keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size-kb", type=int, default=100)
+    parser.add_argument("--num-payloads", type=int, default=200)
+    parser.add_argument("--level", type=int, default=3)
+    parser.add_argument("--dict-size", type=int, default=112 * 1024)
+    parser.add_argument("--redis", action="store_true")
+    args = parser.parse_args()
+
+    payloads = [
+        json.dumps(make_qa_pair(args.size_kb, seed)).encode("utf-8")
+        for seed in range(args.num_payloads)
+    ]
+    # train on payloads the dictionary is not measured on
+    training = [
+        json.dumps(make_qa_pair(args.size_kb, seed)).encode("utf-8")
+        for seed in range(args.num_payloads, args.num_payloads + 100)
+    ]
+    dict_data = train_dictionary(training, args.dict_size)
+    codecs = {
+        "none": PayloadCodec("none"),
+        "zstd": PayloadCodec("zstd", args.level),
+        "zstd+dict": PayloadCodec("zstd", args.level, dict_data),
+    }
+
+    print(f"{args.num_payloads} payloads of {args.size_kb} KB, zstd level {args.level}")
+    for name, codec in codecs.items():
+        result = measure(codec, payloads)
+        line = (
+            f"{name:<10} stored: {result['stored_mb']:8.2f} MB  ratio: {result['ratio']:5.2f}x  "
+            f"encode: {result['encode_mb_per_sec']:8.1f} MB/s  "
+            f"decode: {result['decode_mb_per_sec']:8.1f} MB/s"
+        )
+        if args.redis:
+            usage_mb = asyncio.run(redis_memory_usage(name, result["values"]))
+            line += f"  redis memory: {usage_mb:8.2f} MB"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+bench_enqueue.py
+
+Measures enqueue throughput of realistic QA pair payloads against a local redis, using the
+redis settings from the environment. Compares the previous enqueue (json.dumps of
+jsonable_encoder, then SET, RPUSH and SET in separate round trips) against
+`RedisCache.enqueue` (orjson if installed, one MULTI pipeline). Both use the configured codec.
+
+Keys are written under the `bench_enqueue` prefix and deleted afterwards.
+
+Usage:
+    python -m benchmarks.bench_enqueue --size-kb 100 --num-payloads 500 --concurrency 4
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import uuid_utils
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.payloads import make_qa_pair
+from commons.cache import RedisCache
+from commons.cache.codec import get_codec
+from commons.utils.serialization import dumps
+
+
+async def legacy_enqueue(cache: RedisCache, data: dict) -> int:
+    redis_task_id = uuid_utils.uuid7().__str__()
+    hist_key = cache._build_key(cache._hist_key_prefix, redis_task_id)
+    str_data = get_codec().encode(json.dumps(jsonable_encoder(data)).encode("utf-8"))
+    await cache.redis.set(hist_key, str_data)
+    num_items = await cache.redis.rpush(
+        cache._build_key(cache._queue_key), redis_task_id
+    )
+    await cache.redis.set(cache._build_key(cache._last_enqueue_key), time.time())
+    return num_items
+
+
+def bench_serialize(payloads: list[dict]):
+    for name, fn in [
+        ("json+jsonable_encoder", lambda d: json.dumps(jsonable_encoder(d)).encode()),
+        ("serialization.dumps", dumps),
+    ]:
+        start_time = time.perf_counter()
+        for payload in payloads:
+            fn(payload)
+        elapsed = time.perf_counter() - start_time
+        print(f"serialize {name:<22} {elapsed / len(payloads) * 1000:8.3f} ms/payload")
+
+
+async def bench_enqueue(
+    cache: RedisCache, enqueue, payloads: list[dict], concurrency: int
+):
+    queue = list(payloads)
+
+    async def worker():
+        while queue:
+            await enqueue(cache, queue.pop())
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return len(payloads) / (time.perf_counter() - start_time)
+
+
+async def cleanup(cache: RedisCache):
+    keys = [key async for key in cache.redis.scan_iter(match=f"{cache._key_prefix}:*")]
+    if keys:
+        await cache.redis.delete(*keys)
+
+
+async def main_async(args):
+    payloads = [make_qa_pair(args.size_kb, seed) for seed in range(args.num_payloads)]
+    bench_serialize(payloads)
+
+    cache = RedisCache()
+    # keep away from the real queue, and skip parsing the CLI args of the service
+    cache._key_prefix = "bench_enqueue"
+    cache.history_ttl_ms = 0
+    try:
+        for name, enqueue in [
+            ("legacy", legacy_enqueue),
+            ("pipelined", RedisCache.enqueue),
+        ]:
+            await cleanup(cache)
+            per_sec = await bench_enqueue(cache, enqueue, payloads, args.concurrency)
+            print(
+                f"enqueue {name:<10} {per_sec:8.1f} payloads/s  "
+                f"{1000 / per_sec * args.concurrency:8.3f} ms/payload per worker"
+            )
+    finally:
+        await cleanup(cache)
+        await cache.redis.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size-kb", type=int, default=100)
+    parser.add_argument("--num-payloads", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
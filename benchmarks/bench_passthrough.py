@@ -0,0 +1,94 @@
+"""
+bench_passthrough.py
+
+Compares the per-request CPU time and peak memory of serving a QA pair from the queue by
+re-parsing it (decompress, json.loads, pydantic model, jsonable_encoder, json.dumps, as FastAPI
+did before) against stitching the stored JSON bytes into the response envelope, after
+decompressing them, and compressing the response for clients that accept zstd.
+
+Usage:
+    python -m benchmarks.bench_passthrough --size-kb 100 --iterations 500
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.payloads import make_qa_pair
+from commons.cache.codec import get_codec
+from commons.routes.synthetic_gen import SyntheticGenResponse, _passthrough_response
+
+
+def reparse(value: bytes) -> bytes:
+    body = json.loads(get_codec().decode(value).decode("utf-8"))
+    response = SyntheticGenResponse(success=True, body=body, error=None)
+    # same as fastapi.responses.JSONResponse.render
+    return json.dumps(
+        jsonable_encoder(response),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def passthrough(value: bytes) -> bytes:
+    return bytes(_passthrough_response([value], False).body)
+
+
+def passthrough_zstd(value: bytes) -> bytes:
+    return bytes(_passthrough_response([value], False, "zstd").body)
+
+
+def measure(fn, value: bytes, iterations: int) -> tuple[float, float]:
+    """Returns the mean CPU time in ms and the peak traced memory in KB of one call."""
+    fn(value)
+    start_time = time.process_time()
+    for _ in range(iterations):
+        fn(value)
+    cpu_ms = (time.process_time() - start_time) / iterations * 1000
+
+    tracemalloc.start()
+    fn(value)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size-kb", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    # stored the same way as RedisCache.enqueue
+    data = json.dumps(jsonable_encoder(make_qa_pair(args.size_kb))).encode("utf-8")
+    value = get_codec().encode(data)
+    assert json.loads(reparse(value)) == json.loads(passthrough(value))
+    print(
+        f"payload: {len(data) / 1024:.1f} KB, stored as {len(value) / 1024:.1f} KB "
+        f"with codec {get_codec().codec}, {args.iterations} iterations"
+    )
+
+    results = {
+        name: measure(fn, value, args.iterations)
+        for name, fn in [
+            ("reparse", reparse),
+            ("passthrough", passthrough),
+            ("passthrough_zstd", passthrough_zstd),
+        ]
+    }
+    for name, (cpu_ms, peak_kb) in results.items():
+        print(
+            f"{name:<16} cpu: {cpu_ms:8.3f} ms/request  peak memory: {peak_kb:8.1f} KB"
+        )
+    for name in ["passthrough", "passthrough_zstd"]:
+        speedup = results["reparse"][0] / results[name][0]
+        print(f"{name} is {speedup:.1f}x faster than reparse")
+
+
+if __name__ == "__main__":
+    main()
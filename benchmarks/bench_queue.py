@@ -0,0 +1,102 @@
+"""
+bench_queue.py
+
+Measures the throughput of enqueue, the latency of dequeue + ack, and the throughput of worker
+counter updates of each cache backend, e.g.
+    python -m benchmarks.bench_queue --backends memory sqlite redis
+The redis backend uses the queue backend in REDIS_QUEUE_BACKEND, run it once with each:
+    REDIS_QUEUE_BACKEND=stream python -m benchmarks.bench_queue --backends redis
+
+Keys are written under the `bench_queue` prefix and deleted afterwards, the sqlite backend uses a
+temporary database.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.payloads import make_qa_pair
+from commons.cache import CacheBackend, get_cache
+from commons.config import get_settings
+
+
+async def bench_backend(cache: CacheBackend, payloads: list[dict], args):
+    await cache.clear()
+    try:
+        start_time = time.perf_counter()
+        for payload in payloads:
+            await cache.enqueue(payload)
+        enqueue_per_sec = len(payloads) / (time.perf_counter() - start_time)
+
+        latencies: list[float] = []
+
+        async def consumer():
+            while True:
+                request_start = time.perf_counter()
+                items = await cache.dequeue_many(args.batch_size)
+                if not items:
+                    return
+                await cache.ack(items)
+                latencies.append(time.perf_counter() - request_start)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*[consumer() for _ in range(args.concurrency)])
+        dequeue_per_sec = len(payloads) / (time.perf_counter() - start_time)
+
+        # each worker updates the counter before and after building a QA pair
+        start_time = time.perf_counter()
+        for _ in range(args.num_counter_updates // 2):
+            await cache.update_num_workers_active(1, "GAMES:CHANGE_ANSWERS")
+            await cache.update_num_workers_active(-1, "GAMES:CHANGE_ANSWERS")
+        counter_per_sec = args.num_counter_updates / (time.perf_counter() - start_time)
+    finally:
+        await cache.clear()
+        await cache.close()
+
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    print(
+        f"backend: {type(cache).__name__}, {args.num_payloads} payloads of "
+        f"{args.size_kb} KB, batch size {args.batch_size}, {args.concurrency} consumers"
+    )
+    print(f"enqueue:         {enqueue_per_sec:8.1f} payloads/s")
+    print(f"dequeue + ack:   {dequeue_per_sec:8.1f} payloads/s")
+    print(f"dequeue + ack latency: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+    print(f"counter updates: {counter_per_sec:8.1f} updates/s")
+
+
+async def main_async(args):
+    payloads = [make_qa_pair(args.size_kb, seed) for seed in range(args.num_payloads)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in args.backends:
+            cache = get_cache(backend)
+            # keep away from the real queue, and skip parsing the CLI args of the service
+            cache._key_prefix = "bench_queue"
+            cache.history_ttl_ms = 0
+            if backend == "sqlite":
+                cache.path = os.path.join(tmp_dir, "bench_queue.db")  # type: ignore
+            await bench_backend(cache, payloads, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size-kb", type=int, default=100)
+    parser.add_argument("--num-payloads", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--num-counter-updates", type=int, default=1000)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=["memory", "sqlite", "redis"],
+        default=[get_settings().cache.backend],
+    )
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+bench_spill.py
+
+Checks that QA pairs spilled to disk by one process reach the consumers of another process that
+shares the redis, and measures how long they take to drain, e.g.
+    REDIS_MEMORY_BUDGET_BYTES=200000 python -m benchmarks.bench_spill --num-payloads 200
+
+The producer enqueues every payload, most of which are spilled, and then only moves them back
+into redis with the refill timer of `WorkerManager`, like a replica whose routes are not called.
+The consumer dequeues from the other process until it has every payload, and exits with status 1
+if any payload is lost or delivered twice.
+
+Keys are written under the `bench_spill` prefix and deleted afterwards.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from benchmarks.payloads import make_qa_pair
+from commons.cache import get_cache
+from commons.config import get_settings
+
+
+def _get_cache():
+    cache = get_cache("redis")
+    # keep away from the real queue, and skip parsing the CLI args of the service
+    cache._key_prefix = "bench_spill"
+    cache.history_ttl_ms = 0
+    return cache
+
+
+async def produce(args, enqueued):
+    from commons.worker import WorkerManager
+
+    cache = _get_cache()
+    await cache.clear()
+    for seed in range(args.num_payloads):
+        await cache.enqueue(make_qa_pair(args.size_kb, seed))
+    num_spilled = cache._spill.num_records  # type: ignore
+    print(f"producer: enqueued {args.num_payloads} payloads, {num_spilled} spilled")
+    enqueued.set()
+
+    refill_task = asyncio.create_task(
+        WorkerManager(do_work=lambda: None).refill_spilled()
+    )
+    deadline = time.monotonic() + args.timeout
+    while cache._spill.num_records and time.monotonic() < deadline:  # type: ignore
+        await asyncio.sleep(0.1)
+    refill_task.cancel()
+    await cache.close()
+
+
+async def consume(args, enqueued) -> bool:
+    cache = _get_cache()
+    await asyncio.to_thread(enqueued.wait)
+    queue_length = await cache.get_queue_length()
+    print(f"consumer: queue length {queue_length}, including spilled payloads")
+
+    ids: list[str] = []
+    start_time = time.perf_counter()
+    deadline = time.monotonic() + args.timeout
+    while len(ids) < args.num_payloads and time.monotonic() < deadline:
+        items = await cache.dequeue_many(args.batch_size, block_sec=1)
+        await cache.ack(items)
+        ids += [item.id for item in items]
+    elapsed = time.perf_counter() - start_time
+    await cache.clear()
+    await cache.close()
+
+    print(
+        f"consumer: {len(ids)}/{args.num_payloads} payloads in {elapsed:.2f}s, "
+        f"{len(ids) / elapsed:.1f} payloads/s"
+    )
+    passed = queue_length == args.num_payloads and sorted(set(ids)) == sorted(ids)
+    return passed and len(ids) == args.num_payloads
+
+
+def _run_producer(args, enqueued):
+    asyncio.run(produce(args, enqueued))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size-kb", type=int, default=100)
+    parser.add_argument("--num-payloads", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+    if get_settings().redis.memory_budget_bytes <= 0:
+        parser.error("set REDIS_MEMORY_BUDGET_BYTES to enable spilling")
+
+    context = multiprocessing.get_context("spawn")
+    enqueued = context.Event()
+    producer = context.Process(target=_run_producer, args=(args, enqueued))
+    producer.start()
+    passed = asyncio.run(consume(args, enqueued))
+    producer.join()
+    if not passed:
+        print("FAILED: payloads were lost or delivered twice")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
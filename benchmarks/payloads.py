@@ -0,0 +1,85 @@
+"""
+payloads.py
+
+Realistic QA pair payloads for benchmarks, built from the HTML answers in
+`example-lab-outputs.json` so they compress and serialize like the real ones.
+"""
+
+import json
+import os
+import random
+import re
+
+import uuid_utils
+
+_EXAMPLES_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "example-lab-outputs.json",
+)
+_TOPICS = ["GAMES", "ANIMATION", "SCIENCE", "PHYSICS"]
+_STRATEGIES = ["NO_AUGMENTATION", "CHANGE_QUESTIONS", "CHANGE_ANSWERS"]
+
+
+def _load_statements() -> list[str]:
+    with open(_EXAMPLES_PATH) as f:
+        examples = json.load(f)
+    contents = [file["content"] for example in examples for file in example["files"]]
+    return [s for content in contents for s in re.split(r"(?<=[;}>])", content) if s]
+
+
+def _make_answer(statements: list[str], size: int, rng: random.Random) -> str:
+    """Statements sampled from the examples, with random numbers, so that payloads with
+    different seeds share vocabulary like real answers do, but are not copies of each other.
+    """
+    parts = []
+    length = 0
+    while length < size:
+        statement = re.sub(
+            r"\d+", lambda _: str(rng.randrange(1000)), rng.choice(statements)
+        )
+        parts.append(statement)
+        length += len(statement)
+    return "".join(parts)[:size]
+
+
+def make_qa_pair(size_kb: int = 100, seed: int = 0) -> dict:
+    """A QA pair shaped like the output of `build_prompt_responses_pair`, with four
+    HTML answers adding up to roughly `size_kb` KB.
+    """
+    statements = _load_statements()
+    rng = random.Random(seed)
+    answer_size = size_kb * 1024 // 4
+    # answers to the same question are mostly similar, so they share a base answer
+    base_answer = _make_answer(statements, answer_size, rng)
+    responses = []
+    ground_truth = {}
+    for i in range(4):
+        cut = rng.randrange(answer_size // 2, answer_size)
+        html = base_answer[:cut] + _make_answer(statements, answer_size - cut, rng)
+        cid = str(uuid_utils.uuid4())
+        responses.append(
+            {
+                "model": f"anthropic/claude-3.5-sonnet-{i}",
+                "completion": {
+                    "files": [
+                        {
+                            "filename": "index.html",
+                            "content": html,
+                            "language": "html",
+                        }
+                    ]
+                },
+                "cid": cid,
+            }
+        )
+        ground_truth[cid] = i
+    return {
+        "prompt": "Create an interactive visualization of a historical timeline. " * 8,
+        "question_model": "anthropic/claude-3.5-sonnet",
+        "responses": responses,
+        "ground_truth": ground_truth,
+        "augmented_prompts": [],
+        "topic": _TOPICS[seed % len(_TOPICS)],
+        "persona": "A history teacher who wants to engage students.",
+        "metadata": {"augment_type": _STRATEGIES[seed % len(_STRATEGIES)]},
+    }
@@ -1 +1,5 @@
+from .base import CacheBackend as CacheBackend
+from .base import HistoryEntry as HistoryEntry
+from .base import QueueItem as QueueItem
+from .base import get_cache as get_cache
 from .redis import RedisCache as RedisCache
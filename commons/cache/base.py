@@ -0,0 +1,416 @@
+"""
+base.py
+
+Interface of the cache that holds the queue of QA pairs, their history, and the counters shared
+by workers, selected with `CACHE_BACKEND`:
+- "redis" (default): `RedisCache`, shared by every process that can reach redis, with the list
+  or stream queue backend selected with `REDIS_QUEUE_BACKEND`
+- "memory": `MemoryCache`, plain asyncio data structures, only shared within one process
+- "sqlite": `SQLiteCache`, a SQLite database in WAL mode, shared by the processes of one host
+
+Every backend stores payloads as encoded by `get_codec()`, keeps one queue per partition, and
+expires history entries `history_ttl_ms` after they are dequeued. `tests/test_cache.py` checks
+that every backend behaves the same.
+"""
+
+import functools
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, NamedTuple
+
+import uuid_utils
+from loguru import logger
+
+from commons.cache.codec import get_codec
+from commons.config import get_settings, parse_cli_args
+from commons.utils.serialization import dumps
+
+
+class QueueItem(NamedTuple):
+    # uuid7 id of the history entry
+    id: str
+    # payload as stored, decode with `get_codec().decode`
+    value: bytes
+    # queue the item was dequeued from, so it can be requeued or acknowledged
+    queue_key: str = ""
+    # id of the delivery to acknowledge, only used by the stream backend
+    message_id: str = ""
+
+
+def partition_of(data: Any) -> str | None:
+    """Partition of a QA pair, "<topic>:<augment_type>", None if either is missing."""
+    if not isinstance(data, dict):
+        return None
+    topic = data.get("topic")
+    augment_type = (data.get("metadata") or {}).get("augment_type")
+    if not topic or not augment_type:
+        return None
+    return f"{topic}:{augment_type}"
+
+
+class HistoryEntry(NamedTuple):
+    # uuid7 id of the history entry
+    id: str
+    # unix timestamp of the enqueue, from the uuid7 id
+    created_at: float
+    # payload as stored, if requested
+    value: bytes | None = None
+
+
+# facets of the history index, and the filters of `query_history`
+HISTORY_FACETS = ("topic", "model", "strategy")
+
+
+def history_facets(data: Any) -> dict[str, list[str]]:
+    """Facet values of a QA pair. Its models are the question model and every answer model."""
+    if not isinstance(data, dict):
+        return {}
+    models = {data.get("question_model")} | {
+        response.get("model") for response in data.get("responses") or []
+    }
+    facets = {
+        "topic": [data.get("topic")],
+        "model": sorted(model for model in models if model),
+        "strategy": [(data.get("metadata") or {}).get("augment_type")],
+    }
+    return {
+        facet: [value for value in values if value]
+        for facet, values in facets.items()
+        if any(values)
+    }
+
+
+def uuid7_ms(id: str) -> int:
+    """Unix timestamp in ms of a uuid7, its first 48 bits."""
+    return int(id[:8] + id[9:13], 16)
+
+
+def uuid7_prefix(ms: int) -> str:
+    """Prefix of every uuid7 created at `ms`, it sorts before all of them and after every
+    uuid7 created earlier.
+    """
+    hex_ms = f"{ms:012x}"
+    return f"{hex_ms[:8]}-{hex_ms[8:]}"
+
+
+def matches_partition(
+    partition: str, topic: str | None = None, augment_type: str | None = None
+) -> bool:
+    partition_topic, _, partition_augment_type = partition.partition(":")
+    return (topic is None or partition_topic == topic) and (
+        augment_type is None or partition_augment_type == augment_type
+    )
+
+
+class CacheBackend(ABC):
+    _key_prefix: str = "synthetic"
+    # QA pairs are queued in "queue:<topic>:<augment_type>", "queue" holds QA pairs without
+    # a partition
+    _queue_key: str = "queue"
+    # set of partitions that QA pairs have been queued in
+    _partitions_key: str = "queue_partitions"
+    # key prefix to historical data
+    _hist_key_prefix: str = "history"
+    # key to figure out how many workers are working
+    _num_workers_active_key: str = "num_workers_active"
+    # hash of how many workers are working on each partition
+    _num_workers_active_by_partition_key: str = "num_workers_active_by_partition"
+    # key to the unix timestamp of the last successful enqueue
+    _last_enqueue_key: str = "last_enqueue_at"
+    # ids of history entries ordered by time, "history_index:<facet>:<value>" holds the ids
+    # with that facet value
+    _history_index_key: str = "history_index"
+    # set of the values of a facet, "history_facets:<facet>"
+    _history_facets_key: str = "history_facets"
+    # maximum number of index entries looked at by one `query_history` call, so filters that
+    # match few entries return a partial page with a cursor instead of walking the whole index
+    _history_max_scan: int = 10_000
+    _encoding: str = "utf-8"
+
+    def _build_key(self, *parts: str) -> str:
+        if len(parts) == 0:
+            raise ValueError("Must specify at least one cache key")
+        return f"{self._key_prefix}:{':'.join(parts)}"
+
+    def build_key(self, *parts: str) -> str:
+        """Key of a shared value under the key prefix of the cache, for `get_value`,
+        `set_value` and `incr`, e.g. `build_key("sampler", name, "cursor")`.
+        """
+        return self._build_key(*parts)
+
+    @functools.cached_property
+    def history_ttl_ms(self) -> int:
+        """Expiry of history entries once dequeued, 0 if they never expire.
+
+        Resolved once on first use instead of in `__new__`, as `parse_cli_args` fails on
+        the arguments of other CLIs that also use the cache.
+        """
+        args = parse_cli_args()
+        if args.env_name and args.env_name == "prod":
+            # expire in 4 hours time
+            return 3600 * 4 * 1000
+        return 0
+
+    def _partition_queue_key(self, partition: str | None) -> str:
+        if partition is None:
+            return self._build_key(self._queue_key)
+        return self._build_key(self._queue_key, partition)
+
+    def _new_entry(self, data: Any) -> tuple[str, bytes, str | None]:
+        """Id, stored value and partition of a QA pair to enqueue.
+
+        Raises:
+            ValueError: If data is None.
+        """
+        if data is None:
+            raise ValueError("Data is required")
+        # use uuid7 so ids are sorted by time
+        return (
+            uuid_utils.uuid7().__str__(),
+            get_codec().encode(dumps(data)),
+            partition_of(data),
+        )
+
+    async def close(self) -> None:
+        try:
+            # clear all active workers
+            delta = -1 * await self.get_num_workers_active()
+            await self.update_num_workers_active(delta)
+        except Exception as exc:
+            logger.opt(exception=True).error(f"Error closing cache: {exc}")
+
+    @abstractmethod
+    async def clear(self):
+        """Delete everything stored under the key prefix, used by benchmarks and checks."""
+
+    @abstractmethod
+    async def ping(self) -> float:
+        """Round trip time to the backend in seconds."""
+
+    @abstractmethod
+    async def _partition_names(self) -> set[str]: ...
+
+    @abstractmethod
+    async def _queue_lengths(self, keys: list[str]) -> list[int]: ...
+
+    async def get_partitions(
+        self, topic: str | None = None, augment_type: str | None = None
+    ) -> list[str]:
+        """Partitions that QA pairs have been queued in, filtered by topic and augment type."""
+        partitions = sorted(await self._partition_names())
+        return [p for p in partitions if matches_partition(p, topic, augment_type)]
+
+    async def _queue_keys(
+        self, topic: str | None = None, augment_type: str | None = None
+    ) -> list[str]:
+        """Keys of the queues holding QA pairs that match the filters."""
+        if topic is not None and augment_type is not None:
+            return [self._partition_queue_key(f"{topic}:{augment_type}")]
+        keys = [
+            self._partition_queue_key(partition)
+            for partition in await self.get_partitions(topic, augment_type)
+        ]
+        if topic is None and augment_type is None:
+            keys.append(self._partition_queue_key(None))
+        return keys
+
+    async def get_partition_queue_lengths(self) -> dict[str, int]:
+        """Number of queued QA pairs of each partition."""
+        partitions = await self.get_partitions()
+        lengths = await self._queue_lengths(
+            [self._partition_queue_key(partition) for partition in partitions]
+        )
+        return dict(zip(partitions, lengths, strict=True))
+
+    async def get_queue_length(
+        self, topic: str | None = None, augment_type: str | None = None
+    ) -> int:
+        """Number of queued QA pairs, of all partitions unless filtered."""
+        keys = await self._queue_keys(topic, augment_type)
+        num_items = sum(await self._queue_lengths(keys))
+        logger.trace(f"Queue length: {num_items}, time: {(datetime.now().timestamp())}")
+        return num_items
+
+    @abstractmethod
+    async def get_last_enqueue_time(self) -> float | None:
+        """Unix timestamp of the last successful enqueue by any worker, None if there was none."""
+
+    @abstractmethod
+    async def get_num_workers_active(self) -> int: ...
+
+    @abstractmethod
+    async def get_num_workers_active_by_partition(self) -> dict[str, int]:
+        """Number of active workers building a QA pair of a specific partition."""
+
+    @abstractmethod
+    async def reset_num_workers_active_by_partition(self): ...
+
+    @abstractmethod
+    async def update_num_workers_active(
+        self, delta: int, partition: str | None = None
+    ) -> int:
+        """Update the number of workers active by delta.
+
+        Args:
+            delta (int): Amount to increment/decrement the count by. To decrement use a negative number.
+            partition (str | None): Partition the workers are building QA pairs of, if any.
+
+        Returns:
+            int: The new number of workers active.
+        """
+
+    @abstractmethod
+    async def enqueue(self, data: Any) -> int:
+        """Store a QA pair in the history and push its id into the queue of its partition.
+
+        Raises:
+            ValueError: If data is None.
+
+        Returns:
+            int: Number of elements in the queue of the partition.
+        """
+
+    @abstractmethod
+    async def dequeue_many(
+        self,
+        count: int,
+        block_sec: float = 0,
+        topic: str | None = None,
+        augment_type: str | None = None,
+    ) -> list[QueueItem]:
+        """Dequeue up to `count` QA pairs with their stored values, oldest first.
+
+        Args:
+            count (int): Maximum number of items to dequeue.
+            block_sec (float): Maximum time to wait for an item if the queues are empty.
+            topic (str | None): Only dequeue QA pairs of this topic.
+            augment_type (str | None): Only dequeue QA pairs of this augment type.
+
+        Returns:
+            list[QueueItem]: Dequeued items, empty if the queues are empty.
+        """
+
+    @abstractmethod
+    async def requeue(self, items: list[QueueItem]) -> int:
+        """Put dequeued items back at the front of their queues, keeping their order.
+
+        Returns:
+            int: Number of items requeued.
+        """
+
+    async def dequeue(self) -> str | None:
+        """Dequeue an item from the specified queue key, assumes it is a queue and
+        returns the value as as a string
+        """
+        items = await self.dequeue_many(1)
+        if not items:
+            return None
+        await self.ack(items)
+        return get_codec().decode(items[0].value).decode(self._encoding)
+
+    async def ack(self, items: list[QueueItem]):  # noqa: B027
+        """Acknowledge that dequeued items were delivered. Items are removed from the
+        queue on dequeue, so there is nothing to do unless the backend tracks deliveries.
+        """
+
+    async def get_num_in_flight(self) -> int | None:
+        """Number of items dequeued but not acknowledged yet, None if not tracked."""
+        return None
+
+    async def refill_spilled(self):  # noqa: B027
+        """Move QA pairs this process spilled to disk back into the queue if there is room,
+        nothing to do unless the backend spills, see `commons/cache/spill.py`.
+        """
+
+    def _history_facet_key(self, facet: str, value: str) -> str:
+        return self._build_key(self._history_index_key, facet, value)
+
+    @abstractmethod
+    async def query_history(
+        self,
+        limit: int = 50,
+        cursor: str | None = None,
+        topic: str | None = None,
+        model: str | None = None,
+        strategy: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        with_values: bool = False,
+    ) -> tuple[list[HistoryEntry], str | None]:
+        """Page through the history index, newest first, without scanning the keyspace.
+
+        Entries whose history has expired are skipped and removed from the index.
+
+        Args:
+            limit (int): Maximum number of entries to return.
+            cursor (str | None): Cursor returned with the previous page.
+            topic (str | None): Only entries of this topic.
+            model (str | None): Only entries with a question or answer from this model.
+            strategy (str | None): Only entries of this augment strategy.
+            since (float | None): Only entries enqueued at or after this unix timestamp.
+            until (float | None): Only entries enqueued at or before this unix timestamp.
+            with_values (bool): Also return the stored payloads.
+
+        Returns:
+            tuple[list[HistoryEntry], str | None]: The entries, and the cursor of the next
+                page, None once there are no more entries. A page can have fewer than `limit`
+                entries and still be followed by more, if the filters matched few entries.
+        """
+
+    @abstractmethod
+    async def get_history_facets(self) -> dict[str, dict[str, int]]:
+        """Number of indexed entries with each value of each facet, including expired entries
+        that were not removed from the index yet.
+        """
+
+    @abstractmethod
+    async def trim_history_index(self) -> int:
+        """Remove entries enqueued more than `history_ttl_ms` ago from the history index and
+        its facets, and facet values left without entries, so the index does not grow
+        without bound. Nothing is removed if history never expires.
+
+        The index then covers the last `history_ttl_ms`, an entry still queued after that
+        is dropped from the index but is still dequeued.
+
+        Returns:
+            int: Number of entries removed from the index.
+        """
+
+    @abstractmethod
+    async def get_value(self, key: str) -> bytes | None:
+        """Value of a shared key, e.g. the state of `PermutationCycler`."""
+
+    @abstractmethod
+    async def set_value(self, key: str, value: str | int, nx: bool = False) -> bool:
+        """Set a shared key, only if it does not exist yet if `nx` is set.
+
+        Returns:
+            bool: Whether the key was set.
+        """
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        """Increment a shared counter, which starts at 0, and return its new value."""
+
+
+@functools.lru_cache(maxsize=1)
+def _configured_backend() -> str:
+    return get_settings().cache.backend
+
+
+def get_cache(backend: str | None = None) -> CacheBackend:
+    """The cache of this process, of `backend` if set, otherwise of `CACHE_BACKEND`."""
+    backend = backend or _configured_backend()
+    if backend == "redis":
+        from commons.cache.redis import RedisCache
+
+        return RedisCache()
+    if backend == "memory":
+        from commons.cache.memory import MemoryCache
+
+        return MemoryCache()
+    if backend == "sqlite":
+        from commons.cache.sqlite import SQLiteCache
+
+        return SQLiteCache()
+    raise ValueError(f"Unknown cache backend: {backend}")
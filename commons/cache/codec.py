@@ -0,0 +1,147 @@
+"""
+codec.py
+
+Storage format of QA pair payloads in redis.
+
+Each QA pair holds four mostly similar HTML answers, so payloads compress well. Stored values
+start with a format byte followed by the encoded JSON:
+- `FORMAT_JSON` (0x00): uncompressed JSON
+- `FORMAT_ZSTD` (0x01): a zstd frame, compressed with the dictionary whose id is in the frame
+  header, or without a dictionary if the id is 0
+
+Values written before the format byte was introduced are plain JSON objects, so they start with
+`{` and are decoded as is.
+
+A dictionary trained on past payloads improves the compression ratio of small payloads, train one
+from the history in redis with:
+    python -m commons.cache.codec --output zstd.dict --samples 1000
+and set `REDIS_ZSTD_DICT_PATH` to use it. Keep old dictionaries around while values compressed
+with them are still stored, only one dictionary can be loaded at a time.
+"""
+
+import argparse
+import asyncio
+import functools
+
+import zstandard
+from loguru import logger
+
+from commons.config import get_settings
+
+FORMAT_JSON = 0x00
+FORMAT_ZSTD = 0x01
+_LEGACY_JSON = ord("{")
+
+
+class PayloadCodec:
+    def __init__(self, codec: str = "zstd", level: int = 3, dict_data: bytes = b""):
+        if codec not in ("zstd", "none"):
+            raise ValueError(f"Unknown redis codec: {codec}")
+        self.codec = codec
+        self.dictionary = (
+            zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+        )
+        self._compressor = zstandard.ZstdCompressor(
+            level=level, dict_data=self.dictionary
+        )
+        # used for responses to clients that accept zstd, which have no dictionary
+        self._plain_compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressors = {0: zstandard.ZstdDecompressor()}
+        if self.dictionary is not None:
+            self._decompressors[self.dictionary.dict_id()] = zstandard.ZstdDecompressor(
+                dict_data=self.dictionary
+            )
+
+    def encode(self, data: bytes) -> bytes:
+        """Encode JSON bytes for storage."""
+        if self.codec == "zstd":
+            return bytes([FORMAT_ZSTD]) + self._compressor.compress(data)
+        return bytes([FORMAT_JSON]) + data
+
+    def decode(self, value: bytes) -> bytes:
+        """Decode a stored value back to JSON bytes."""
+        if not value:
+            raise ValueError("Cannot decode an empty value")
+        fmt = value[0]
+        if fmt == _LEGACY_JSON:
+            return value
+        if fmt == FORMAT_JSON:
+            return value[1:]
+        if fmt == FORMAT_ZSTD:
+            frame = memoryview(value)[1:]
+            dict_id = zstandard.get_frame_parameters(frame).dict_id
+            decompressor = self._decompressors.get(dict_id)
+            if decompressor is None:
+                raise ValueError(
+                    f"Value was compressed with zstd dictionary {dict_id}, which is not loaded"
+                )
+            return decompressor.decompress(frame)
+        raise ValueError(f"Unknown payload format: {fmt:#04x}")
+
+    def compress_response(self, parts: list[bytes]) -> bytes:
+        """Compress the parts of a response body to a single zstd frame, without a
+        dictionary so that any client can decompress it.
+        """
+        compressor = self._plain_compressor.compressobj(
+            size=sum(len(part) for part in parts)
+        )
+        chunks = [compressor.compress(part) for part in parts]
+        chunks.append(compressor.flush())
+        return b"".join(chunks)
+
+
+@functools.lru_cache(maxsize=1)
+def get_codec() -> PayloadCodec:
+    settings = get_settings().redis
+    dict_data = b""
+    if settings.zstd_dict_path:
+        with open(settings.zstd_dict_path, "rb") as f:
+            dict_data = f.read()
+        logger.info(f"Loaded zstd dictionary from {settings.zstd_dict_path}")
+    return PayloadCodec(settings.codec, settings.zstd_level, dict_data)
+
+
+async def _load_history_samples(num_samples: int) -> list[bytes]:
+    from commons.cache import RedisCache
+
+    cache = RedisCache()
+    codec = get_codec()
+    samples: list[bytes] = []
+    pattern = cache._build_key(cache._hist_key_prefix, "*")
+    async for key in cache.redis.scan_iter(match=pattern, count=500):
+        value = await cache.redis.get(key)
+        if value is None:
+            continue
+        samples.append(codec.decode(value))
+        if len(samples) >= num_samples:
+            break
+    await cache.redis.close()
+    return samples
+
+
+def train_dictionary(samples: list[bytes], dict_size: int) -> bytes:
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Train a zstd dictionary on QA pairs from the history in redis"
+    )
+    parser.add_argument("--output", required=True, help="Path to write the dictionary")
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--dict-size", type=int, default=112 * 1024)
+    args = parser.parse_args()
+
+    samples = asyncio.run(_load_history_samples(args.samples))
+    if not samples:
+        raise SystemExit("No history entries found in redis")
+    dict_data = train_dictionary(samples, args.dict_size)
+    with open(args.output, "wb") as f:
+        f.write(dict_data)
+    logger.success(
+        f"Trained zstd dictionary on {len(samples)} QA pairs, written to {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+memory.py
+
+Cache backend on plain asyncio data structures, selected with `CACHE_BACKEND=memory`.
+
+Nothing leaves the process, so there is no round trip per queue operation or counter update, and
+no redis server is needed to run the service or its benchmarks. The queue is only shared by the
+workers and routes of one process, so run uvicorn with a single worker, and QA pairs are lost
+when the process exits.
+"""
+
+import asyncio
+import bisect
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any
+
+from loguru import logger
+
+from commons.cache.base import (
+    HISTORY_FACETS,
+    CacheBackend,
+    HistoryEntry,
+    QueueItem,
+    history_facets,
+    uuid7_ms,
+    uuid7_prefix,
+)
+
+
+class MemoryCache(CacheBackend):
+    _instance: "MemoryCache | None" = None
+    # expired history entries are deleted this often, they are never returned once expired
+    _purge_interval_sec: float = 60.0
+
+    def __new__(cls) -> "MemoryCache":
+        if MemoryCache._instance is None:
+            instance = super().__new__(cls)
+            instance._reset()
+            MemoryCache._instance = instance
+        return MemoryCache._instance
+
+    def _reset(self):
+        self._queues: dict[str, deque[str]] = {}
+        self._partitions: set[str] = set()
+        self._history: dict[str, bytes] = {}
+        # monotonic time at which history entries expire, by id
+        self._expires_at: dict[str, float] = {}
+        # ids of history entries in time order, and the ids with each facet value
+        self._history_index: list[str] = []
+        self._history_facets: dict[str, dict[str, set[str]]] = {
+            facet: defaultdict(set) for facet in HISTORY_FACETS
+        }
+        self._values: dict[str, bytes] = {}
+        self._num_workers_active = 0
+        self._num_workers_active_by_partition: Counter[str] = Counter()
+        # dequeues blocked until an item is queued
+        self._waiters: list[asyncio.Future[None]] = []
+        self._last_purge_at = time.monotonic()
+
+    async def clear(self):
+        self._reset()
+
+    async def ping(self) -> float:
+        return 0.0
+
+    async def _partition_names(self) -> set[str]:
+        return set(self._partitions)
+
+    async def _queue_lengths(self, keys: list[str]) -> list[int]:
+        return [len(self._queues.get(key, ())) for key in keys]
+
+    async def get_last_enqueue_time(self) -> float | None:
+        value = self._values.get(self._build_key(self._last_enqueue_key))
+        return None if value is None else float(value)
+
+    async def get_num_workers_active(self) -> int:
+        return self._num_workers_active
+
+    async def get_num_workers_active_by_partition(self) -> dict[str, int]:
+        return {
+            partition: max(value, 0)
+            for partition, value in self._num_workers_active_by_partition.items()
+        }
+
+    async def reset_num_workers_active_by_partition(self):
+        self._num_workers_active_by_partition.clear()
+
+    async def update_num_workers_active(
+        self, delta: int, partition: str | None = None
+    ) -> int:
+        # ensure it doesn't go below 0
+        self._num_workers_active = max(self._num_workers_active + delta, 0)
+        if partition is not None:
+            self._num_workers_active_by_partition[partition] += delta
+        return self._num_workers_active
+
+    async def enqueue(self, data: Any) -> int:
+        id, value, partition = self._new_entry(data)
+        self._history[id] = value
+        # uuid7 ids sort by time, so this appends unless the clock went back
+        bisect.insort(self._history_index, id)
+        for facet, values in history_facets(data).items():
+            for facet_value in values:
+                self._history_facets[facet][facet_value].add(id)
+        if partition is not None:
+            self._partitions.add(partition)
+        queue = self._queues.setdefault(self._partition_queue_key(partition), deque())
+        queue.append(id)
+        self._values[self._build_key(self._last_enqueue_key)] = str(
+            time.time()
+        ).encode()
+        self._wake_waiters()
+        logger.debug(f"Queued {id} in partition {partition}")
+        return len(queue)
+
+    def _wake_waiters(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    def _get_history(self, id: str) -> bytes | None:
+        expires_at = self._expires_at.get(id)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._history.pop(id, None)
+            self._expires_at.pop(id, None)
+        return self._history.get(id)
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        if now - self._last_purge_at < self._purge_interval_sec:
+            return
+        self._last_purge_at = now
+        expired = [
+            id for id, expires_at in self._expires_at.items() if expires_at <= now
+        ]
+        for id in expired:
+            self._history.pop(id, None)
+            self._expires_at.pop(id, None)
+
+    def _pop_items(self, keys: list[str], count: int) -> list[QueueItem]:
+        """Pop up to `count` items, oldest first across queues as uuid7 ids sort by time.
+        Ids whose history entry no longer exists are skipped.
+        """
+        self._purge_expired()
+        items: list[QueueItem] = []
+        while len(items) < count:
+            heads = [
+                (queue[0], key) for key in keys if (queue := self._queues.get(key))
+            ]
+            if not heads:
+                break
+            id, key = min(heads)
+            self._queues[key].popleft()
+            value = self._get_history(id)
+            if value is None:
+                continue
+            if self.history_ttl_ms > 0:
+                self._expires_at[id] = time.monotonic() + self.history_ttl_ms / 1000
+            items.append(QueueItem(id=id, value=value, queue_key=key))
+        return items
+
+    async def dequeue_many(
+        self,
+        count: int,
+        block_sec: float = 0,
+        topic: str | None = None,
+        augment_type: str | None = None,
+    ) -> list[QueueItem]:
+        items = self._pop_items(await self._queue_keys(topic, augment_type), count)
+        deadline = time.monotonic() + block_sec
+        while not items and time.monotonic() < deadline:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            # look up the queues again, the item may be in a new partition
+            items = self._pop_items(await self._queue_keys(topic, augment_type), count)
+        return items
+
+    async def requeue(self, items: list[QueueItem]) -> int:
+        for item in reversed(items):
+            # history entries do not expire while queued, unless they already expired
+            if self._get_history(item.id) is not None:
+                self._expires_at.pop(item.id, None)
+            self._queues.setdefault(item.queue_key, deque()).appendleft(item.id)
+        if items:
+            self._wake_waiters()
+        return len(items)
+
+    async def get_history_facets(self) -> dict[str, dict[str, int]]:
+        return {
+            facet: {value: len(ids) for value, ids in sorted(values.items())}
+            for facet, values in self._history_facets.items()
+        }
+
+    def _prune_history_index(self, ids: set[str]):
+        self._history_index = [id for id in self._history_index if id not in ids]
+        for values in self._history_facets.values():
+            for facet_ids in values.values():
+                facet_ids -= ids
+
+    async def trim_history_index(self) -> int:
+        if self.history_ttl_ms <= 0:
+            return 0
+        cutoff = uuid7_prefix(int(time.time() * 1000) - self.history_ttl_ms)
+        position = bisect.bisect_left(self._history_index, cutoff)
+        del self._history_index[:position]
+        for values in self._history_facets.values():
+            for value, ids in list(values.items()):
+                ids -= {id for id in ids if id < cutoff}
+                if not ids:
+                    del values[value]
+        return position
+
+    async def query_history(
+        self,
+        limit: int = 50,
+        cursor: str | None = None,
+        topic: str | None = None,
+        model: str | None = None,
+        strategy: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        with_values: bool = False,
+    ) -> tuple[list[HistoryEntry], str | None]:
+        filters = [
+            self._history_facets[facet].get(value, set())
+            for facet, value in zip(
+                HISTORY_FACETS, (topic, model, strategy), strict=True
+            )
+            if value is not None
+        ]
+        # ids sort by time, so time bounds are positions in the index
+        end = len(self._history_index)
+        if until is not None:
+            end = bisect.bisect_left(
+                self._history_index, uuid7_prefix(int(until * 1000) + 1)
+            )
+        if cursor is not None:
+            end = min(end, bisect.bisect_left(self._history_index, cursor))
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(
+                self._history_index, uuid7_prefix(int(since * 1000))
+            )
+
+        entries: list[HistoryEntry] = []
+        missing: set[str] = set()
+        position = end
+        while position > start and len(entries) < limit:
+            if end - position >= self._history_max_scan:
+                break
+            position -= 1
+            id = self._history_index[position]
+            if not all(id in ids for ids in filters):
+                continue
+            value = self._get_history(id)
+            if value is None:
+                missing.add(id)
+                continue
+            entries.append(
+                HistoryEntry(
+                    id=id,
+                    created_at=uuid7_ms(id) / 1000,
+                    value=value if with_values else None,
+                )
+            )
+        # the next page starts before the last id looked at
+        next_cursor = None if position <= start else self._history_index[position]
+        if missing:
+            self._prune_history_index(missing)
+        return entries, next_cursor
+
+    async def get_value(self, key: str) -> bytes | None:
+        return self._values.get(key)
+
+    async def set_value(self, key: str, value: str | int, nx: bool = False) -> bool:
+        if nx and key in self._values:
+            return False
+        self._values[key] = str(value).encode()
+        return True
+
+    async def incr(self, key: str) -> int:
+        value = int(self._values.get(key, b"0")) + 1
+        self._values[key] = str(value).encode()
+        return value
@@ -1,15 +1,128 @@
-import json
+import asyncio
+import heapq
+import itertools
+import re
+import time
 from collections.abc import Awaitable
 from datetime import datetime
 from typing import Any, cast
 
 import uuid_utils
-from fastapi.encoders import jsonable_encoder
 from loguru import logger
 from redis import asyncio as aioredis
-from redis.asyncio.client import Redis
+from redis.asyncio.client import Pipeline, Redis
+from redis.commands.core import AsyncScript
+from redis.exceptions import ResponseError
 
-from commons.config import RedisSettings, get_settings, parse_cli_args
+from commons.cache.base import (
+    HISTORY_FACETS,
+    CacheBackend,
+    HistoryEntry,
+    QueueItem,
+    history_facets,
+    uuid7_ms,
+)
+from commons.cache.codec import get_codec
+from commons.cache.spill import SpillPosition, SpillRecord, SpillStore
+from commons.config import RedisSettings, get_settings
+from commons.utils.serialization import loads
+
+_ID_PATTERN = re.compile(rb"[0-9a-f]+(-[0-9a-f]+){4}")
+
+# queues hold the uuid7 ids of history entries, one queue per partition. Every key is passed in
+# KEYS: the counter of the bytes queued in redis, the queues, then the history entries of the ids
+# read at the heads of the queues by the caller. ARGV is [history expiry in ms, number of queues,
+# then the queue index from 0 and the id of each head, oldest first]. Each id is popped if it is
+# still at the head of its queue, heads taken by another consumer in the meantime are skipped,
+# and the script returns [queue index, id, payload, ...]. Ids whose history entry no longer
+# exists are popped and skipped. History entries do not expire while queued, they expire ARGV[1]
+# ms after being dequeued, and their size is subtracted from the bytes queued in redis.
+# An empty id stands for a whole QA pair queued by versions before queues held ids, it is
+# popped and returned as the payload.
+_DEQUEUE_SCRIPT = """
+local ttl_ms = tonumber(ARGV[1])
+local num_queues = tonumber(ARGV[2])
+local num_ids = 0
+local results = {}
+for i = 3, #ARGV, 2 do
+    local queue_index = tonumber(ARGV[i])
+    local queue_key = KEYS[2 + queue_index]
+    local id = ARGV[i + 1]
+    local head = redis.call('LINDEX', queue_key, 0)
+    if id == '' then
+        if head and not string.match(head, '^%x+%-%x+%-%x+%-%x+%-%x+$') then
+            redis.call('LPOP', queue_key)
+            table.insert(results, queue_index)
+            table.insert(results, '')
+            table.insert(results, head)
+        end
+    else
+        num_ids = num_ids + 1
+        if head == id then
+            redis.call('LPOP', queue_key)
+            local hist_key = KEYS[1 + num_queues + num_ids]
+            local value = redis.call('GET', hist_key)
+            if value then
+                if ttl_ms > 0 then
+                    redis.call('PEXPIRE', hist_key, ttl_ms)
+                end
+                redis.call('DECRBY', KEYS[1], string.len(value))
+                table.insert(results, queue_index)
+                table.insert(results, id)
+                table.insert(results, value)
+            end
+        end
+    end
+end
+return results
+"""
+
+# fetches the history entries KEYS[2..] of ids popped from the queues, and starts to expire
+# them ARGV[1] ms from now, their size is subtracted from the bytes queued in redis in KEYS[1].
+# Returns their payloads, nil for entries that no longer exist
+_FETCH_SCRIPT = """
+local ttl_ms = tonumber(ARGV[1])
+local values = {}
+for i = 2, #KEYS do
+    local value = redis.call('GET', KEYS[i])
+    if value then
+        if ttl_ms > 0 then
+            redis.call('PEXPIRE', KEYS[i], ttl_ms)
+        end
+        redis.call('DECRBY', KEYS[1], string.len(value))
+    end
+    values[i - 1] = value
+end
+return values
+"""
+
+# puts ids back at the front of their queues in order, and removes the expiry set on dequeue.
+# KEYS are the counter of the bytes queued in redis, then the queue and history entry of each id
+# in ARGV
+_REQUEUE_SCRIPT = """
+for i = #ARGV, 1, -1 do
+    local hist_key = KEYS[2 * i + 1]
+    redis.call('PERSIST', hist_key)
+    redis.call('INCRBY', KEYS[1], redis.call('STRLEN', hist_key))
+    redis.call('LPUSH', KEYS[2 * i], ARGV[i])
+end
+return #ARGV
+"""
+
+# removes index entries older than the cutoff ARGV[1] in ms from the history index KEYS[1] and
+# the facet indexes, KEYS[2..] are pairs of the values set of a facet and the index of one of
+# its values ARGV[2..], values left without entries are removed from the values set
+_TRIM_HISTORY_SCRIPT = """
+local max_score = '(' .. ARGV[1]
+local num_trimmed = redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', max_score)
+for i = 2, #KEYS, 2 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i + 1], '-inf', max_score)
+    if redis.call('ZCARD', KEYS[i + 1]) == 0 then
+        redis.call('SREM', KEYS[i], ARGV[i / 2 + 1])
+    end
+end
+return num_trimmed
+"""
 
 
 def build_redis_url() -> str:
@@ -22,45 +135,117 @@ def build_redis_url() -> str:
         return f"redis://{redis.host}:{redis.port}"
 
 
-class RedisCache:
+class RedisCache(CacheBackend):
     _instance: "RedisCache | None" = None
-    _key_prefix: str = "synthetic"
-    _queue_key: str = "queue"
-    # key prefix to historical data
-    _hist_key_prefix: str = "history"
-    # key to figure out how many workers are working
-    _num_workers_active_key: str = "num_workers_active"
-    _encoding: str = "utf-8"
     redis: Redis  # pyright: ignore[reportMissingTypeArgument]
+    _dequeue_script: AsyncScript
+    _fetch_script: AsyncScript
+    _requeue_script: AsyncScript
+    _trim_history_script: AsyncScript
+    # size of the payloads of queued QA pairs
+    _queued_bytes_key: str = "queued_bytes"
+    # number of spilled QA pairs by queue key, see `commons/cache/spill.py`
+    _spilled_key: str = "spilled"
+    # ids of spilled QA pairs, which are in the history index before they are back in redis
+    _spilled_ids_key: str = "spilled_ids"
+    _spill: SpillStore | None = None
+    _memory_budget_bytes: int = 0
+    # QA pairs moved from the spill segments back into redis at a time
+    _refill_batch_size: int = 64
+    # how long to wait before trying to refill again when there is no room in redis
+    _refill_retry_sec: float = 0.5
+    _refill_after: float = 0.0
+    _refill_lock: asyncio.Lock
 
     def __new__(cls) -> "RedisCache":
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-            redis_url = build_redis_url()
-            cls._instance.redis = aioredis.from_url(url=redis_url)
-        return cls._instance
+        if RedisCache._instance is None:
+            impl = cls
+            if get_settings().redis.queue_backend == "stream":
+                from commons.cache.redis_stream import RedisStreamCache
 
-    def _build_key(self, *parts: str) -> str:
-        if len(parts) == 0:
-            raise ValueError("Must specify at least one redis key")
-        return f"{self._key_prefix}:{':'.join(parts)}"
+                impl = RedisStreamCache
+            elif get_settings().redis.queue_backend != "list":
+                raise ValueError(
+                    f"Unknown redis queue backend: {get_settings().redis.queue_backend}"
+                )
+            instance = super().__new__(impl)
+            redis_url = build_redis_url()
+            instance.redis = aioredis.from_url(url=redis_url)
+            instance._dequeue_script = instance.redis.register_script(_DEQUEUE_SCRIPT)
+            instance._fetch_script = instance.redis.register_script(_FETCH_SCRIPT)
+            instance._requeue_script = instance.redis.register_script(_REQUEUE_SCRIPT)
+            instance._trim_history_script = instance.redis.register_script(
+                _TRIM_HISTORY_SCRIPT
+            )
+            redis_settings = get_settings().redis
+            if redis_settings.memory_budget_bytes > 0:
+                instance._memory_budget_bytes = redis_settings.memory_budget_bytes
+                instance._spill = SpillStore(
+                    redis_settings.spill_dir, redis_settings.spill_segment_bytes
+                )
+            instance._refill_lock = asyncio.Lock()
+            RedisCache._instance = instance
+        return RedisCache._instance
 
     async def close(self) -> None:
+        await super().close()
         try:
-            # clear all active workers
-            delta = -1 * await self.get_num_workers_active()
-            await self.update_num_workers_active(delta)
-
             if self.redis:
                 await self.redis.close()
         except Exception as exc:
             logger.opt(exception=True).error(f"Error closing Redis connection: {exc}")
 
-    async def get_queue_length(self) -> int:
-        key = self._build_key(self._queue_key)
-        num_items: int = await cast(Awaitable[int], self.redis.llen(key))
-        logger.trace(f"Queue length: {num_items}, time: {(datetime.now().timestamp())}")
-        return num_items
+    async def clear(self):
+        keys = [
+            key async for key in self.redis.scan_iter(match=f"{self._key_prefix}:*")
+        ]
+        if keys:
+            await self.redis.delete(*keys)
+        if self._spill is not None:
+            self._spill.clear()
+
+    async def _partition_names(self) -> set[str]:
+        members = await cast(
+            Awaitable[set[bytes]],
+            self.redis.smembers(self._build_key(self._partitions_key)),
+        )
+        return {member.decode(self._encoding) for member in members}
+
+    async def _queue_lengths(self, keys: list[str]) -> list[int]:
+        return [
+            length + spilled
+            for length, spilled in zip(
+                await self._redis_queue_lengths(keys),
+                await self._spilled_lengths(keys),
+                strict=True,
+            )
+        ]
+
+    async def _redis_queue_lengths(self, keys: list[str]) -> list[int]:
+        """Number of QA pairs queued in redis, excluding spilled ones."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.llen(key)
+            return await pipe.execute()
+
+    async def _spilled_lengths(self, keys: list[str]) -> list[int]:
+        """Number of spilled QA pairs of each queue, by every process."""
+        if not keys or self._spill is None:
+            return [0] * len(keys)
+        values = await cast(
+            Awaitable[list[bytes | None]],
+            self.redis.hmget(self._build_key(self._spilled_key), keys),
+        )
+        return [max(int(value or 0), 0) for value in values]
+
+    async def get_last_enqueue_time(self) -> float | None:
+        value = await self.redis.get(self._build_key(self._last_enqueue_key))
+        return None if value is None else float(value)
+
+    async def ping(self) -> float:
+        start_time = time.perf_counter()
+        await self.redis.ping()
+        return time.perf_counter() - start_time
 
     async def get_num_workers_active(self) -> int:
         key = self._build_key(self._num_workers_active_key)
@@ -71,15 +256,26 @@ class RedisCache:
         )
         return num_active
 
-    async def update_num_workers_active(self, delta: int) -> int:
-        """Update the number of workers active by delta.
+    async def get_num_workers_active_by_partition(self) -> dict[str, int]:
+        values = await cast(
+            Awaitable[dict[bytes, bytes]],
+            self.redis.hgetall(
+                self._build_key(self._num_workers_active_by_partition_key)
+            ),
+        )
+        return {
+            partition.decode(self._encoding): max(int(value), 0)
+            for partition, value in values.items()
+        }
 
-        Args:
-            delta (int): Amount to increment/decrement the count by. To decrement use a negative number.
+    async def reset_num_workers_active_by_partition(self):
+        await self.redis.delete(
+            self._build_key(self._num_workers_active_by_partition_key)
+        )
 
-        Returns:
-            int: The new number of workers active.
-        """
+    async def update_num_workers_active(
+        self, delta: int, partition: str | None = None
+    ) -> int:
         key = self._build_key(self._num_workers_active_key)
 
         lock_key = self._build_key(key, "lock")
@@ -95,6 +291,12 @@ class RedisCache:
                 # ensure it doesn't go below 0
                 num_active = max(num_active, 0)
                 await self.redis.set(key, num_active)
+            if partition is not None:
+                await self.redis.hincrby(
+                    self._build_key(self._num_workers_active_by_partition_key),
+                    partition,
+                    delta,
+                )
         finally:
             # ensure we always release the lock
             try:
@@ -109,70 +311,616 @@ class RedisCache:
         pairs. This is because each QA pair may take long to generate and we
         want to maintain responsiveness of the FastAPI app.
 
+        QA pairs are queued by partition, i.e. their topic and augment type, so that
+        callers can dequeue QA pairs of a specific partition.
+
         Args:
-            key (str): Redis key that will be prefixed with `_key_prefix`.
             data (Any): Data to be enqueued.
 
         Raises:
             ValueError: If data is None.
 
         Returns:
-            int: Number of elements in the queue.
+            int: Number of elements in the queue of the partition.
         """
 
-        if data is None:
-            raise ValueError("Data is required")
-
-        # keep the historical data as is
-        # use uuid7 so keys in redis are sorted by time
-        redis_task_id = uuid_utils.uuid7().__str__()
+        # keep the historical data as is, and only push its id into the queue
+        redis_task_id, str_data, partition = self._new_entry(data)
         hist_key = self._build_key(self._hist_key_prefix, redis_task_id)
+        if self._spill is not None:
+            if len(str_data) > self._memory_budget_bytes:
+                logger.warning(
+                    f"QA pair {redis_task_id} of {len(str_data)} bytes is larger than "
+                    f"REDIS_MEMORY_BUDGET_BYTES={self._memory_budget_bytes}, it is only "
+                    "queued in redis when no other payloads are"
+                )
+            await self.refill_spilled()
+            # spill after the QA pairs of the partition already spilled, to keep its queue
+            # in order
+            if self._spill.num_records_of(partition) or not await self._has_room(
+                len(str_data)
+            ):
+                return await self._spill_entry(redis_task_id, str_data, partition, data)
         try:
             logger.debug(f"Writing persistent data into {hist_key}")
-            # place into persistent key
-            str_data = json.dumps(jsonable_encoder(data)).encode(self._encoding)
-            args = parse_cli_args()
-            if args.env_name and args.env_name == "prod":
-                # expire in 4 hours time
-                await self.redis.set(hist_key, str_data, ex=3600 * 4)  # pyright: ignore[reportUnknownMemberType]
-            else:
-                await self.redis.set(hist_key, str_data)  # pyright: ignore[reportUnknownMemberType]
-
-            queue_key = self._build_key(self._queue_key)
-            logger.debug(f"Writing queue data into {queue_key}")
-            # fuck it and push the data into the queue as well, instead of it being a reference to the persistent data
-            # this also simplifies dequeuing logic
-            num_items: int = await self.redis.rpush(queue_key, str_data)  # type: ignore
+            # place into persistent key, it only starts to expire once dequeued so that
+            # queued ids always point to an existing entry
+            logger.debug(f"Writing {redis_task_id} into queue of partition {partition}")
+            # write the entry, its id and the enqueue time in one round trip
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.set(self._build_key(self._last_enqueue_key), time.time())
+                pipe.set(hist_key, str_data)
+                if partition is not None:
+                    pipe.sadd(self._build_key(self._partitions_key), partition)
+                pipe.incrby(self._build_key(self._queued_bytes_key), len(str_data))
+                self._index_history(pipe, redis_task_id, history_facets(data))
+                self._push_to_queue(pipe, redis_task_id, partition)
+                num_items: int = (await pipe.execute())[-1]
 
             # collect cids for each answer and log successful upload to DB
             ids: list[str] = [response["cid"] for response in data["responses"]]
             logger.success(f"Pushed Task {ids} to DB")
             return num_items
         except Exception as exc:
+            if self._spill is not None and _is_out_of_memory(exc):
+                logger.warning(f"Redis is out of memory, spilling {redis_task_id}")
+                return await self._spill_entry(redis_task_id, str_data, partition, data)
             logger.opt(exception=True).error(
                 f"Error enqueuing data into key: {hist_key}, error: {exc}"
             )
             raise
 
-    async def dequeue(self) -> str | None:
-        """Dequeue an item from the specified queue key, assumes it is a queue and
-        returns the value as as a string
+    async def _queued_bytes(self) -> int:
+        value = await self.redis.get(self._build_key(self._queued_bytes_key))
+        return max(int(value or 0), 0)
+
+    async def _has_room(self, num_bytes: int) -> bool:
+        queued_bytes = await self._queued_bytes()
+        # a QA pair larger than the budget still fits in an empty queue
+        return (
+            queued_bytes == 0 or queued_bytes + num_bytes <= self._memory_budget_bytes
+        )
+
+    async def _spill_entry(
+        self, redis_task_id: str, str_data: bytes, partition: str | None, data: Any
+    ) -> int:
+        """Append a QA pair to the spill segments, it is moved into redis once there is room.
+
+        Returns:
+            int: Number of elements in the queue of the partition, including spilled ones.
         """
-        current_key: str = self._build_key(self._queue_key)
-        try:
-            value_raw = await cast(
-                Awaitable[str | bytes | list[Any] | None],
-                self.redis.lpop(current_key),  # pyright: ignore[reportUnknownMemberType]
+        assert self._spill is not None
+        self._spill.append(
+            SpillRecord(
+                id=redis_task_id,
+                partition=partition,
+                facets=history_facets(data),
+                value=str_data,
             )
+        )
+        ids: list[str] = [response["cid"] for response in data["responses"]]
+        logger.success(
+            f"Spilled Task {ids} to {self._spill.directory}, "
+            f"{self._spill.num_records} QA pairs spilled"
+        )
+        # the QA pair is safe on disk, it is counted in the queue lengths and added to the
+        # history index here, and indexed again once it is moved into redis
+        queue_key = self._partition_queue_key(partition)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.set(self._build_key(self._last_enqueue_key), time.time())
+                if partition is not None:
+                    pipe.sadd(self._build_key(self._partitions_key), partition)
+                pipe.hincrby(self._build_key(self._spilled_key), queue_key, 1)
+                pipe.sadd(self._build_key(self._spilled_ids_key), redis_task_id)
+                self._index_history(pipe, redis_task_id, history_facets(data))
+                await pipe.execute()
+            return (await self._queue_lengths([queue_key]))[0]
+        except Exception as exc:
+            logger.warning(f"Error counting spilled QA pair {redis_task_id}: {exc}")
+            return 0
+
+    async def refill_spilled(self):
+        """Move spilled QA pairs back into redis while there is room, oldest first.
+
+        The oldest QA pair of a partition whose queue in redis is empty is moved even if
+        there is no room, so that QA pairs of other partitions filling the budget cannot
+        hold back the consumers of that partition.
+        """
+        if self._spill is None or not self._spill.num_records:
+            return
+        if self._refill_lock.locked() or time.monotonic() < self._refill_after:
+            return
+        async with self._refill_lock:
+            try:
+                partitions = self._spill.partitions()
+                lengths = await self._redis_queue_lengths(
+                    [self._partition_queue_key(partition) for partition in partitions]
+                )
+                room = self._memory_budget_bytes - await self._queued_bytes()
+                heads: list[tuple[SpillRecord, SpillPosition]] = []
+                candidates: list[list[tuple[SpillRecord, SpillPosition]]] = []
+                for partition, length in zip(partitions, lengths, strict=True):
+                    records = self._spill.read(
+                        partition,
+                        self._refill_batch_size,
+                        max(room, 0),
+                        allow_oversized=length == 0,
+                    )
+                    if length == 0 and records:
+                        heads.append(records.pop(0))
+                    candidates.append(records)
+                room -= sum(len(record.value) for record, _ in heads)
+                # then the oldest QA pairs of every partition, a prefix of the merged
+                # records is a prefix of the records of each partition
+                selected = heads
+                for record, position in heapq.merge(
+                    *candidates, key=lambda candidate: candidate[0].id
+                ):
+                    if len(selected) >= self._refill_batch_size:
+                        break
+                    if len(record.value) > room:
+                        break
+                    room -= len(record.value)
+                    selected.append((record, position))
+                if not selected:
+                    # wait for consumers to make room
+                    self._refill_after = time.monotonic() + self._refill_retry_sec
+                    return
+                await self._move_into_redis(selected)
+            except Exception as exc:
+                # the QA pairs stay spilled, and are moved once redis has room again
+                self._refill_after = time.monotonic() + self._refill_retry_sec
+                logger.warning(f"Error moving spilled QA pairs into redis: {exc}")
+
+    async def _refill_queues(self, keys: list[str], count: int) -> bool:
+        """Move up to `count` spilled QA pairs of the queues `keys` into redis, oldest first,
+        whether or not there is room. Called by dequeues that found these queues empty in
+        redis, so that consumers do not wait for room while QA pairs are spilled.
+
+        Returns:
+            bool: Whether any QA pair was moved.
+        """
+        if self._spill is None or not self._spill.num_records:
+            return False
+        async with self._refill_lock:
+            try:
+                candidates = [
+                    self._spill.read(partition, count)
+                    for partition in self._spill.partitions()
+                    if self._partition_queue_key(partition) in keys
+                ]
+                selected = list(
+                    heapq.merge(*candidates, key=lambda candidate: candidate[0].id)
+                )[:count]
+                if not selected:
+                    return False
+                await self._move_into_redis(selected)
+                return True
+            except Exception as exc:
+                logger.warning(f"Error moving spilled QA pairs into redis: {exc}")
+                return False
+
+    async def _move_into_redis(self, selected: list[tuple[SpillRecord, SpillPosition]]):
+        """Queue spilled QA pairs in redis, then remove them from the spill segments."""
+        assert self._spill is not None
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for record, _ in selected:
+                queue_key = self._partition_queue_key(record.partition)
+                pipe.set(
+                    self._build_key(self._hist_key_prefix, record.id), record.value
+                )
+                if record.partition is not None:
+                    pipe.sadd(self._build_key(self._partitions_key), record.partition)
+                pipe.hincrby(self._build_key(self._spilled_key), queue_key, -1)
+                pipe.srem(self._build_key(self._spilled_ids_key), record.id)
+                pipe.incrby(self._build_key(self._queued_bytes_key), len(record.value))
+                self._index_history(pipe, record.id, record.facets)
+                self._push_to_queue(pipe, record.id, record.partition)
+            await pipe.execute()
+        # the position after the last record moved of each partition
+        positions = {position.partition: position for _, position in selected}
+        for position in positions.values():
+            self._spill.commit(position)
+        logger.info(
+            f"Moved {len(selected)} spilled QA pairs into redis, "
+            f"{self._spill.num_records} left"
+        )
+
+    def _index_history(
+        self, pipe: Pipeline, redis_task_id: str, facets: dict[str, list[str]]
+    ):
+        """Add the commands that add a history entry to the history index to `pipe`."""
+        score = {redis_task_id: uuid7_ms(redis_task_id)}
+        pipe.zadd(self._build_key(self._history_index_key), score)
+        for facet, values in facets.items():
+            pipe.sadd(self._build_key(self._history_facets_key, facet), *values)
+            for value in values:
+                pipe.zadd(self._history_facet_key(facet, value), score)
+
+    def _push_to_queue(self, pipe: Pipeline, redis_task_id: str, partition: str | None):
+        """Add the commands that push an id into the queue of `partition` to `pipe`, the
+        last command must return the number of elements in the queue.
+        """
+        pipe.rpush(self._partition_queue_key(partition), redis_task_id)
+
+    async def dequeue_many(
+        self,
+        count: int,
+        block_sec: float = 0,
+        topic: str | None = None,
+        augment_type: str | None = None,
+    ) -> list[QueueItem]:
+        """Dequeue up to `count` ids from the queues and fetch their history entries.
+
+        The ids at the heads of the queues are read first, then a lua script pops those
+        still at the heads and fetches their history entries atomically, so that every key
+        it touches is passed in KEYS. Heads taken by another consumer in the meantime are
+        read again.
+
+        Values are returned as stored by `enqueue`, so they can be passed through to a
+        response without being decompressed or parsed, decode them with `get_codec().decode`.
+        Call `ack` once the items have been delivered.
+
+        Args:
+            count (int): Maximum number of items to dequeue.
+            block_sec (float): Maximum time to wait for an item if the queues are empty.
+            topic (str | None): Only dequeue QA pairs of this topic.
+            augment_type (str | None): Only dequeue QA pairs of this augment type.
+
+        Returns:
+            list[QueueItem]: Dequeued items, oldest first, empty if the queues are empty.
+        """
+        await self.refill_spilled()
+        keys = await self._queue_keys(topic, augment_type)
+        if not keys:
+            return []
+        try:
+            items = await self._pop_items(keys, count)
+            # the queues are empty in redis, but QA pairs may still be spilled
+            if not items and await self._refill_queues(keys, count):
+                items = await self._pop_items(keys, count)
+            if items or block_sec <= 0:
+                return items
 
-            value: str | None = None
-            if isinstance(value_raw, list):
-                raise NotImplementedError("not implemented")
-            elif isinstance(value_raw, bytes):
-                value = value_raw.decode(self._encoding)
-            return value
+            # wait for an item to be pushed into any of the queues, then take what else
+            # is available without waiting
+            popped = await cast(
+                Awaitable[tuple[bytes, bytes] | None],
+                self.redis.blpop(keys, timeout=block_sec),
+            )
+            if popped is None:
+                return []
+            queue_key, element = popped[0].decode(self._encoding), popped[1]
+            if not _is_id(element):
+                items.append(await self._migrate_legacy_item(queue_key, element))
+            else:
+                id = element.decode(self._encoding)
+                (value,) = await self._fetch_script(
+                    keys=[
+                        self._build_key(self._queued_bytes_key),
+                        self._build_key(self._hist_key_prefix, id),
+                    ],
+                    args=[self.history_ttl_ms],
+                    client=self.redis,
+                )
+                if value is not None:
+                    items.append(QueueItem(id=id, value=value, queue_key=queue_key))
+            if len(items) < count:
+                items += await self._pop_items(keys, count - len(items))
+            return items
         except Exception as exc:
             logger.opt(exception=True).error(
-                f"Error dequeuing data from key: {current_key}, error: {exc}"
+                f"Error dequeuing {count} items from keys: {keys}, error: {exc}"
             )
             raise
+
+    async def _pop_items(self, keys: list[str], count: int) -> list[QueueItem]:
+        items: list[QueueItem] = []
+        while len(items) < count:
+            heads = await self._read_heads(keys, count - len(items))
+            if not heads:
+                break
+            ids = [element.decode(self._encoding) for _, element in heads if element]
+            results = await self._dequeue_script(
+                keys=[
+                    self._build_key(self._queued_bytes_key),
+                    *keys,
+                    *[self._build_key(self._hist_key_prefix, id) for id in ids],
+                ],
+                args=[
+                    self.history_ttl_ms,
+                    len(keys),
+                    *[part for head in heads for part in head],
+                ],
+                client=self.redis,
+            )
+            for i in range(0, len(results), 3):
+                queue_key = keys[results[i]]
+                if not results[i + 1]:
+                    items.append(
+                        await self._migrate_legacy_item(queue_key, results[i + 2])
+                    )
+                    continue
+                items.append(
+                    QueueItem(
+                        id=results[i + 1].decode(self._encoding),
+                        value=results[i + 2],
+                        queue_key=queue_key,
+                    )
+                )
+        return items
+
+    async def _read_heads(self, keys: list[str], count: int) -> list[tuple[int, bytes]]:
+        """Up to `count` ids at the heads of the queues `keys`, oldest first across queues as
+        uuid7 ids sort by time, with the index of their queue. Whole QA pairs queued by older
+        versions come first, with an empty id.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.lrange(key, 0, count - 1)
+            queues = await pipe.execute()
+        heads = heapq.merge(
+            *[
+                [(element if _is_id(element) else b"", index) for element in elements]
+                for index, elements in enumerate(queues)
+            ]
+        )
+        return [(index, element) for element, index in itertools.islice(heads, count)]
+
+    async def _migrate_legacy_item(self, queue_key: str, value: bytes) -> QueueItem:
+        """Store a whole QA pair queued by versions before queues held ids as a history
+        entry, so that it can be requeued and acknowledged like the other items.
+        """
+        id = str(uuid_utils.uuid7())
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(
+                self._build_key(self._hist_key_prefix, id),
+                value,
+                px=self.history_ttl_ms or None,
+            )
+            self._index_history(
+                pipe, id, history_facets(loads(get_codec().decode(value)))
+            )
+            await pipe.execute()
+        logger.warning(
+            f"Dequeued a QA pair queued whole by an older version from {queue_key}, "
+            f"stored it as history entry {id}"
+        )
+        return QueueItem(id=id, value=value, queue_key=queue_key)
+
+    async def requeue(self, items: list[QueueItem]) -> int:
+        if not items:
+            return 0
+        return await self._requeue_script(
+            keys=[
+                self._build_key(self._queued_bytes_key),
+                *[
+                    key
+                    for item in items
+                    for key in (
+                        item.queue_key,
+                        self._build_key(self._hist_key_prefix, item.id),
+                    )
+                ],
+            ],
+            args=[item.id for item in items],
+            client=self.redis,
+        )
+
+    async def get_value(self, key: str) -> bytes | None:
+        return await self.redis.get(key)
+
+    async def set_value(self, key: str, value: str | int, nx: bool = False) -> bool:
+        return bool(await self.redis.set(key, value, nx=nx))
+
+    async def incr(self, key: str) -> int:
+        return await self.redis.incr(key)
+
+    async def _facet_values(self) -> dict[str, list[str]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for facet in HISTORY_FACETS:
+                pipe.smembers(self._build_key(self._history_facets_key, facet))
+            results = await pipe.execute()
+        return {
+            facet: sorted(value.decode(self._encoding) for value in values)
+            for facet, values in zip(HISTORY_FACETS, results, strict=True)
+        }
+
+    async def get_history_facets(self) -> dict[str, dict[str, int]]:
+        facet_values = await self._facet_values()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for facet, values in facet_values.items():
+                for value in values:
+                    pipe.zcard(self._history_facet_key(facet, value))
+            counts = iter(await pipe.execute())
+        return {
+            facet: {value: next(counts) for value in values}
+            for facet, values in facet_values.items()
+        }
+
+    async def _spilled_values(self, ids: list[str]) -> dict[str, bytes | None]:
+        """Spilled QA pairs among `ids`, with their payloads if this process spilled them."""
+        if not ids or self._spill is None:
+            return {}
+        flags = await self.redis.smismember(self._build_key(self._spilled_ids_key), ids)
+        return {
+            id: self._spill.get(id) for id, flag in zip(ids, flags, strict=True) if flag
+        }
+
+    async def _prune_history_index(self, ids: list[str]):
+        """Remove entries whose history has expired from the index and its facets."""
+        keys = [self._build_key(self._history_index_key)] + [
+            self._history_facet_key(facet, value)
+            for facet, values in (await self._facet_values()).items()
+            for value in values
+        ]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zrem(key, *ids)
+            await pipe.execute()
+
+    async def trim_history_index(self) -> int:
+        if self.history_ttl_ms <= 0:
+            return 0
+        facet_values = [
+            (facet, value)
+            for facet, values in (await self._facet_values()).items()
+            for value in values
+        ]
+        return await self._trim_history_script(
+            keys=[
+                self._build_key(self._history_index_key),
+                *[
+                    key
+                    for facet, value in facet_values
+                    for key in (
+                        self._build_key(self._history_facets_key, facet),
+                        self._history_facet_key(facet, value),
+                    )
+                ],
+            ],
+            args=[
+                int(time.time() * 1000) - self.history_ttl_ms,
+                *[value for _, value in facet_values],
+            ],
+            client=self.redis,
+        )
+
+    async def query_history(
+        self,
+        limit: int = 50,
+        cursor: str | None = None,
+        topic: str | None = None,
+        model: str | None = None,
+        strategy: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        with_values: bool = False,
+    ) -> tuple[list[HistoryEntry], str | None]:
+        filters = zip(HISTORY_FACETS, (topic, model, strategy), strict=True)
+        keys = [
+            self._history_facet_key(facet, value)
+            for facet, value in filters
+            if value is not None
+        ] or [self._build_key(self._history_index_key)]
+        if len(keys) > 1:
+            # walk the smallest index, and look up the entries in the others
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.zcard(key)
+                sizes = await pipe.execute()
+            keys = [key for _, key in sorted(zip(sizes, keys, strict=True))]
+        index_key, other_keys = keys[0], keys[1:]
+
+        # scores are the ms timestamps of the uuid7 ids, and entries with the same score are
+        # ordered by id, so the position in the index is the last id seen
+        max_ms = None if until is None else int(until * 1000)
+        min_score: int | str = "-inf" if since is None else int(since * 1000)
+        last_id = cursor
+        entries: list[HistoryEntry] = []
+        num_scanned = 0
+        while len(entries) < limit and num_scanned < self._history_max_scan:
+            if last_id is not None:
+                max_ms = (
+                    uuid7_ms(last_id)
+                    if max_ms is None
+                    else min(max_ms, uuid7_ms(last_id))
+                )
+            # entries with the same score as the last id were partly seen already
+            num_seen = 0
+            if last_id is not None and max_ms == uuid7_ms(last_id):
+                num_seen = await self.redis.zcount(index_key, max_ms, max_ms)
+            batch_size = max(limit - len(entries), 100 if other_keys else 1)
+            rows = await self.redis.zrevrangebyscore(
+                index_key,
+                "+inf" if max_ms is None else max_ms,
+                min_score,
+                start=0,
+                num=batch_size + num_seen,
+            )
+            exhausted = len(rows) < batch_size + num_seen
+            ids = [row.decode(self._encoding) for row in rows]
+            if last_id is not None:
+                ids = [id for id in ids if id < last_id]
+            num_scanned += len(ids)
+            if not ids:
+                last_id = None if exhausted else last_id
+                break
+
+            candidates = ids
+            if other_keys:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for id in ids:
+                        for key in other_keys:
+                            pipe.zscore(key, id)
+                    scores = await pipe.execute()
+                candidates = [
+                    id
+                    for i, id in enumerate(ids)
+                    if all(
+                        score is not None
+                        for score in scores[
+                            i * len(other_keys) : (i + 1) * len(other_keys)
+                        ]
+                    )
+                ]
+            # stop at the entry that fills the page, the next page starts after it
+            num_needed = limit - len(entries)
+            if len(candidates) > num_needed:
+                candidates = candidates[:num_needed]
+                last_id, exhausted = candidates[-1], False
+            else:
+                last_id = ids[-1]
+
+            hist_keys = [
+                self._build_key(self._hist_key_prefix, id) for id in candidates
+            ]
+            if with_values:
+                values = await self.redis.mget(hist_keys) if hist_keys else []
+            else:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for hist_key in hist_keys:
+                        pipe.exists(hist_key)
+                    values = [
+                        None if not found else b"" for found in await pipe.execute()
+                    ]
+            missing = [
+                id
+                for id, value in zip(candidates, values, strict=True)
+                if value is None
+            ]
+            # spilled QA pairs are indexed before they are back in redis
+            spilled = await self._spilled_values(missing)
+            values = [
+                value if id not in spilled else (spilled[id] if with_values else b"")
+                for id, value in zip(candidates, values, strict=True)
+            ]
+            missing = [id for id in missing if id not in spilled]
+            if missing:
+                await self._prune_history_index(missing)
+            entries += [
+                HistoryEntry(
+                    id=id,
+                    created_at=uuid7_ms(id) / 1000,
+                    value=value if with_values else None,
+                )
+                for id, value in zip(candidates, values, strict=True)
+                if value is not None
+            ]
+            if exhausted:
+                last_id = None
+                break
+        return entries, last_id
+
+
+def _is_id(element: bytes) -> bool:
+    """Whether a queue element is the uuid7 id of a history entry, rather than a whole QA
+    pair queued by versions before queues held ids.
+    """
+    return _ID_PATTERN.fullmatch(element) is not None
+
+
+def _is_out_of_memory(exc: Exception) -> bool:
+    """Whether redis refused a write because it reached `maxmemory`."""
+    return isinstance(exc, ResponseError) and str(exc).startswith("OOM")
@@ -0,0 +1,279 @@
+"""
+redis_stream.py
+
+Queue backend on redis streams with a consumer group, selected with `REDIS_QUEUE_BACKEND=stream`.
+
+With the list backend, a QA pair is lost if the process crashes between popping it and the
+response reaching the validator. With streams:
+- `enqueue` XADDs the id of the history entry to the stream of its partition
+- `dequeue_many` XREADGROUPs new entries from the streams of the matching partitions, blocking
+  up to `block_sec`, which stay pending until `ack` is called once the response has been written
+- deliveries that are not acknowledged within `stream_claim_idle_ms`, e.g. because the
+  process crashed, are claimed with XAUTOCLAIM and delivered again by the next dequeue
+- pending deliveries can be inspected with `XPENDING synthetic:stream:<partition> synthetic-gen`
+
+Acknowledged entries are deleted from the stream, so its length is the number of queued and
+in flight items. History entries start to expire once acknowledged.
+"""
+
+import os
+import socket
+import time
+from collections import defaultdict
+
+from loguru import logger
+from redis.asyncio.client import Pipeline
+from redis.exceptions import ResponseError
+
+from commons.cache.base import QueueItem
+from commons.cache.redis import RedisCache
+from commons.config import get_settings
+
+
+class RedisStreamCache(RedisCache):
+    # one stream per partition, "stream:<topic>:<augment_type>"
+    _stream_key: str = "stream"
+    _group_name: str = "synthetic-gen"
+    # field of stream entries holding the id of the history entry
+    _id_field: bytes = b"id"
+    # streams whose consumer group has been created
+    _groups_created: set[str] = set()
+    # stalled deliveries are only looked for this often, to save a round trip per dequeue
+    _claim_interval_sec: float = 1.0
+    _last_claim_at: float = 0.0
+    # stream to start reading from on the next dequeue
+    _next_stream: int = 0
+
+    @property
+    def _consumer_name(self) -> str:
+        return f"{socket.gethostname()}-{os.getpid()}"
+
+    def _partition_queue_key(self, partition: str | None) -> str:
+        if partition is None:
+            return self._build_key(self._stream_key)
+        return self._build_key(self._stream_key, partition)
+
+    async def _ensure_groups(self, stream_keys: list[str]):
+        for stream_key in stream_keys:
+            if stream_key in self._groups_created:
+                continue
+            try:
+                # start from the beginning, so entries added before the group are delivered
+                await self.redis.xgroup_create(
+                    stream_key, self._group_name, id="0", mkstream=True
+                )
+            except ResponseError as exc:
+                if "BUSYGROUP" not in str(exc):
+                    raise
+            self._groups_created.add(stream_key)
+
+    async def clear(self):
+        await super().clear()
+        # the consumer groups were deleted with the streams
+        self._groups_created.clear()
+
+    def _push_to_queue(self, pipe: Pipeline, redis_task_id: str, partition: str | None):
+        stream_key = self._partition_queue_key(partition)
+        pipe.xadd(stream_key, {self._id_field: redis_task_id})
+        pipe.xlen(stream_key)
+
+    async def _redis_queue_lengths(self, keys: list[str]) -> list[int]:
+        """Number of entries waiting to be delivered, excluding in flight deliveries."""
+        await self._ensure_groups(keys)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.xlen(key)
+                pipe.xpending(key, self._group_name)
+            results = await pipe.execute()
+        return [
+            max(length - pending["pending"], 0)
+            for length, pending in zip(results[::2], results[1::2], strict=True)
+        ]
+
+    async def get_num_in_flight(self) -> int | None:
+        keys = await self._queue_keys()
+        await self._ensure_groups(keys)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.xpending(key, self._group_name)
+            return sum(pending["pending"] for pending in await pipe.execute())
+
+    async def _claim_stalled(
+        self, stream_keys: list[str], count: int
+    ) -> list[tuple[str, bytes, dict]]:
+        """Claim up to `count` deliveries that were not acknowledged in time."""
+        if time.monotonic() - self._last_claim_at < self._claim_interval_sec:
+            return []
+        self._last_claim_at = time.monotonic()
+        claimed: list[tuple[str, bytes, dict]] = []
+        for stream_key in stream_keys:
+            if len(claimed) >= count:
+                break
+            _, messages, *_ = await self.redis.xautoclaim(
+                stream_key,
+                self._group_name,
+                self._consumer_name,
+                min_idle_time=get_settings().redis.stream_claim_idle_ms,
+                count=count - len(claimed),
+            )
+            # entries deleted while pending are returned without fields by redis < 7
+            claimed += [
+                (stream_key, message_id, fields)
+                for message_id, fields in messages
+                if fields
+            ]
+        if claimed:
+            logger.warning(f"Claimed {len(claimed)} stalled deliveries for redelivery")
+        return claimed
+
+    async def dequeue_many(
+        self,
+        count: int,
+        block_sec: float = 0,
+        topic: str | None = None,
+        augment_type: str | None = None,
+    ) -> list[QueueItem]:
+        """Deliver up to `count` items, stalled deliveries first, then new entries.
+
+        Items stay pending until `ack` is called, and are delivered again if they are not
+        acknowledged within `stream_claim_idle_ms`.
+        """
+        await self.refill_spilled()
+        stream_keys = await self._queue_keys(topic, augment_type)
+        if not stream_keys:
+            return []
+        await self._ensure_groups(stream_keys)
+        try:
+            messages = await self._claim_stalled(stream_keys, count)
+            messages += await self._read_streams(stream_keys, count - len(messages))
+            # the streams are empty in redis, but QA pairs may still be spilled
+            if not messages and await self._refill_queues(stream_keys, count):
+                messages = await self._read_streams(stream_keys, count)
+            if not messages and block_sec > 0:
+                # wait for an entry in any of the streams, returns at most one per stream
+                messages = await self._read_group(
+                    {stream_key: ">" for stream_key in stream_keys},
+                    1,
+                    block_ms=int(block_sec * 1000),
+                )
+                messages, extra = messages[:count], messages[count:]
+                if extra:
+                    await self.requeue(
+                        [self._to_item(message, b"") for message in extra]
+                    )
+            if not messages:
+                return []
+
+            values = await self.redis.mget(
+                [
+                    self._build_key(
+                        self._hist_key_prefix,
+                        fields[self._id_field].decode(self._encoding),
+                    )
+                    for _, _, fields in messages
+                ]
+            )
+        except Exception as exc:
+            logger.opt(exception=True).error(
+                f"Error dequeuing {count} items from streams: {stream_keys}, error: {exc}"
+            )
+            raise
+
+        items: list[QueueItem] = []
+        missing: list[QueueItem] = []
+        for message, value in zip(messages, values, strict=True):
+            item = self._to_item(message, value)
+            (items if value is not None else missing).append(item)
+        if missing:
+            logger.warning(
+                f"Dropping {len(missing)} stream entries without a history entry"
+            )
+            await self.ack(missing)
+        return items
+
+    async def _read_streams(
+        self, stream_keys: list[str], count: int
+    ) -> list[tuple[str, bytes, dict]]:
+        """Read up to `count` new entries, from the streams one by one as XREADGROUP returns
+        up to `count` entries from each stream, starting from a different stream each time
+        to be fair.
+        """
+        messages: list[tuple[str, bytes, dict]] = []
+        self._next_stream += 1
+        offset = self._next_stream % len(stream_keys)
+        for stream_key in stream_keys[offset:] + stream_keys[:offset]:
+            if len(messages) >= count:
+                break
+            messages += await self._read_group({stream_key: ">"}, count - len(messages))
+        return messages
+
+    async def _read_group(
+        self, streams: dict[str, str], count: int, block_ms: int = 0
+    ) -> list[tuple[str, bytes, dict]]:
+        response = await self.redis.xreadgroup(
+            self._group_name,
+            self._consumer_name,
+            streams,  # type: ignore
+            count=count,
+            # 0 would block forever
+            block=block_ms or None,
+        )
+        return [
+            (stream_key.decode(self._encoding), message_id, fields)
+            for stream_key, stream_messages in response or []
+            for message_id, fields in stream_messages
+        ]
+
+    def _to_item(self, message: tuple[str, bytes, dict], value: bytes) -> QueueItem:
+        stream_key, message_id, fields = message
+        return QueueItem(
+            id=fields[self._id_field].decode(self._encoding),
+            value=value,
+            queue_key=stream_key,
+            message_id=message_id.decode(self._encoding),
+        )
+
+    @staticmethod
+    def _by_stream(items: list[QueueItem]) -> dict[str, list[QueueItem]]:
+        by_stream: dict[str, list[QueueItem]] = defaultdict(list)
+        for item in items:
+            by_stream[item.queue_key].append(item)
+        return by_stream
+
+    async def ack(self, items: list[QueueItem]):
+        """Acknowledge and delete delivered entries, and start to expire their history."""
+        if not items:
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for stream_key, stream_items in self._by_stream(items).items():
+                message_ids = [item.message_id for item in stream_items]
+                pipe.xack(stream_key, self._group_name, *message_ids)
+                pipe.xdel(stream_key, *message_ids)
+            # entries count as queued until acknowledged, as they are redelivered until then
+            pipe.decrby(
+                self._build_key(self._queued_bytes_key),
+                sum(len(item.value or b"") for item in items),
+            )
+            if self.history_ttl_ms > 0:
+                for item in items:
+                    pipe.pexpire(
+                        self._build_key(self._hist_key_prefix, item.id),
+                        self.history_ttl_ms,
+                    )
+            await pipe.execute()
+
+    async def requeue(self, items: list[QueueItem]) -> int:
+        """Make dequeued items available again. Streams are append only, so they are
+        added again at the end of their stream, instead of at the front like the list backend.
+        """
+        if not items:
+            return 0
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for stream_key, stream_items in self._by_stream(items).items():
+                message_ids = [item.message_id for item in stream_items]
+                for item in stream_items:
+                    pipe.xadd(stream_key, {self._id_field: item.id})
+                pipe.xack(stream_key, self._group_name, *message_ids)
+                pipe.xdel(stream_key, *message_ids)
+            await pipe.execute()
+        return len(items)
@@ -0,0 +1,356 @@
+"""
+spill.py
+
+Overflow tier of the redis queue, enabled with `REDIS_MEMORY_BUDGET_BYTES`.
+
+A finished QA pair takes minutes to generate, so when the payloads queued in redis would exceed
+the budget, or an enqueue is refused because redis is out of memory, `RedisCache` appends the QA
+pair to a local segment file instead of losing it, and moves spilled QA pairs back into redis as
+consumers drain the queue:
+- segments are append-only files of records `crc32, meta length, value length, meta, value`,
+  where meta is the JSON of the id, partition and history facets, and value is the payload as
+  stored in redis
+- segments are read through mmap, and the offset of the next record to move back into redis is
+  kept in a `.offset` file next to the segment, so a restart resumes where it stopped
+- each segment holds the QA pairs of one partition, and the segments of each partition are read
+  in order, so QA pairs of one partition never wait behind those of another
+- each process writes to its own directory under `REDIS_SPILL_DIR`, locked while it runs, and
+  adopts the segments of directories whose process has exited
+
+Records are written to the page cache without fsync, so they survive the process but not the
+host crashing. A crash between moving records into redis and saving the offset delivers those
+records twice.
+"""
+
+import fcntl
+import mmap
+import os
+import socket
+import struct
+import sys
+import zlib
+from collections import Counter, deque
+from collections.abc import Iterator
+from typing import NamedTuple
+
+from loguru import logger
+
+from commons.utils.serialization import dumps, loads
+
+# crc32 of meta and value, length of meta, length of value
+_HEADER = struct.Struct("<III")
+_OFFSET = struct.Struct("<Q")
+_SEGMENT_SUFFIX = ".seg"
+
+
+class SpillRecord(NamedTuple):
+    id: str
+    partition: str | None
+    facets: dict[str, list[str]]
+    value: bytes
+
+
+class SpillPosition(NamedTuple):
+    """Position after a record read, pass it to `SpillStore.commit`."""
+
+    partition: str | None
+    segment: str
+    offset: int
+    # records of the partition read up to this position
+    num_records: int
+
+
+def encode_record(record: SpillRecord) -> bytes:
+    meta = dumps(
+        {"id": record.id, "partition": record.partition, "facets": record.facets}
+    )
+    crc = zlib.crc32(record.value, zlib.crc32(meta))
+    return _HEADER.pack(crc, len(meta), len(record.value)) + meta + record.value
+
+
+class _Segment:
+    def __init__(self, path: str, sealed: bool = False):
+        self.path = path
+        # no longer appended to
+        self.sealed = sealed
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._offset_fd = os.open(path + ".offset", os.O_RDWR | os.O_CREAT, 0o644)
+        data = os.pread(self._offset_fd, _OFFSET.size, 0)
+        self.read_offset: int = (
+            _OFFSET.unpack(data)[0] if len(data) == _OFFSET.size else 0
+        )
+        self.size = os.fstat(self._fd).st_size
+        self._mmap: mmap.mmap | None = None
+        # offsets and ids of the records that were not committed yet
+        self.ids: deque[tuple[int, str]] = deque()
+
+    def append(self, record: SpillRecord):
+        self.ids.append((self.size, record.id))
+        data = encode_record(record)
+        os.write(self._fd, data)
+        self.size += len(data)
+
+    def _view(self) -> mmap.mmap | None:
+        # the mapping is created again once the segment has grown past it
+        if self._mmap is None or len(self._mmap) < self.size:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = (
+                mmap.mmap(self._fd, self.size, access=mmap.ACCESS_READ)
+                if self.size
+                else None
+            )
+        return self._mmap
+
+    def read(self, offset: int) -> tuple[SpillRecord, int] | None:
+        """Record at `offset` and the offset after it, None at the end of the segment or at
+        a record that was only partly written.
+        """
+        view = self._view()
+        if view is None or offset + _HEADER.size > self.size:
+            return None
+        crc, meta_len, value_len = _HEADER.unpack_from(view, offset)
+        meta_start = offset + _HEADER.size
+        value_start = meta_start + meta_len
+        end = value_start + value_len
+        if end > self.size:
+            return None
+        meta, value = view[meta_start:value_start], view[value_start:end]
+        if zlib.crc32(value, zlib.crc32(meta)) != crc:
+            logger.warning(f"Corrupt record at offset {offset} of {self.path}")
+            return None
+        meta = loads(meta)
+        record = SpillRecord(
+            id=meta["id"],
+            partition=meta["partition"],
+            facets=meta["facets"],
+            value=value,
+        )
+        return record, end
+
+    def records(self) -> Iterator[tuple[int, SpillRecord]]:
+        """Offsets and records that were not committed yet, and that can be read."""
+        offset = self.read_offset
+        while (result := self.read(offset)) is not None:
+            yield offset, result[0]
+            offset = result[1]
+
+    def commit(self, offset: int):
+        self.read_offset = offset
+        os.pwrite(self._offset_fd, _OFFSET.pack(offset), 0)
+        while self.ids and self.ids[0][0] < offset:
+            self.ids.popleft()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        os.close(self._fd)
+        os.close(self._offset_fd)
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.path + ".offset"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SpillStore:
+    """FIFOs of spilled QA pairs by partition, in append-only segment files.
+
+    Args:
+        directory (str): Directory shared by the processes of a host.
+        segment_bytes (int): Size after which a new segment is started.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int):
+        self._root = directory
+        self._segment_bytes = segment_bytes
+        self.directory = os.path.join(
+            directory, f"{socket.gethostname()}-{os.getpid()}"
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        # held until the process exits, so that other processes do not adopt the segments
+        self._lock_file = open(os.path.join(self.directory, "lock"), "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segments: dict[str | None, deque[_Segment]] = {}
+        self._num_records: Counter[str | None] = Counter()
+        # segment and offset of each record that was not committed yet, by id
+        self._locations: dict[str, tuple[_Segment, int]] = {}
+        self._next_segment = 0
+        self._adopt_orphans()
+
+    @property
+    def num_records(self) -> int:
+        return sum(self._num_records.values())
+
+    def num_records_of(self, partition: str | None) -> int:
+        return self._num_records[partition]
+
+    def partitions(self) -> list[str | None]:
+        """Partitions with spilled records."""
+        return [partition for partition, n in self._num_records.items() if n > 0]
+
+    def _adopt_orphans(self):
+        """Take over the segments left by processes that exited, including a previous
+        process with the same hostname and pid, e.g. after a container restart.
+        """
+        self._adopt_directory(self.directory)
+        for name in sorted(os.listdir(self._root)):
+            directory = os.path.join(self._root, name)
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            try:
+                with open(os.path.join(directory, "lock"), "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # its process is still running
+                        continue
+                    self._adopt_directory(directory)
+                    for filename in os.listdir(directory):
+                        os.remove(os.path.join(directory, filename))
+                os.rmdir(directory)
+            except FileNotFoundError:
+                # adopted by another process in the meantime
+                continue
+
+    def _adopt_directory(self, directory: str):
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(_SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(directory, filename)
+            target = self._segment_path()
+            if os.path.exists(path + ".offset"):
+                os.rename(path + ".offset", target + ".offset")
+            os.rename(path, target)
+            # appends go to a new segment, after any record that was only partly written
+            segment = _Segment(target, sealed=True)
+            records = list(segment.records())
+            if not records:
+                segment.delete()
+                continue
+            partition = records[0][1].partition
+            for offset, record in records:
+                segment.ids.append((offset, record.id))
+                self._locations[record.id] = (segment, offset)
+            self._segments.setdefault(partition, deque()).append(segment)
+            self._num_records[partition] += len(records)
+            logger.info(f"Adopted {len(records)} spilled QA pairs from {path}")
+
+    def _segment_path(self) -> str:
+        self._next_segment += 1
+        return os.path.join(
+            self.directory, f"{self._next_segment:08d}{_SEGMENT_SUFFIX}"
+        )
+
+    def append(self, record: SpillRecord):
+        segments = self._segments.setdefault(record.partition, deque())
+        if (
+            not segments
+            or segments[-1].sealed
+            or segments[-1].size >= self._segment_bytes
+        ):
+            if segments:
+                segments[-1].sealed = True
+            segments.append(_Segment(self._segment_path()))
+        segment = segments[-1]
+        self._locations[record.id] = (segment, segment.size)
+        segment.append(record)
+        self._num_records[record.partition] += 1
+
+    def get(self, id: str) -> bytes | None:
+        """Payload of a record that was not committed yet, None if there is none."""
+        location = self._locations.get(id)
+        if location is None:
+            return None
+        result = location[0].read(location[1])
+        return None if result is None else result[0].value
+
+    def read(
+        self,
+        partition: str | None,
+        max_records: int,
+        max_bytes: int = sys.maxsize,
+        allow_oversized: bool = False,
+    ) -> list[tuple[SpillRecord, SpillPosition]]:
+        """Oldest records of a partition whose payloads add up to at most `max_bytes`, with
+        the position after each of them, without removing them.
+
+        Records are only read from one segment at a time, the next read continues with the
+        next segment once this one has been committed.
+
+        Args:
+            partition (str | None): Partition of the records.
+            max_records (int): Maximum number of records to read.
+            max_bytes (int): Maximum total size of their payloads.
+            allow_oversized (bool): Return the oldest record even if its payload alone is
+                larger than `max_bytes`, so that it cannot block the records behind it.
+        """
+        records: list[tuple[SpillRecord, SpillPosition]] = []
+        num_bytes = 0
+        for segment in self._segments.get(partition, ()):
+            offset = segment.read_offset
+            while len(records) < max_records:
+                result = segment.read(offset)
+                if result is None:
+                    break
+                record, offset = result
+                if num_bytes + len(record.value) > max_bytes and not (
+                    allow_oversized and not records
+                ):
+                    return records
+                num_bytes += len(record.value)
+                position = SpillPosition(
+                    partition, segment.path, offset, len(records) + 1
+                )
+                records.append((record, position))
+            if records:
+                return records
+            if segment.sealed and segment.read(offset) is None:
+                # the rest of a segment that is no longer written to cannot be read
+                continue
+            break
+        return records
+
+    def _delete(self, segment: _Segment):
+        for _, id in segment.ids:
+            self._locations.pop(id, None)
+        segment.delete()
+
+    def commit(self, position: SpillPosition):
+        """Remove the records of a partition up to `position` once they have been moved into
+        redis.
+        """
+        segments = self._segments.get(position.partition)
+        while segments and segments[0].path != position.segment:
+            # fully read, or only left with a record that was partly written
+            self._delete(segments.popleft())
+        if not segments:
+            return
+        segment = segments[0]
+        for offset, id in segment.ids:
+            if offset >= position.offset:
+                break
+            self._locations.pop(id, None)
+        segment.commit(position.offset)
+        self._num_records[position.partition] = max(
+            self._num_records[position.partition] - position.num_records, 0
+        )
+        # fully read, the next append starts a new segment
+        if position.offset >= segment.size or (
+            segment.sealed and segment.read(position.offset) is None
+        ):
+            self._delete(segments.popleft())
+        if not segments:
+            del self._segments[position.partition]
+
+    def clear(self):
+        for segments in self._segments.values():
+            while segments:
+                self._delete(segments.popleft())
+        self._segments.clear()
+        self._num_records.clear()
+        self._locations.clear()
@@ -0,0 +1,493 @@
+"""
+sqlite.py
+
+Cache backend on a SQLite database in WAL mode, selected with `CACHE_BACKEND=sqlite`.
+
+The database file at `CACHE_SQLITE_PATH` is shared by every process on the host, so uvicorn can
+run several workers without a redis server, and queued QA pairs survive restarts. Each process
+opens its own connection, and queries run in a thread so a write lock held by another process
+does not block the event loop.
+
+Tables mirror the redis keys, so keys built with `_build_key` mean the same in both:
+- `history`: payloads by key, with the unix time at which they expire once dequeued
+- `queue`: ids by queue key, popped in `seq` order, requeued ids get a lower `seq`
+- `zsets`: the history index and its facets, ordered by uuid7 id, i.e. by time
+- `sets`, `hashes` and `kv`: partitions, facet values, worker counters and other shared values
+
+SQLite cannot notify other processes of new rows, so a blocked dequeue polls every
+`sqlite_poll_interval_sec`.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any, TypeVar
+
+from loguru import logger
+
+from commons.cache.base import (
+    HISTORY_FACETS,
+    CacheBackend,
+    HistoryEntry,
+    QueueItem,
+    history_facets,
+    uuid7_ms,
+    uuid7_prefix,
+)
+from commons.config import get_settings
+
+T = TypeVar("T")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL);
+CREATE TABLE IF NOT EXISTS queue (seq INTEGER PRIMARY KEY, queue_key TEXT NOT NULL, id TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS queue_by_key ON queue (queue_key, seq);
+CREATE TABLE IF NOT EXISTS sets (key TEXT NOT NULL, member TEXT NOT NULL, PRIMARY KEY (key, member));
+CREATE TABLE IF NOT EXISTS hashes (
+    key TEXT NOT NULL, field TEXT NOT NULL, value INTEGER NOT NULL, PRIMARY KEY (key, field)
+);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS zsets (key TEXT NOT NULL, member TEXT NOT NULL, PRIMARY KEY (key, member));
+"""
+
+
+class SQLiteCache(CacheBackend):
+    _instance: "SQLiteCache | None" = None
+    path: str
+    # expired history entries are deleted this often, they are never returned once expired
+    _purge_interval_sec: float = 60.0
+
+    def __new__(cls) -> "SQLiteCache":
+        if SQLiteCache._instance is None:
+            instance = super().__new__(cls)
+            settings = get_settings().cache
+            instance.path = settings.sqlite_path
+            instance._poll_interval_sec = settings.sqlite_poll_interval_sec
+            instance._conn = None
+            instance._conn_pid = None
+            instance._lock = threading.Lock()
+            instance._last_purge_at = 0.0
+            SQLiteCache._instance = instance
+        return SQLiteCache._instance
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections must not be shared with forked processes
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path,
+                # wait for the write lock held by another process instead of failing
+                timeout=30,
+                # transactions are started explicitly with BEGIN IMMEDIATE
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            # durable across process crashes, a power loss may lose the last transactions
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn, self._conn_pid = conn, os.getpid()
+            logger.info(f"Opened sqlite cache at {self.path}")
+        return self._conn
+
+    async def _run(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        def locked() -> T:
+            with self._lock:
+                return fn(self._connect())
+
+        return await asyncio.to_thread(locked)
+
+    @staticmethod
+    @contextmanager
+    def _transaction(conn: sqlite3.Connection) -> Iterator[None]:
+        # take the write lock up front, so concurrent read-modify-writes cannot interleave
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    async def close(self) -> None:
+        await super().close()
+        with self._lock:
+            if self._conn is not None and self._conn_pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    async def clear(self):
+        pattern = f"{self._key_prefix}:%"
+
+        def clear(conn: sqlite3.Connection):
+            with self._transaction(conn):
+                conn.execute("DELETE FROM history WHERE key LIKE ?", (pattern,))
+                conn.execute("DELETE FROM queue WHERE queue_key LIKE ?", (pattern,))
+                for table in ("sets", "hashes", "kv", "zsets"):
+                    conn.execute(f"DELETE FROM {table} WHERE key LIKE ?", (pattern,))
+
+        await self._run(clear)
+
+    async def ping(self) -> float:
+        start_time = time.perf_counter()
+        await self._run(lambda conn: conn.execute("SELECT 1").fetchone())
+        return time.perf_counter() - start_time
+
+    async def _partition_names(self) -> set[str]:
+        key = self._build_key(self._partitions_key)
+        rows = await self._run(
+            lambda conn: conn.execute(
+                "SELECT member FROM sets WHERE key = ?", (key,)
+            ).fetchall()
+        )
+        return {member for (member,) in rows}
+
+    async def _queue_lengths(self, keys: list[str]) -> list[int]:
+        def lengths(conn: sqlite3.Connection) -> list[int]:
+            return [
+                conn.execute(
+                    "SELECT COUNT(*) FROM queue WHERE queue_key = ?", (key,)
+                ).fetchone()[0]
+                for key in keys
+            ]
+
+        return await self._run(lengths)
+
+    async def get_last_enqueue_time(self) -> float | None:
+        value = await self.get_value(self._build_key(self._last_enqueue_key))
+        return None if value is None else float(value)
+
+    async def get_num_workers_active(self) -> int:
+        value = await self.get_value(self._build_key(self._num_workers_active_key))
+        return 0 if value is None else int(value)
+
+    async def get_num_workers_active_by_partition(self) -> dict[str, int]:
+        key = self._build_key(self._num_workers_active_by_partition_key)
+        rows = await self._run(
+            lambda conn: conn.execute(
+                "SELECT field, value FROM hashes WHERE key = ?", (key,)
+            ).fetchall()
+        )
+        return {partition: max(value, 0) for partition, value in rows}
+
+    async def reset_num_workers_active_by_partition(self):
+        key = self._build_key(self._num_workers_active_by_partition_key)
+        await self._run(
+            lambda conn: conn.execute("DELETE FROM hashes WHERE key = ?", (key,))
+        )
+
+    async def update_num_workers_active(
+        self, delta: int, partition: str | None = None
+    ) -> int:
+        key = self._build_key(self._num_workers_active_key)
+        hash_key = self._build_key(self._num_workers_active_by_partition_key)
+
+        def update(conn: sqlite3.Connection) -> int:
+            with self._transaction(conn):
+                row = conn.execute(
+                    "SELECT value FROM kv WHERE key = ?", (key,)
+                ).fetchone()
+                # ensure it doesn't go below 0
+                num_active = max((int(row[0]) if row else 0) + delta, 0)
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (key, str(num_active).encode()),
+                )
+                if partition is not None:
+                    conn.execute(
+                        "INSERT INTO hashes (key, field, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (key, field) DO UPDATE SET value = value + excluded.value",
+                        (hash_key, partition, delta),
+                    )
+            return num_active
+
+        return await self._run(update)
+
+    async def enqueue(self, data: Any) -> int:
+        id, value, partition = self._new_entry(data)
+        queue_key = self._partition_queue_key(partition)
+
+        def enqueue(conn: sqlite3.Connection) -> int:
+            with self._transaction(conn):
+                conn.execute(
+                    "INSERT INTO history (key, value) VALUES (?, ?)",
+                    (self._build_key(self._hist_key_prefix, id), value),
+                )
+                if partition is not None:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)",
+                        (self._build_key(self._partitions_key), partition),
+                    )
+                self._index_history(conn, id, data)
+                conn.execute(
+                    "INSERT INTO queue (queue_key, id) VALUES (?, ?)", (queue_key, id)
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (
+                        self._build_key(self._last_enqueue_key),
+                        str(time.time()).encode(),
+                    ),
+                )
+                return conn.execute(
+                    "SELECT COUNT(*) FROM queue WHERE queue_key = ?", (queue_key,)
+                ).fetchone()[0]
+
+        try:
+            num_items = await self._run(enqueue)
+        except Exception as exc:
+            logger.opt(exception=True).error(
+                f"Error enqueuing data into queue: {queue_key}, error: {exc}"
+            )
+            raise
+        logger.debug(f"Queued {id} in partition {partition}")
+        return num_items
+
+    def _index_history(self, conn: sqlite3.Connection, id: str, data: Any):
+        rows = [(self._build_key(self._history_index_key), id)]
+        for facet, values in history_facets(data).items():
+            conn.executemany(
+                "INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)",
+                [(self._build_key(self._history_facets_key, facet), v) for v in values],
+            )
+            rows += [(self._history_facet_key(facet, value), id) for value in values]
+        conn.executemany("INSERT INTO zsets (key, member) VALUES (?, ?)", rows)
+
+    def _purge_expired(self, conn: sqlite3.Connection, now: float):
+        """Delete expired history entries, and remove them from the history index."""
+        hist_prefix = self._build_key(self._hist_key_prefix, "")
+        index_key = self._build_key(self._history_index_key)
+        expired = conn.execute(
+            "SELECT key FROM history WHERE expires_at <= ?", (now,)
+        ).fetchall()
+        conn.execute("DELETE FROM history WHERE expires_at <= ?", (now,))
+        conn.executemany(
+            "DELETE FROM zsets WHERE (key = ? OR key LIKE ?) AND member = ?",
+            [
+                (index_key, f"{index_key}:%", key[len(hist_prefix) :])
+                for (key,) in expired
+                if key.startswith(hist_prefix)
+            ],
+        )
+
+    def _pop_items(
+        self, conn: sqlite3.Connection, keys: list[str], count: int
+    ) -> list[QueueItem]:
+        """Pop up to `count` items in queue order, and start to expire their history.
+        Ids whose history entry no longer exists are skipped.
+        """
+        now = time.time()
+        expires_at = (
+            now + self.history_ttl_ms / 1000 if self.history_ttl_ms > 0 else None
+        )
+        placeholders = ",".join("?" * len(keys))
+        items: list[QueueItem] = []
+        with self._transaction(conn):
+            while len(items) < count:
+                rows = conn.execute(
+                    f"SELECT seq, queue_key, id FROM queue WHERE queue_key IN ({placeholders}) "
+                    "ORDER BY seq LIMIT ?",
+                    (*keys, count - len(items)),
+                ).fetchall()
+                if not rows:
+                    break
+                conn.executemany(
+                    "DELETE FROM queue WHERE seq = ?", [(seq,) for seq, _, _ in rows]
+                )
+                for _, queue_key, id in rows:
+                    hist_key = self._build_key(self._hist_key_prefix, id)
+                    row = conn.execute(
+                        "SELECT value FROM history WHERE key = ? "
+                        "AND (expires_at IS NULL OR expires_at > ?)",
+                        (hist_key, now),
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    if expires_at is not None:
+                        conn.execute(
+                            "UPDATE history SET expires_at = ? WHERE key = ?",
+                            (expires_at, hist_key),
+                        )
+                    items.append(QueueItem(id=id, value=row[0], queue_key=queue_key))
+            if now - self._last_purge_at > self._purge_interval_sec:
+                self._last_purge_at = now
+                self._purge_expired(conn, now)
+        return items
+
+    async def dequeue_many(
+        self,
+        count: int,
+        block_sec: float = 0,
+        topic: str | None = None,
+        augment_type: str | None = None,
+    ) -> list[QueueItem]:
+        deadline = time.monotonic() + block_sec
+        while True:
+            # look up the queues each time, the item may be in a new partition
+            keys = await self._queue_keys(topic, augment_type)
+            try:
+                items = (
+                    await self._run(
+                        lambda conn, keys=keys: self._pop_items(conn, keys, count)
+                    )
+                    if keys
+                    else []
+                )
+            except Exception as exc:
+                logger.opt(exception=True).error(
+                    f"Error dequeuing {count} items from keys: {keys}, error: {exc}"
+                )
+                raise
+            remaining = deadline - time.monotonic()
+            if items or remaining <= 0:
+                return items
+            await asyncio.sleep(min(self._poll_interval_sec, remaining))
+
+    async def requeue(self, items: list[QueueItem]) -> int:
+        if not items:
+            return 0
+
+        def requeue(conn: sqlite3.Connection):
+            now = time.time()
+            with self._transaction(conn):
+                for item in reversed(items):
+                    # history entries do not expire while queued, unless they already expired
+                    conn.execute(
+                        "UPDATE history SET expires_at = NULL WHERE key = ? AND expires_at > ?",
+                        (self._build_key(self._hist_key_prefix, item.id), now),
+                    )
+                    conn.execute(
+                        "INSERT INTO queue (seq, queue_key, id) "
+                        "VALUES ((SELECT COALESCE(MIN(seq), 1) - 1 FROM queue), ?, ?)",
+                        (item.queue_key, item.id),
+                    )
+
+        await self._run(requeue)
+        return len(items)
+
+    async def get_history_facets(self) -> dict[str, dict[str, int]]:
+        facet_prefix = self._build_key(self._history_index_key, "")
+
+        def counts(conn: sqlite3.Connection) -> list[tuple[str, int]]:
+            return conn.execute(
+                "SELECT key, COUNT(*) FROM zsets WHERE key LIKE ? GROUP BY key ORDER BY key",
+                (f"{facet_prefix}%",),
+            ).fetchall()
+
+        facets: dict[str, dict[str, int]] = {facet: {} for facet in HISTORY_FACETS}
+        for key, count in await self._run(counts):
+            facet, _, value = key[len(facet_prefix) :].partition(":")
+            if facet in facets:
+                facets[facet][value] = count
+        return facets
+
+    async def trim_history_index(self) -> int:
+        if self.history_ttl_ms <= 0:
+            return 0
+        cutoff = uuid7_prefix(int(time.time() * 1000) - self.history_ttl_ms)
+        index_key = self._build_key(self._history_index_key)
+
+        def trim(conn: sqlite3.Connection) -> int:
+            with self._transaction(conn):
+                num_trimmed = conn.execute(
+                    "DELETE FROM zsets WHERE key = ? AND member < ?",
+                    (index_key, cutoff),
+                ).rowcount
+                conn.execute(
+                    "DELETE FROM zsets WHERE key LIKE ? AND member < ?",
+                    (f"{index_key}:%", cutoff),
+                )
+                for facet in HISTORY_FACETS:
+                    conn.execute(
+                        "DELETE FROM sets WHERE key = ? AND NOT EXISTS "
+                        "(SELECT 1 FROM zsets WHERE zsets.key = ? || sets.member)",
+                        (
+                            self._build_key(self._history_facets_key, facet),
+                            self._history_facet_key(facet, ""),
+                        ),
+                    )
+            return num_trimmed
+
+        return await self._run(trim)
+
+    async def query_history(
+        self,
+        limit: int = 50,
+        cursor: str | None = None,
+        topic: str | None = None,
+        model: str | None = None,
+        strategy: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        with_values: bool = False,
+    ) -> tuple[list[HistoryEntry], str | None]:
+        # ids sort by time, so time bounds and the cursor are bounds on the ids
+        sql = (
+            f"SELECT i.member, {'h.value' if with_values else 'NULL'} FROM zsets i "
+            "JOIN history h ON h.key = ? || i.member "
+            "AND (h.expires_at IS NULL OR h.expires_at > ?) WHERE i.key = ?"
+        )
+        params: list[Any] = [
+            self._build_key(self._hist_key_prefix, ""),
+            time.time(),
+            self._build_key(self._history_index_key),
+        ]
+        filters = zip(HISTORY_FACETS, (topic, model, strategy), strict=True)
+        for facet, value in filters:
+            if value is not None:
+                sql += " AND EXISTS (SELECT 1 FROM zsets f WHERE f.key = ? AND f.member = i.member)"
+                params.append(self._history_facet_key(facet, value))
+        if until is not None:
+            sql += " AND i.member < ?"
+            params.append(uuid7_prefix(int(until * 1000) + 1))
+        if cursor is not None:
+            sql += " AND i.member < ?"
+            params.append(cursor)
+        if since is not None:
+            sql += " AND i.member >= ?"
+            params.append(uuid7_prefix(int(since * 1000)))
+        sql += " ORDER BY i.member DESC LIMIT ?"
+        params.append(limit)
+
+        rows = await self._run(lambda conn: conn.execute(sql, params).fetchall())
+        entries = [
+            HistoryEntry(id=id, created_at=uuid7_ms(id) / 1000, value=value)
+            for id, value in rows
+        ]
+        next_cursor = entries[-1].id if len(entries) == limit else None
+        return entries, next_cursor
+
+    async def get_value(self, key: str) -> bytes | None:
+        row = await self._run(
+            lambda conn: conn.execute(
+                "SELECT value FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+        )
+        return None if row is None else row[0]
+
+    async def set_value(self, key: str, value: str | int, nx: bool = False) -> bool:
+        verb = "INSERT OR IGNORE" if nx else "INSERT OR REPLACE"
+        cursor = await self._run(
+            lambda conn: conn.execute(
+                f"{verb} INTO kv (key, value) VALUES (?, ?)", (key, str(value).encode())
+            )
+        )
+        return cursor.rowcount > 0
+
+    async def incr(self, key: str) -> int:
+        def incr(conn: sqlite3.Connection) -> int:
+            with self._transaction(conn):
+                row = conn.execute(
+                    "SELECT value FROM kv WHERE key = ?", (key,)
+                ).fetchone()
+                value = (int(row[0]) if row else 0) + 1
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (key, str(value).encode()),
+                )
+            return value
+
+        return await self._run(incr)
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import re
 import shutil
@@ -19,11 +20,12 @@ from pyppeteer.page import Page
 
 
 class ErrorInfo(BaseModel):
-    message: str
-    lineno: int
-    colno: int
-    source: str
-    stack: str
+    type: str = "Error"
+    message: str = ""
+    lineno: int | None = None
+    colno: int | None = None
+    source: str | None = None
+    stack: str | None = None
 
 
 IMAGE_NAME = "web-sandbox"
@@ -343,41 +345,97 @@ async def _ensure_docker_image_built():
             await _build_docker_image()
 
 
-# # TODO treesitter parsing to get the whole function that is buggy, and maybe subfunctions
-# def _parse_nodejs_server_feedback(
-#     html_code: str,
-#     feedback: str,
-#     before_context_lines: int = 10,  # pyright: ignore[reportUnusedParameter]
-#     after_context_lines: int = 10,  # pyright: ignore[reportUnusedParameter]
-# ):
-#     # parse each line which is a JSON object as defined by winston logging in server.js
-#     feedback_lines = []
-#     for line in feedback.splitlines():
-#         try:
-#             # Process the JSON data as needed
-#             # For example, you could yield or return it:
-#             feedback_lines.append(json.loads(line))
-#         except json.JSONDecodeError:
-#             # If the line is not valid JSON, skip it
-#             continue
-
-#     # for each feedback line grab buggy locations
-#     error_messages = []
-#     for feedback_line in feedback_lines:
-#         # get the line number and the function name
-#         message_json = feedback_line["message"]
-#         error_info: ErrorInfo | None = None
-#         try:
-#             message_data = json.loads(message_json)
-#             error_info = ErrorInfo(
-#                 message=message_data["message"],
-#                 lineno=message_data["lineno"],
-#                 colno=message_data["colno"],
-#                 source=message_data["source"],
-#                 stack=message_data["stack"],
-#             )
-#             error_messages.append(error_info)
-#         except json.JSONDecodeError:
-#             continue
-
-#     return error_messages
+# weights used to score execution feedback, errors that usually break the whole page are weighted higher
+ERROR_SEVERITY: dict[str, float] = {
+    "SyntaxError": 10.0,
+    "ReferenceError": 8.0,
+    "TypeError": 5.0,
+    "RangeError": 5.0,
+    "unhandledRejection": 3.0,
+}
+DEFAULT_ERROR_SEVERITY = 4.0
+
+
+def parse_feedback_errors(feedback: str) -> list[ErrorInfo]:
+    """
+    Parses the feedback from the code executor into structured errors.
+
+    Each line of the feedback is a JSON object as defined by winston logging in server.js,
+    where client-side errors are logged at the "error" level with errorLogging.js's payload as the message.
+
+    Args:
+        feedback (str): The feedback returned by `get_feedback`.
+
+    Returns:
+        list[ErrorInfo]: Unique errors found in the feedback, in order of appearance.
+    """
+    errors: dict[tuple, ErrorInfo] = {}
+    for line in feedback.splitlines():
+        try:
+            log_line = json.loads(line)
+        except json.JSONDecodeError:
+            # If the line is not valid JSON, skip it
+            continue
+        if not isinstance(log_line, dict) or log_line.get("level") != "error":
+            continue
+
+        message = log_line.get("message", "")
+        try:
+            message_data = json.loads(message)
+            error_info = ErrorInfo(
+                type=str(message_data.get("type") or "Error"),
+                message=str(
+                    message_data.get("message") or message_data.get("reason") or ""
+                ),
+                lineno=message_data.get("lineno"),
+                colno=message_data.get("colno"),
+                source=message_data.get("source"),
+                stack=message_data.get("stack"),
+            )
+        except (json.JSONDecodeError, AttributeError, ValueError):
+            error_info = ErrorInfo(type="ServerError", message=str(message))
+
+        # the same error is usually logged many times, e.g. inside an animation loop
+        key = (error_info.type, error_info.message, error_info.lineno)
+        errors.setdefault(key, error_info)
+
+    return list(errors.values())
+
+
+def is_feedback_parsed(feedback: str) -> bool:
+    """
+    Whether the feedback is empty or has at least one log line, otherwise it is unknown whether
+    the code has errors, e.g. because the sandbox failed before the server started logging.
+    """
+    if not feedback.strip():
+        return True
+    for line in feedback.splitlines():
+        try:
+            if isinstance(json.loads(line), dict):
+                return True
+        except json.JSONDecodeError:
+            continue
+    return False
+
+
+def score_feedback(feedback: str) -> tuple[float, int, bool]:
+    """
+    Scores the feedback from the code executor, lower is better.
+
+    Feedback that cannot be parsed is scored as one error of unknown type, so it ranks below
+    code without errors.
+
+    Args:
+        feedback (str): The feedback returned by `get_feedback`.
+
+    Returns:
+        tuple[float, int, bool]: The severity weighted score, the number of unique errors, and
+            whether the feedback could be parsed.
+    """
+    if not is_feedback_parsed(feedback):
+        return DEFAULT_ERROR_SEVERITY, 0, False
+    errors = parse_feedback_errors(feedback)
+    score = sum(
+        ERROR_SEVERITY.get(error.type, DEFAULT_ERROR_SEVERITY) for error in errors
+    )
+    return score, len(errors), True
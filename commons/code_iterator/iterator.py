@@ -1,10 +1,14 @@
+import asyncio
+
 from loguru import logger
 from tenacity import AsyncRetrying, RetryError, stop_after_attempt
 
 from commons.code_executor import get_feedback
-from commons.code_executor.feedback import _remove_error_logging_js
+from commons.code_executor.feedback import _remove_error_logging_js, score_feedback
 from commons.code_iterator.rewoo import plan_and_solve
+from commons.code_iterator.tools import patch_code
 from commons.code_iterator.types import CodeIteration, CodeIterationStates
+from commons.config import get_settings
 
 
 def parse_code_iteration_state(states: CodeIterationStates) -> CodeIterationStates:
@@ -14,18 +18,55 @@ def parse_code_iteration_state(states: CodeIterationStates) -> CodeIterationStat
     return states
 
 
+def _build_iteration(
+    code: str, feedback: str, parent: int | None = None
+) -> CodeIteration:
+    score, num_errors, feedback_parsed = score_feedback(feedback)
+    return CodeIteration(
+        code=code,
+        error=feedback,
+        score=score,
+        num_errors=num_errors,
+        feedback_parsed=feedback_parsed,
+        parent=parent,
+    )
+
+
+async def _generate_candidate(
+    parent_index: int, parent: CodeIteration, iteration_mode: str
+) -> CodeIteration:
+    """Generate a single candidate fix branched from the parent iteration, and score it."""
+    solution = None
+    if iteration_mode == "patch":
+        solution = await patch_code(parent.code, parent.error)
+    if solution is None:
+        solution = await plan_and_solve(parent.code)
+    feedback, code_with_loggingjs = await get_feedback(solution)
+    return _build_iteration(code_with_loggingjs, feedback, parent=parent_index)
+
+
 async def debug_initial_code(
     initial_html_code: str,
     max_iterations: int = 3,
     max_retries_per_iter: int = 3,
+    iteration_mode: str | None = None,
+    num_candidates: int | None = None,
 ) -> CodeIterationStates:
     """Based on an initial piece of code, perform CoT loop to fix any errors with the code.
 
+    Each iteration is scored based on the errors found by the code executor, and every
+    iteration branches from the best scoring iteration so far, so that fixes which make
+    the code worse are backtracked.
+
     Args:
         initial_code (str): Initial code to debug.
         model (str): Model to use for debugging.
         max_iterations (int, optional): Maximum number of iterations to perform. Defaults to 3.
         max_retries_per_iter (int, optional): Maximum number of retries per iteration. Defaults to 3.
+        iteration_mode (str | None, optional): "patch" to apply targeted edits to the latest code, falling back to
+            "full" regeneration using plan and solve. Defaults to `rewoo.iteration_mode` from settings.
+        num_candidates (int | None, optional): Number of candidate fixes to explore in parallel per iteration.
+            Defaults to `rewoo.num_candidates` from settings.
 
     Raises:
         ValueError: If no initial iteration is found.
@@ -33,40 +74,43 @@ async def debug_initial_code(
         Exception: If an error occurs while generating code.
 
     Returns:
-        CodeIterationStates: States of all code iterations.
+        CodeIterationStates: States of all code iterations, use `best_iteration` for the best code.
     """
     feedback, code_with_loggingjs = await get_feedback(initial_html_code)
     states = CodeIterationStates()
-    states.set_initial_state(
-        iteration=CodeIteration(code=code_with_loggingjs, error=feedback)
-    )
-    if not feedback:
-        logger.info("⏩ No intitial code executor feedback, skipping feedback loop")
-        return parse_code_iteration_state(states)
-
+    states.set_initial_state(iteration=_build_iteration(code_with_loggingjs, feedback))
     if not states.latest_iteration:
         raise ValueError("No initial iteration found")
 
+    if states.latest_iteration.is_error_free:
+        logger.info("⏩ No intitial code executor errors, skipping feedback loop")
+        return parse_code_iteration_state(states)
+
+    iteration_mode = iteration_mode or get_settings().rewoo.iteration_mode
+    num_candidates = num_candidates or get_settings().rewoo.num_candidates
+
     while states.current_iteration_num < max_iterations:
+        best_index = states.best_iteration_index
+        best_iteration = states.best_iteration
+        assert best_index is not None and best_iteration is not None
         try:
             async for attempt in AsyncRetrying(
                 stop=stop_after_attempt(max_retries_per_iter),
             ):
                 with attempt:
-                    latest_iteration = states.latest_iteration
-                    solution = await plan_and_solve(latest_iteration.code)
-                    feedback, code_with_loggingjs = await get_feedback(solution)
-                    states.add_iteration(
-                        iteration=CodeIteration(
-                            code=code_with_loggingjs, error=feedback
-                        )
+                    results = await asyncio.gather(
+                        *[
+                            _generate_candidate(
+                                best_index, best_iteration, iteration_mode
+                            )
+                            for _ in range(num_candidates)
+                        ],
+                        return_exceptions=True,
                     )
-
-                    if not feedback:
-                        logger.success(
-                            f"🚀 No more error feedback found after {states.current_iteration_num}, exiting feedback loop 🙇"
-                        )
-                        break
+                    candidates = [r for r in results if isinstance(r, CodeIteration)]
+                    if not candidates:
+                        raise next(r for r in results if isinstance(r, BaseException))
+                    states.add_candidates(candidates)
         except RetryError as e:
             logger.error(
                 f"Failed to generate answer after {max_retries_per_iter} attempts."
@@ -76,4 +120,21 @@ async def debug_initial_code(
             logger.error(f"Error occurred while generating code answer: {e}")
             raise e
 
+        new_best = states.best_iteration
+        assert new_best is not None
+        logger.info(
+            f"Iteration {states.current_iteration_num}: candidate scores {[c.score for c in candidates]}, "
+            f"best score {new_best.score} from iteration {states.best_iteration_index}"
+        )
+        if new_best is best_iteration:
+            logger.warning(
+                f"No candidate improved on score {best_iteration.score}, backtracking to iteration {best_index}"
+            )
+
+        if new_best.is_error_free:
+            logger.success(
+                f"🚀 No more error feedback found after {states.current_iteration_num}, exiting feedback loop 🙇"
+            )
+            break
+
     return parse_code_iteration_state(states)
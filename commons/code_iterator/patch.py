@@ -0,0 +1,62 @@
+"""
+Applies search/replace patches returned by the LLM onto the current code, so that
+fix iterations only need to generate the changed snippets instead of the whole file.
+"""
+
+from loguru import logger
+
+from commons.code_iterator.types import CodePatch, SearchReplaceEdit
+
+
+class PatchApplyError(Exception):
+    """Raised when a patch cannot be applied unambiguously to the code."""
+
+
+def _find_unique(code: str, search: str) -> int:
+    count = code.count(search)
+    if count == 1:
+        return code.index(search)
+    if count == 0:
+        raise PatchApplyError(f"Search snippet not found in code: {search[:80]!r}")
+    raise PatchApplyError(
+        f"Search snippet is ambiguous, found {count} matches: {search[:80]!r}"
+    )
+
+
+def _apply_edit(code: str, edit: SearchReplaceEdit) -> str:
+    if not edit.search:
+        raise PatchApplyError("Search snippet must not be empty")
+
+    try:
+        start = _find_unique(code, edit.search)
+        return code[:start] + edit.replace + code[start + len(edit.search) :]
+    except PatchApplyError:
+        # LLMs commonly get leading/trailing blank lines wrong, retry with those stripped
+        search = edit.search.strip("\n")
+        if not search or search == edit.search:
+            raise
+        start = _find_unique(code, search)
+        return code[:start] + edit.replace.strip("\n") + code[start + len(search) :]
+
+
+def apply_code_patch(code: str, patch: CodePatch) -> str:
+    """Apply all edits of a patch in order, each edit must match exactly once.
+
+    Args:
+        code (str): Code to apply the patch onto.
+        patch (CodePatch): Patch containing search/replace edits.
+
+    Raises:
+        PatchApplyError: If the patch is empty, or any edit does not match exactly once.
+
+    Returns:
+        str: The patched code.
+    """
+    if not patch.edits:
+        raise PatchApplyError("Patch does not contain any edits")
+
+    for edit in patch.edits:
+        code = _apply_edit(code, edit)
+
+    logger.debug(f"Applied patch with {len(patch.edits)} edits")
+    return code
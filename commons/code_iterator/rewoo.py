@@ -14,13 +14,13 @@ import instructor
 from dotenv import load_dotenv
 from langfuse.decorators import langfuse_context, observe
 from loguru import logger
-from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletion
 
+from commons.code_iterator.streaming import stream_html_code
 from commons.code_iterator.tools import call_llm, fix_code, web_search_and_format
 from commons.code_iterator.types import HtmlCode, Plan, ReWOOState, Step, Tool
 from commons.config import get_settings
-from commons.llm import Provider, _get_llm_api_kwargs, get_llm_api_client
+from commons.llm import Provider, get_async_openai_client, get_llm_api_client
 from commons.utils import func_to_pydantic_model, get_function_signature
 from commons.utils.logging import get_kwargs_from_partial
 
@@ -215,9 +215,7 @@ async def build_func_call(func: Callable, step: Step, rewoo_state: ReWOOState):
     logger.debug(f"Inferred JSON schema: {response_model.model_json_schema()}")
 
     tool_client = instructor.from_openai(  # type: ignore
-        AsyncOpenAI(
-            **_get_llm_api_kwargs(Provider.OPENROUTER),  # type: ignore
-        ),
+        get_async_openai_client(Provider.OPENROUTER),
         mode=instructor.Mode.PARALLEL_TOOLS,
     )
 
@@ -403,12 +401,26 @@ async def _solve(rewoo_state: ReWOOState) -> str:
         plan=plan_str, execution_results=results_str, task=rewoo_state.task
     )
 
+    messages = [{"role": "user", "content": prompt}]
+    model = get_settings().rewoo.solver
+
+    if get_settings().rewoo.stream_solutions:
+        html_code = await stream_html_code(messages, model)
+        langfuse_context.update_current_observation(
+            input=messages,
+            model=model,
+            output={"html_code": html_code},
+            metadata={"stream": True},
+        )
+        logger.debug(f"Rewoo Solver streamed {len(html_code)} characters")
+        return html_code
+
     client = get_llm_api_client()
 
     partial_func = functools.partial(
         client.chat.completions.create,
-        messages=[{"role": "user", "content": prompt}],
-        model=get_settings().rewoo.solver,
+        messages=messages,
+        model=model,
         response_model=HtmlCode,
     )
 
@@ -428,7 +440,7 @@ async def _solve(rewoo_state: ReWOOState) -> str:
 
 
 async def _plan_and_solve(html_code: str):
-    # TODO implement backtracking to be able to figure out when LLM's iteration actually makes code worse
+    # backtracking when an iteration makes the code worse is handled by `debug_initial_code`
     task = _build_task_prompt(html_code)
     plan = await _generate_plan(task)
     if plan is None:
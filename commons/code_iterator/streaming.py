@@ -0,0 +1,158 @@
+"""
+Streaming helpers for LLM calls that respond with a full HTML document.
+
+Instead of waiting for the whole `HtmlCode` JSON response, the HTML is streamed
+as plain text so that we can:
+- stop generating as soon as the closing `</html>` tag is seen
+- abort early when the start of the response is obviously not an HTML document
+
+A stream that fails before `</html>` is seen is retried with exponential backoff, unless it was
+truncated at `max_tokens`, which would happen again.
+"""
+
+import re
+
+from loguru import logger
+from tenacity import (
+    AsyncRetrying,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from commons.config import get_settings
+from commons.llm import Provider, get_async_openai_client
+
+HTML_END_TAG = "</html>"
+# optional markdown fence, followed by the start of an HTML document
+_html_start_pattern = re.compile(
+    r"^\s*(?:```[a-zA-Z]*\s*)?(<!doctype html|<html)", re.I
+)
+
+STREAM_FORMAT_INSTRUCTION = (
+    "Respond with only the complete HTML document, starting with <!DOCTYPE html> "
+    "and ending with </html>. Do not wrap the HTML in JSON and do not add any "
+    "explanations before or after it."
+)
+
+
+class InvalidHtmlStreamError(Exception):
+    """Raised when a streamed response cannot be a valid HTML document."""
+
+
+class TruncatedHtmlStreamError(InvalidHtmlStreamError):
+    """Raised when a streamed response reached `max_tokens` before `</html>`."""
+
+
+def _validate_html_start(head: str):
+    if not _html_start_pattern.match(head):
+        raise InvalidHtmlStreamError(
+            f"Streamed response does not start with an HTML document: {head[:80]!r}"
+        )
+
+
+async def stream_html_code(
+    messages: list[dict[str, str]],
+    model: str,
+    max_tokens: int | None = None,
+) -> str:
+    """Stream an HTML document from the LLM, validating it incrementally.
+
+    Args:
+        messages (list[dict[str, str]]): Chat messages to send, the format instruction is appended.
+        model (str): Model to use for generation.
+        max_tokens (int | None, optional): Maximum number of output tokens. Defaults to
+            `generation.max_tokens` from settings.
+
+    Raises:
+        InvalidHtmlStreamError: If the response does not start with an HTML document,
+            or if it was truncated before `</html>` was generated.
+
+    Returns:
+        str: The HTML document, up to and including the closing `</html>` tag.
+    """
+    max_tokens = max_tokens or get_settings().generation.max_tokens
+    html_code = ""
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(get_settings().rewoo.stream_max_attempts),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        retry=retry_if_not_exception_type(TruncatedHtmlStreamError),
+        before_sleep=lambda state: logger.warning(
+            f"Streaming HTML failed on attempt {state.attempt_number}, retrying: "
+            f"{state.outcome.exception() if state.outcome else None}"
+        ),
+        reraise=True,
+    ):
+        with attempt:
+            html_code = await _stream_html_code(messages, model, max_tokens)
+    return html_code
+
+
+async def _stream_html_code(
+    messages: list[dict[str, str]], model: str, max_tokens: int
+) -> str:
+    settings = get_settings().rewoo
+    client = get_async_openai_client(Provider.OPENROUTER)
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=[*messages, {"role": "user", "content": STREAM_FORMAT_INSTRUCTION}],  # type: ignore
+        max_tokens=max_tokens,
+        stream=True,
+        # the last chunk reports the usage, which settles the tokens charged by the rate limiter
+        stream_options={"include_usage": True},
+    )
+
+    parts: list[str] = []
+    # keep a small window so that a closing tag split across chunks is detected
+    tail = ""
+    head = ""
+    is_validated = False
+    is_complete = False
+    finish_reason: str | None = None
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+
+            if not is_validated:
+                head += delta
+                if len(head.lstrip()) >= settings.stream_validate_after_chars:
+                    _validate_html_start(head)
+                    is_validated = True
+
+            window = (tail + delta).lower()
+            if HTML_END_TAG in window:
+                is_complete = True
+                break
+            tail = window[-len(HTML_END_TAG) :]
+    finally:
+        # closing the stream early stops the provider from generating more tokens
+        try:
+            await stream.close()
+        except Exception as exc:
+            # never raise from here, it would replace the error that ended the stream
+            logger.warning(f"Error closing the HTML stream: {exc}")
+
+    text = "".join(parts)
+    if not is_validated:
+        _validate_html_start(text)
+
+    if not is_complete:
+        if finish_reason == "length":
+            raise TruncatedHtmlStreamError(
+                f"Streamed HTML was truncated after {len(text)} characters"
+            )
+        logger.warning("Streamed HTML finished without a closing </html> tag")
+
+    start = _html_start_pattern.match(text).start(1)  # type: ignore
+    end = text.lower().rfind(HTML_END_TAG)
+    html_code = text[start : end + len(HTML_END_TAG)] if end > start else text[start:]
+    logger.debug(
+        f"Streamed {len(html_code)} characters of HTML, stopped early: {is_complete}"
+    )
+    return html_code
@@ -1,3 +1,4 @@
+import asyncio
 import functools
 import urllib.parse
 from typing import Annotated, List
@@ -6,12 +7,15 @@ import aiohttp
 from bs4 import BeautifulSoup, Tag
 from langfuse.decorators import langfuse_context, observe
 from loguru import logger
-from openai import AsyncOpenAI
 
 from commons.code_executor import get_feedback
-from commons.code_iterator.types import DuckduckgoSearchResult, HtmlCode
+from commons.code_executor.feedback import _remove_error_logging_js
+from commons.code_iterator.patch import PatchApplyError, apply_code_patch
+from commons.code_iterator.streaming import stream_html_code
+from commons.code_iterator.types import CodePatch, DuckduckgoSearchResult, HtmlCode
 from commons.config import get_settings
-from commons.llm import get_llm_api_client
+from commons.linter.linter import lint_html_scripts
+from commons.llm import get_async_openai_client, get_llm_api_client
 from commons.utils.logging import get_kwargs_from_partial
 
 # blacklist domains that are not useful for code fixing
@@ -119,12 +123,8 @@ async def web_search_and_format(
 async def call_llm(input: str) -> str | None:
     """Simply use OpenAI as a proxy to call LLMs, no JSON parsing etc, just pure text"""
     try:
-        settings = get_settings()
-        # simple LLM call without instructor, so we instantiate AsyncOpenAI directly
-        client = AsyncOpenAI(
-            api_key=settings.llm_api.openrouter_api_key.get_secret_value(),
-            base_url=settings.llm_api.openrouter_api_base_url,
-        )
+        # simple LLM call without instructor, so we use the AsyncOpenAI client directly
+        client = get_async_openai_client()
 
         partial_func = functools.partial(
             client.chat.completions.create,
@@ -169,16 +169,29 @@ async def fix_code(html_code: str) -> str:
     # need to provide the modified HTML code with the error logging JS injected
     # so that diagnostics are consistent with the actual lineno/colno error is at
     fix_code_prompt = f"The following is the buggy code: {modified_code}\n\nThe following is the feedback from the execution: {feedback}\n\nYour task is to fix the code and provide the fully working code."
+    messages = [{"role": "user", "content": fix_code_prompt}]
+    model = get_settings().rewoo.tool.fix_code
+
+    if get_settings().rewoo.iteration_mode == "patch":
+        patched_code = await patch_code(modified_code, feedback)
+        if patched_code is not None:
+            return patched_code
+        logger.info("Falling back to full regeneration of the code")
+
+    if get_settings().rewoo.stream_solutions:
+        html_code = await stream_html_code(messages, model)
+        langfuse_context.update_current_observation(
+            input=messages,
+            model=model,
+            output={"html_code": html_code},
+            metadata={"stream": True},
+        )
+        return html_code
 
     partial_func = functools.partial(
         client.chat.completions.create,
-        messages=[
-            {
-                "role": "user",
-                "content": fix_code_prompt,
-            }
-        ],
-        model=get_settings().rewoo.tool.fix_code,
+        messages=messages,
+        model=model,
         response_model=HtmlCode,
     )
 
@@ -194,3 +207,67 @@ async def fix_code(html_code: str) -> str:
     )
 
     return response.html_code
+
+
+@observe(as_type="generation", capture_input=False, capture_output=False)
+async def generate_code_patch(html_code: str, feedback: str) -> CodePatch:
+    """Ask the LLM for targeted search/replace edits that fix the code, instead of the whole file.
+
+    Args:
+        html_code (str): HTML code to fix, edits must match snippets of this code exactly
+        feedback (str): Feedback from the code execution
+
+    Returns:
+        CodePatch: Edits to apply onto the code
+    """
+    client = get_llm_api_client()
+    patch_prompt = f"The following is the buggy code: {html_code}\n\nThe following is the feedback from the execution: {feedback}\n\nYour task is to fix the code by responding with only the search/replace edits required, do not rewrite the whole file."
+
+    partial_func = functools.partial(
+        client.chat.completions.create,
+        messages=[{"role": "user", "content": patch_prompt}],
+        model=get_settings().rewoo.tool.fix_code,
+        response_model=CodePatch,
+    )
+
+    kwargs = get_kwargs_from_partial(partial_func)
+    response: CodePatch = await partial_func()
+    langfuse_context.update_current_observation(
+        input=kwargs.pop("messages"),
+        model=kwargs.pop("model"),
+        output=response.model_dump(),
+        metadata={
+            **kwargs,
+        },
+    )
+
+    return response
+
+
+async def patch_code(html_code: str, feedback: str) -> str | None:
+    """Fix the code by applying LLM generated edits locally, then validating the result using the linter.
+
+    Args:
+        html_code (str): HTML code to fix
+        feedback (str): Feedback from the code execution
+
+    Returns:
+        str | None: Patched HTML code, or None if the patch could not be applied or failed linting,
+        in which case callers should fall back to regenerating the whole file.
+    """
+    try:
+        patch = await generate_code_patch(html_code, feedback)
+        patched_code = _remove_error_logging_js(apply_code_patch(html_code, patch))
+    except PatchApplyError as exc:
+        logger.warning(f"Failed to apply code patch: {exc}")
+        return None
+    except Exception as exc:
+        logger.error(f"Error while generating code patch: {exc}")
+        return None
+
+    lint_result = await asyncio.to_thread(lint_html_scripts, patched_code, "patch")
+    if lint_result.return_code != 0:
+        logger.warning(f"Patched code failed linting: {lint_result.output}")
+        return None
+
+    return patched_code
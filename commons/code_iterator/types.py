@@ -111,9 +111,45 @@ class HtmlCode(BaseModel):
     html_code: str = Field(..., description="The HTML code solution")
 
 
+class SearchReplaceEdit(BaseModel):
+    """
+    Represents a targeted change to the code, by replacing an exact snippet.
+    """
+
+    search: str = Field(
+        ...,
+        description="An exact snippet copied from the current code, including indentation. It must match exactly one location in the code, so include enough surrounding lines to make it unique.",
+    )
+    replace: str = Field(
+        ..., description="The code that replaces the snippet in `search`."
+    )
+
+
+class CodePatch(BaseModel):
+    """
+    Represents a set of targeted changes to apply to the current code, instead of rewriting the whole file.
+    """
+
+    edits: List[SearchReplaceEdit] = Field(
+        ...,
+        description="A list of search/replace edits, applied in order, that fix the errors in the code.",
+    )
+
+
 class CodeIteration(BaseModel):
     code: str
     error: str
+    # severity weighted score of the errors in `error`, lower is better
+    score: float = 0.0
+    num_errors: int = 0
+    # False if `error` could not be parsed, then it is unknown whether the code has errors
+    feedback_parsed: bool = True
+    # index of the iteration that this iteration was branched from
+    parent: int | None = None
+
+    @property
+    def is_error_free(self) -> bool:
+        return not self.error or (self.feedback_parsed and self.num_errors == 0)
 
 
 class CodeIterationStates(BaseModel):
@@ -124,9 +160,33 @@ class CodeIterationStates(BaseModel):
         self.iterations.append(iteration)
         self.current_iteration_num += 1
 
+    def add_candidates(self, candidates: list[CodeIteration]):
+        """Add candidate iterations that were explored in parallel as a single iteration"""
+        self.iterations.extend(candidates)
+        self.current_iteration_num += 1
+
     def set_initial_state(self, iteration: CodeIteration):
         self.iterations.append(iteration)
 
     @property
     def latest_iteration(self) -> CodeIteration | None:
         return self.iterations[-1] if self.iterations else None
+
+    @property
+    def best_iteration_index(self) -> int | None:
+        if not self.iterations:
+            return None
+        # prefer error free iterations, then the lowest score, then the latest iteration when
+        # scores are tied
+        return min(
+            reversed(range(len(self.iterations))),
+            key=lambda i: (
+                not self.iterations[i].is_error_free,
+                self.iterations[i].score,
+            ),
+        )
+
+    @property
+    def best_iteration(self) -> CodeIteration | None:
+        index = self.best_iteration_index
+        return self.iterations[index] if index is not None else None
@@ -1,5 +1,6 @@
 import argparse
 import functools
+import json
 import os
 import sys
 
@@ -24,6 +25,36 @@ class RedisSettings(BaseSettings):
     port: int = Field(default=int(os.getenv("REDIS_PORT", "6379")))
     username: str = Field(default=os.getenv("REDIS_USERNAME", "default"))
     password: SecretStr = Field(default=os.getenv("REDIS_PASSWORD", ""))
+    # how QA pair payloads are stored, "zstd" or "none", see `commons/cache/codec.py`
+    codec: str = Field(default=os.getenv("REDIS_CODEC", "zstd"))
+    zstd_level: int = Field(default=3)
+    # zstd dictionary trained on past payloads, see `python -m commons.cache.codec --help`
+    zstd_dict_path: str = Field(default=os.getenv("REDIS_ZSTD_DICT_PATH", ""))
+    # "list", or "stream" to acknowledge deliveries, see `commons/cache/redis_stream.py`
+    queue_backend: str = Field(default=os.getenv("REDIS_QUEUE_BACKEND", "list"))
+    # stream deliveries not acknowledged within this time are redelivered to another consumer,
+    # must be longer than it takes to send a response
+    stream_claim_idle_ms: int = Field(default=360_000)
+    # bytes of queued payloads kept in redis, finished QA pairs beyond it are spilled to
+    # segment files in `spill_dir` until consumers make room, 0 to disable, see
+    # `commons/cache/spill.py`
+    memory_budget_bytes: int = Field(
+        default=int(os.getenv("REDIS_MEMORY_BUDGET_BYTES", "0"))
+    )
+    spill_dir: str = Field(default=os.getenv("REDIS_SPILL_DIR", "spill"))
+    spill_segment_bytes: int = Field(default=64 * 1024 * 1024)
+
+
+class CacheSettings(BaseSettings):
+    # where the queue, history and worker counters live: "redis", or to run without redis
+    # "memory" (one process) or "sqlite" (processes on one host), see `commons/cache/base.py`
+    backend: str = Field(default=os.getenv("CACHE_BACKEND", "redis"))
+    # database file of the "sqlite" backend
+    sqlite_path: str = Field(
+        default=os.getenv("CACHE_SQLITE_PATH", "synthetic_cache.db")
+    )
+    # the "sqlite" backend cannot be notified of new QA pairs, blocked dequeues poll this often
+    sqlite_poll_interval_sec: float = Field(default=0.05)
 
 
 class LlmApiSettings(BaseSettings):
@@ -35,6 +66,56 @@ class LlmApiSettings(BaseSettings):
     openrouter_api_base_url: str = Field(default="https://openrouter.ai/api/v1")
 
 
+class RateLimitSettings(BaseSettings):
+    # limits applied to each (provider, model) and shared across processes via redis,
+    # see `commons/llm/rate_limiter.py`. Off by default, the limits below are not the quotas
+    # of any account, set them and the overrides to the quotas of yours when enabling it
+    enabled: bool = Field(default=os.getenv("LLM_RATE_LIMIT_ENABLED", "0") == "1")
+    requests_per_minute: int = Field(default=60)
+    tokens_per_minute: int = Field(default=400_000)
+    max_in_flight: int = Field(default=16)
+    # an in flight request that is not released within this time is assumed to be lost
+    lease_timeout_sec: int = Field(default=900)
+    # per model limits as JSON, e.g. {"openai/gpt-4-turbo": {"requests_per_minute": 30}}
+    overrides: dict[str, dict[str, int]] = Field(
+        default=json.loads(os.getenv("LLM_RATE_LIMIT_OVERRIDES", "{}"))
+    )
+
+
+class HedgeSettings(BaseSettings):
+    # duplicate slow requests to an alternate provider or model, see `commons/llm/hedging.py`
+    enabled: bool = Field(default=os.getenv("LLM_HEDGE_ENABLED", "0") == "1")
+    # comma separated "provider:model" alternates, e.g. "openai:gpt-4o,openrouter:openai/gpt-4o"
+    alternates: list[str] = Field(
+        default=[a for a in os.getenv("LLM_HEDGE_ALTERNATES", "").split(",") if a]
+    )
+    # hedge once a request is slower than this percentile of recent latencies
+    latency_percentile: float = Field(default=95.0)
+    min_delay_sec: float = Field(default=20.0)
+    # delay used until `min_samples` latencies have been observed
+    default_delay_sec: float = Field(default=180.0)
+    min_samples: int = Field(default=20)
+    # each request earns this fraction of a hedge, so at most ~10% of requests are hedged
+    budget_ratio: float = Field(default=0.1)
+    # maximum number of unused hedges that can be saved up
+    budget_burst: float = Field(default=2.0)
+    max_in_flight: int = Field(default=4)
+
+
+class LlmCacheSettings(BaseSettings):
+    # cache of LLM responses, see `commons/llm/response_cache.py`
+    # "off", "cache" (temperature 0 requests only), "record" or "replay"
+    mode: str = Field(default=os.getenv("LLM_CACHE_MODE", "off"))
+    # "disk" or "redis"
+    backend: str = Field(default=os.getenv("LLM_CACHE_BACKEND", "disk"))
+    directory: str = Field(default=os.getenv("LLM_CACHE_DIR", ".llm_cache"))
+    # expiry of responses stored in "cache" mode, recorded responses never expire
+    ttl_sec: int = Field(default=7 * 24 * 60 * 60)
+    # seeds the randomised parts of the pipeline in "record" and "replay" modes, e.g. the sampled
+    # persona and the temperature of requests, record again with another seed for new requests
+    seed: int = Field(default=int(os.getenv("LLM_CACHE_SEED", "0")))
+
+
 class UvicornSettings(BaseSettings):
     num_workers: int = Field(default=2)
     port: int = Field(default=5003)
@@ -44,6 +125,27 @@ class UvicornSettings(BaseSettings):
 
 class GenerationSettings(BaseSettings):
     buffer_size: int = Field(default=4)
+    # maximum output tokens of generated code answers, including streamed HTML solutions
+    max_tokens: int = Field(default=16384)
+    # target number of buffered QA pairs of specific partitions "<topic>:<augment_type>" as JSON,
+    # e.g. {"GAMES:CHANGE_ANSWERS": 2}, these QA pairs also count towards `buffer_size`
+    partition_buffer_sizes: dict[str, int] = Field(
+        default=json.loads(os.getenv("PARTITION_BUFFER_SIZES", "{}"))
+    )
+    # local persona snapshot, see `commons/dataset/personas.py`, defaults to commons/dataset/personas.bin
+    persona_snapshot_path: str = Field(default=os.getenv("PERSONA_SNAPSHOT_PATH", ""))
+    # how personas and topics are sampled: "random", "cycle" or "cluster", see `commons/dataset/sampler.py`
+    sampling_mode: str = Field(default="cycle")
+    # persona cluster labels used by "cluster" sampling, defaults to commons/dataset/persona_clusters.npy
+    persona_clusters_path: str = Field(default=os.getenv("PERSONA_CLUSTERS_PATH", ""))
+    # questions more similar than this to a recent question are regenerated, see `commons/similarity.py`
+    dedup_threshold: float = Field(default=0.9)
+    # number of recent questions to compare against
+    dedup_window: int = Field(default=2048)
+    # maximum number of times to regenerate a near-duplicate question
+    dedup_max_regenerations: int = Field(default=2)
+    # `/ready` fails until at least this many QA pairs are buffered in the queue
+    ready_min_queue_length: int = Field(default=1)
 
 
 class ReWOOSettings(BaseSettings):
@@ -58,6 +160,17 @@ class ReWOOSettings(BaseSettings):
     max_dep_resolve_sec: int = Field(default=60)
     # used as a maximum time that the WHOLE process takes for `plan_and_solve`
     max_solve_time: int = Field(default=180)
+    # stream HTML solutions as plain text, so generation can stop at </html>
+    stream_solutions: bool = Field(default=True)
+    # number of characters to receive before checking the response is an HTML document
+    stream_validate_after_chars: int = Field(default=64)
+    # attempts of a streamed solution that fails before </html>, with exponential backoff
+    stream_max_attempts: int = Field(default=2)
+    # "patch" asks for search/replace edits when fixing code, falling back to "full" regeneration
+    iteration_mode: str = Field(default="patch")
+    # candidate fixes generated and scored in parallel per iteration, each costs a full LLM call
+    # and code execution, so N candidates cost N times as much per iteration
+    num_candidates: int = Field(default=1)
 
     class ToolCallModelConfig(BaseSettings):
         # let an LLM call another LLM
@@ -71,7 +184,11 @@ class ReWOOSettings(BaseSettings):
 class Settings(BaseSettings):
     langfuse: LangfuseSettings = LangfuseSettings()
     redis: RedisSettings = RedisSettings()
+    cache: CacheSettings = CacheSettings()
     llm_api: LlmApiSettings = LlmApiSettings()
+    rate_limit: RateLimitSettings = RateLimitSettings()
+    hedge: HedgeSettings = HedgeSettings()
+    llm_cache: LlmCacheSettings = LlmCacheSettings()
     uvicorn: UvicornSettings = UvicornSettings()
     generation: GenerationSettings = GenerationSettings()
     rewoo: ReWOOSettings = ReWOOSettings()
@@ -1,122 +1,379 @@
+"""
+analysis.py
+
+Offline similarity analysis of generated questions, to find questions that are too similar.
+
+- question embeddings are cached on disk keyed by the hash of the question, so that only new
+  questions are encoded when the QA history grows
+- questions are encoded in batches
+- top-k similarities are computed blockwise, so the full n x n similarity matrix is never materialized
+
+usage:
+    python -m commons.data_analysis.analysis --directory commons/dataset/sample_synthetic_bank --top-k 5
+    python -m commons.data_analysis.analysis --embedder hashing --plot
+"""
+
+import argparse
+import functools
+import hashlib
 import json
 import os
+from typing import Callable
 
-import matplotlib.pyplot as plt
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+from loguru import logger
 
 from commons.config import GENERATOR_MODELS
 
-directory = "commons/dataset/sample_synthetic_bank"
-sentences = []
-for filename in os.listdir(directory):
-    if filename.endswith(".json"):
+DEFAULT_DIRECTORY = "commons/dataset/sample_synthetic_bank"
+DEFAULT_CACHE_DIR = "commons/data_analysis/.embedding_cache"
+SENTENCE_TRANSFORMER_MODEL = "all-MiniLM-L6-v2"
+
+
+def load_questions(directory: str) -> list[dict]:
+    """Load question-model pairs from .json (list of objects) and .jsonl files in a directory."""
+    sentences = []
+    for filename in sorted(os.listdir(directory)):
         file_path = os.path.join(directory, filename)
+        if filename.endswith(".json"):
+            with open(file_path) as file:
+                items = json.load(file)
+        elif filename.endswith(".jsonl"):
+            with open(file_path) as file:
+                items = [json.loads(line) for line in file if line.strip()]
+        else:
+            continue
 
-        # Read the JSON file
-        with open(file_path) as file:
-            json_data = json.load(file)
+        # Append each question-model pair to sentences list
+        for item in items:
+            sentences.append({"question": item["question"], "model": item["model"]})
+    return sentences
 
-            # Append each question-model pair to sentences list
-            for item in json_data:
-                sentences.append({"question": item["question"], "model": item["model"]})
-model = SentenceTransformer("all-MiniLM-L6-v2")
 
-sentence_embeddings = model.encode([obj["question"] for obj in sentences])
-# sentence_embeddings = model.encode(sentences)
+def question_hash(question: str) -> str:
+    return hashlib.sha1(question.encode("utf-8")).hexdigest()
 
-print("Sentence embeddings:")
-print(sentence_embeddings)
 
-cos_sim_matrix = cosine_similarity(sentence_embeddings)
-print("Cosine Similarity Matrix:")
-print(np.array2string(cos_sim_matrix, precision=2, separator=", "))
+class EmbeddingCache:
+    """Append-only on disk cache of normalized embeddings, keyed by question hash.
 
+    Embeddings are stored as raw float32 rows in `embeddings.f32` and read back as a memmap,
+    the hash of each row is stored on the same line number in `hashes.txt`, and the embedding
+    dimension in `meta.json`. On load both files are truncated to the rows they have in common,
+    so a crash between the two writes only loses the rows of the last batch.
+    """
 
-def process_cos_sim_matrix(sentences, prompt_model):
-    trimmed_sentences = [
-        sentence for sentence in sentences if sentence["model"] == prompt_model
-    ]
-    trimmed_sentence_embeddings = model.encode(
-        [obj["question"] for obj in trimmed_sentences]
-    )
-    trimmed_cos_sim_matrix = cosine_similarity(trimmed_sentence_embeddings)
-    for i in range(len(trimmed_cos_sim_matrix)):
-        row = trimmed_cos_sim_matrix[i]
-        second_largest = np.partition(row, -2)[-2]
-        second_largest_position = np.where(row == second_largest)[0][0]
-        smallest = np.min(row)
-        smallest_position = np.where(row == smallest)[0][0]
-        print(f"The prompt: \n {trimmed_sentences[i]['question']}")
-        print(f"produced by {trimmed_sentences[i]['model']}")
-        print(
-            f"is most similar to the prompt: \n {trimmed_sentences[second_largest_position]['question']}"
+    def __init__(self, cache_dir: str, name: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        self._embeddings_path = os.path.join(cache_dir, f"{name}.embeddings.f32")
+        self._hashes_path = os.path.join(cache_dir, f"{name}.hashes.txt")
+        self._meta_path = os.path.join(cache_dir, f"{name}.meta.json")
+        self._rows: dict[str, int] = {}
+        self._dim: int | None = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self._dim = json.load(f)["dim"]
+        self._load()
+
+    def _load(self):
+        if self._dim is None:
+            # nothing was written yet, or by a version without `meta.json`
+            for path in (self._embeddings_path, self._hashes_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        hashes: list[str] = []
+        hashes_size = 0
+        if os.path.exists(self._hashes_path):
+            with open(self._hashes_path, "rb") as f:
+                for line in f:
+                    # the last line is only partly written
+                    if not line.endswith(b"\n"):
+                        break
+                    hashes.append(line.decode().strip())
+                    hashes_size += len(line)
+        row_size = 4 * self._dim
+        num_embeddings = (
+            os.path.getsize(self._embeddings_path) // row_size
+            if os.path.exists(self._embeddings_path)
+            else 0
         )
-        print(f"produced by {trimmed_sentences[second_largest_position]['model']}")
-        print(f"with cosine similarity of {second_largest:.3f}")
-        print(
-            f"and least similar to the prompt: \n {trimmed_sentences[smallest_position]['question']}"
+
+        num_rows = min(len(hashes), num_embeddings)
+        if num_rows < len(hashes):
+            hashes_size = sum(len(h) + 1 for h in hashes[:num_rows])
+        with open(self._hashes_path, "ab") as f:
+            f.truncate(hashes_size)
+        with open(self._embeddings_path, "ab") as f:
+            f.truncate(num_rows * row_size)
+        if num_rows < max(len(hashes), num_embeddings):
+            logger.warning(
+                f"Dropped incomplete rows of the embedding cache, {num_rows} rows left"
+            )
+        self._rows = {h: row for row, h in enumerate(hashes[:num_rows])}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _append(self, hashes: list[str], embeddings: np.ndarray):
+        if self._dim is None:
+            self._dim = embeddings.shape[1]
+            tmp_path = f"{self._meta_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"dim": self._dim}, f)
+            os.replace(tmp_path, self._meta_path)
+        elif embeddings.shape[1] != self._dim:
+            raise ValueError(
+                f"Embeddings of dimension {embeddings.shape[1]} do not match the cache, "
+                f"which has dimension {self._dim}"
+            )
+        with open(self._embeddings_path, "ab") as f:
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+        with open(self._hashes_path, "a") as f:
+            f.writelines(f"{h}\n" for h in hashes)
+        for h in hashes:
+            self._rows[h] = len(self._rows)
+
+    def embeddings(self) -> np.ndarray:
+        if not self._rows or self._dim is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.memmap(
+            self._embeddings_path,
+            dtype=np.float32,
+            mode="r",
+            shape=(len(self._rows), self._dim),
         )
-        print(f"produced by {trimmed_sentences[smallest_position]['model']}")
-        print(f"with cosine similarity of {smallest:.3f}")
-        print()
 
-    cos_sim_adjacent = []
-    for i in range(len(trimmed_cos_sim_matrix) - 1):
-        cos_sim_adjacent.append(trimmed_cos_sim_matrix[i][i + 1])
+    def get_or_encode(
+        self,
+        questions: list[str],
+        encode: Callable[[list[str]], np.ndarray],
+        batch_size: int = 256,
+    ) -> np.ndarray:
+        """Encode the questions that are not cached yet, in batches.
 
-    series = []
-    for i in range(len(cos_sim_adjacent) - 1):
-        series.append(cos_sim_adjacent[i + 1] - cos_sim_adjacent[i])
+        Args:
+            questions (list[str]): Questions to get embeddings for.
+            encode (Callable[[list[str]], np.ndarray]): Function that returns normalized embeddings.
+            batch_size (int, optional): Number of questions to encode at a time. Defaults to 256.
 
-    # Start of Selection
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
+        Returns:
+            np.ndarray: Row index of each question into `embeddings()`.
+        """
+        hashes = [question_hash(q) for q in questions]
+        missing: dict[str, str] = {}
+        for h, q in zip(hashes, questions, strict=True):
+            if h not in self._rows:
+                missing[h] = q
 
-    # Start of Selection
-    ax1.plot(series)
-    ax1.plot(cos_sim_adjacent)
-    window_size = 5
-    moving_avg = np.convolve(
-        cos_sim_adjacent, np.ones(window_size) / window_size, mode="valid"
+        missing_items = list(missing.items())
+        for start in range(0, len(missing_items), batch_size):
+            batch = missing_items[start : start + batch_size]
+            self._append([h for h, _ in batch], encode([q for _, q in batch]))
+            logger.info(
+                f"Encoded {min(start + batch_size, len(missing_items))}/{len(missing_items)} new questions"
+            )
+
+        return np.array([self._rows[h] for h in hashes], dtype=np.int64)
+
+
+def get_encoder(embedder: str) -> Callable[[list[str]], np.ndarray]:
+    if embedder == "hashing":
+        from commons.similarity import hash_embed
+
+        return lambda batch: np.stack([hash_embed(q) for q in batch])
+
+    @functools.cache
+    def load_model():
+        # only import and load once there are questions to encode, since it is slow
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(SENTENCE_TRANSFORMER_MODEL)
+
+    return lambda batch: load_model().encode(
+        batch, batch_size=len(batch), normalize_embeddings=True
+    )
+
+
+def topk_similar(
+    embeddings: np.ndarray, k: int, block_size: int = 1024
+) -> tuple[np.ndarray, np.ndarray]:
+    """Find the k most similar other rows for each row, by cosine similarity.
+
+    Similarities are computed one (block_size x block_size) block at a time, keeping a running
+    top-k per row, so memory stays O(n * k + block_size^2).
+
+    Args:
+        embeddings (np.ndarray): Normalized embeddings of shape (n, dim).
+        k (int): Number of neighbours to find per row.
+        block_size (int, optional): Number of rows per block. Defaults to 1024.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Indices and similarities of shape (n, k), sorted by
+        decreasing similarity. Missing neighbours (when n <= k) have index -1.
+    """
+    n = len(embeddings)
+    top_indices = np.full((n, k), -1, dtype=np.int64)
+    top_scores = np.full((n, k), -np.inf, dtype=np.float32)
+
+    for row_start in range(0, n, block_size):
+        row_end = min(row_start + block_size, n)
+        rows = np.asarray(embeddings[row_start:row_end], dtype=np.float32)
+        best_indices = top_indices[row_start:row_end]
+        best_scores = top_scores[row_start:row_end]
+
+        for col_start in range(0, n, block_size):
+            col_end = min(col_start + block_size, n)
+            cols = np.asarray(embeddings[col_start:col_end], dtype=np.float32)
+            scores = rows @ cols.T
+            # exclude each row's similarity with itself
+            overlap_start, overlap_end = (
+                max(row_start, col_start),
+                min(row_end, col_end),
+            )
+            diagonal = np.arange(overlap_start, overlap_end)
+            scores[diagonal - row_start, diagonal - col_start] = -np.inf
+
+            col_indices = np.broadcast_to(np.arange(col_start, col_end), scores.shape)
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            merged_indices = np.concatenate([best_indices, col_indices], axis=1)
+            keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+            best_indices = np.take_along_axis(merged_indices, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        top_scores[row_start:row_end] = np.take_along_axis(best_scores, order, axis=1)
+        top_indices[row_start:row_end] = np.take_along_axis(best_indices, order, axis=1)
+
+    top_indices[~np.isfinite(top_scores)] = -1
+    return top_indices, top_scores
+
+
+def adjacent_similarities(embeddings: np.ndarray) -> np.ndarray:
+    """Cosine similarity between each question and the next one, in generation order."""
+    if len(embeddings) < 2:
+        return np.zeros(0, dtype=np.float32)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return np.einsum("ij,ij->i", embeddings[:-1], embeddings[1:])
+
+
+def report_model(
+    sentences: list[dict],
+    embeddings: np.ndarray,
+    prompt_model: str,
+    top_k: int,
+    threshold: float,
+    plot: bool,
+):
+    n = len(sentences)
+    logger.info(f"Analysing {n} questions produced by {prompt_model}")
+    if n < 2:
+        return
+
+    indices, scores = topk_similar(embeddings, min(top_k, n - 1))
+    num_similar = 0
+    for i in np.argsort(-scores[:, 0]):
+        if scores[i, 0] < threshold:
+            break
+        num_similar += 1
+        neighbour = indices[i, 0]
+        print(f"The prompt: \n {sentences[i]['question']}")
+        print(f"is most similar to the prompt: \n {sentences[neighbour]['question']}")
+        print(f"with cosine similarity of {scores[i, 0]:.3f}")
+        print()
+
+    cos_sim_adjacent = adjacent_similarities(embeddings)
+    print(
+        f"{num_similar}/{n} prompts have a neighbour with cosine similarity >= {threshold}"
     )
-    ax1.axhline(
-        y=np.mean(cos_sim_adjacent), color="blue", linewidth=2
-    )  # Add a bold horizontal line at the simple moving average of last 5 points
+    print(f"Mean of nearest neighbour cosine similarity: {np.mean(scores[:, 0]):.3f}")
     print(
-        f"Mean of cosine similarity for {len(cos_sim_adjacent)} : {np.mean(cos_sim_adjacent)}"
+        f"Mean of cosine similarity for {len(cos_sim_adjacent)} adjacent prompts: {np.mean(cos_sim_adjacent):.3f}"
     )
 
-    ax1.plot(moving_avg, label="Moving Average")
-    ax1.legend()
-    ax1.set_xlabel("Instruction Iterations")
-
-    # Highlight negative points in red
-    negative_points = [i for i, value in enumerate(series) if value < 0]
-    ax1.plot(negative_points, [series[i] for i in negative_points], "ro")
+    if plot:
+        _plot_adjacent_similarities(cos_sim_adjacent, prompt_model)
 
-    ax1.set_ylabel("Value")
-    ax1.set_title("Timeseries Plot")
-    ax1.grid(True)
-    ax1.axhline(y=0, color="black", linewidth=2)  # Add a bold horizontal line at y=0
 
-    im = ax2.imshow(trimmed_cos_sim_matrix, cmap="viridis")
-    fig.colorbar(im, ax=ax2, label="Cosine Similarity")
+def _plot_adjacent_similarities(cos_sim_adjacent: np.ndarray, prompt_model: str):
+    import matplotlib.pyplot as plt
 
-    # Add labels for each sentence
-    labels = [f"{trimmed_sentences[i]['model']}" for i in range(len(trimmed_sentences))]
-    ax2.set_xticks(range(len(labels)))
-    ax2.set_xticklabels(labels, rotation=90)
-    ax2.set_yticks(range(len(labels)))
-    ax2.set_yticklabels(labels)
+    series = np.diff(cos_sim_adjacent)
+    _, ax = plt.subplots(figsize=(16, 6))
+    ax.plot(series)
+    ax.plot(cos_sim_adjacent)
+    window_size = 5
+    if len(cos_sim_adjacent) >= window_size:
+        moving_avg = np.convolve(
+            cos_sim_adjacent, np.ones(window_size) / window_size, mode="valid"
+        )
+        ax.plot(moving_avg, label="Moving Average")
+    ax.axhline(y=np.mean(cos_sim_adjacent), color="blue", linewidth=2)
 
-    ax2.set_xlabel("Models")
-    ax2.set_ylabel("Models")
-    ax2.set_title("Cosine Similarity Matrix")
+    # Highlight negative points in red
+    negative_points = np.flatnonzero(series < 0)
+    ax.plot(negative_points, series[negative_points], "ro")
 
+    ax.legend()
+    ax.set_xlabel("Instruction Iterations")
+    ax.set_ylabel("Value")
+    ax.set_title(f"Timeseries Plot ({prompt_model})")
+    ax.grid(True)
+    ax.axhline(y=0, color="black", linewidth=2)
     plt.tight_layout()
     plt.show()
 
 
-for prompt_model in set(GENERATOR_MODELS):
-    process_cos_sim_matrix(sentences, prompt_model)
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find similar generated questions, per question generator model"
+    )
+    parser.add_argument("--directory", type=str, default=DEFAULT_DIRECTORY)
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR)
+    parser.add_argument(
+        "--embedder",
+        type=str,
+        choices=["sentence-transformer", "hashing"],
+        default="sentence-transformer",
+    )
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.9,
+        help="Print prompts with a neighbour at least this similar",
+    )
+    parser.add_argument(
+        "--models",
+        nargs="*",
+        default=None,
+        help="Question models to analyse, defaults to GENERATOR_MODELS",
+    )
+    parser.add_argument("--plot", action="store_true")
+    args = parser.parse_args()
+
+    sentences = load_questions(args.directory)
+    cache = EmbeddingCache(args.cache_dir, args.embedder)
+    rows = cache.get_or_encode(
+        [s["question"] for s in sentences],
+        get_encoder(args.embedder),
+        batch_size=args.batch_size,
+    )
+    embeddings = cache.embeddings()
+
+    for prompt_model in set(args.models or GENERATOR_MODELS):
+        selected = [i for i, s in enumerate(sentences) if s["model"] == prompt_model]
+        report_model(
+            [sentences[i] for i in selected],
+            embeddings[rows[selected]],
+            prompt_model,
+            top_k=args.top_k,
+            threshold=args.threshold,
+            plot=args.plot,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+export_history.py
+
+Streams the history of QA pairs out of the cache into a Parquet or JSONL file, for analysis and
+offline training.
+
+- history entries are read in pages over the history index, each page in one round trip for the
+  payloads, so the keyspace is never scanned and the next page is fetched while the current one
+  is written
+- rows are written as each page arrives, one Parquet row group or a block of JSONL lines per
+  page, so memory stays bounded by the page size whatever the size of the history
+- there is one row per response, with the prompt, persona, topic, strategy, question model,
+  answer model, ground truth and files of the response as columns
+
+usage:
+    python -m commons.data_analysis.export_history --output history.parquet
+    python -m commons.data_analysis.export_history --output history.jsonl --topic GAMES --since 1730000000
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from typing import Any
+
+from loguru import logger
+
+from commons.cache import CacheBackend, HistoryEntry, get_cache
+from commons.cache.codec import get_codec
+from commons.utils.serialization import dumps, loads
+
+# log the progress of the export this often
+PROGRESS_INTERVAL_SEC = 10.0
+
+
+def history_rows(entry: HistoryEntry) -> list[dict[str, Any]]:
+    """Rows of a history entry, one per response, and a row without a response if it has none."""
+    qa_pair = loads(get_codec().decode(entry.value))  # type: ignore
+    shared = {
+        "id": entry.id,
+        "created_at": entry.created_at,
+        "topic": qa_pair.get("topic"),
+        "strategy": (qa_pair.get("metadata") or {}).get("augment_type"),
+        "persona": qa_pair.get("persona"),
+        "prompt": qa_pair.get("prompt"),
+        "question_model": qa_pair.get("question_model"),
+    }
+    ground_truth = qa_pair.get("ground_truth") or {}
+    responses = qa_pair.get("responses") or [{}]
+    return [
+        shared
+        | {
+            "cid": response.get("cid"),
+            "model": response.get("model"),
+            "ground_truth": ground_truth.get(response.get("cid")),
+            "files": (response.get("completion") or {}).get("files") or [],
+        }
+        for response in responses
+    ]
+
+
+class JsonlWriter:
+    def __init__(self, path: str):
+        self._file = open(path, "wb")
+
+    def write(self, rows: list[dict[str, Any]]):
+        self._file.write(b"".join(dumps(row) + b"\n" for row in rows))
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """Writes each batch of rows as a row group, files are a list of structs."""
+
+    def __init__(self, path: str, compression: str):
+        # offline only dependency, install with `pip install .[export]`
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        file_type = pa.struct(
+            [
+                ("filename", pa.string()),
+                ("content", pa.string()),
+                ("language", pa.string()),
+            ]
+        )
+        self._schema = pa.schema(
+            [
+                ("id", pa.string()),
+                ("created_at", pa.float64()),
+                ("topic", pa.string()),
+                ("strategy", pa.string()),
+                ("persona", pa.string()),
+                ("prompt", pa.string()),
+                ("question_model", pa.string()),
+                ("cid", pa.string()),
+                ("model", pa.string()),
+                ("ground_truth", pa.int64()),
+                ("files", pa.list_(file_type)),
+            ]
+        )
+        self._writer = pq.ParquetWriter(path, self._schema, compression=compression)
+
+    def write(self, rows: list[dict[str, Any]]):
+        self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+async def export_history(
+    cache: CacheBackend,
+    writer: JsonlWriter | ParquetWriter,
+    batch_size: int = 128,
+    **filters,
+) -> tuple[int, int]:
+    """Write the history entries matching `filters` with `writer`, newest first.
+
+    Args:
+        cache (CacheBackend): Cache to read the history from.
+        writer (JsonlWriter | ParquetWriter): Where to write the rows.
+        batch_size (int, optional): Number of history entries per page. Defaults to 128.
+        **filters: Filters of `CacheBackend.query_history`, e.g. topic or since.
+
+    Returns:
+        tuple[int, int]: Number of history entries and of rows written.
+    """
+    num_entries = num_rows = 0
+    start_time = last_log_time = time.monotonic()
+
+    def fetch(cursor: str | None):
+        return asyncio.create_task(
+            cache.query_history(
+                limit=batch_size, cursor=cursor, with_values=True, **filters
+            )
+        )
+
+    next_page = fetch(None)
+    try:
+        while next_page is not None:
+            entries, cursor = await next_page
+            # fetch the next page while this one is decoded and written
+            next_page = fetch(cursor) if cursor is not None else None
+            rows = [row for entry in entries for row in history_rows(entry)]
+            if rows:
+                writer.write(rows)
+            num_entries += len(entries)
+            num_rows += len(rows)
+
+            if time.monotonic() - last_log_time >= PROGRESS_INTERVAL_SEC:
+                last_log_time = time.monotonic()
+                logger.info(
+                    f"Exported {num_entries} entries, "
+                    f"{num_entries / (last_log_time - start_time):.0f} entries/s"
+                )
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+    return num_entries, num_rows
+
+
+async def main_async(args):
+    cache = get_cache(args.backend)
+    # skip parsing the CLI args of the service, nothing is dequeued
+    cache.history_ttl_ms = 0
+    if args.format == "parquet":
+        writer = ParquetWriter(args.output, args.compression)
+    else:
+        writer = JsonlWriter(args.output)
+
+    start_time = time.perf_counter()
+    try:
+        num_entries, num_rows = await export_history(
+            cache,
+            writer,
+            batch_size=args.batch_size,
+            topic=args.topic,
+            model=args.model,
+            strategy=args.strategy,
+            since=args.since,
+            until=args.until,
+        )
+    finally:
+        writer.close()
+        await cache.close()
+
+    elapsed = time.perf_counter() - start_time
+    size_mb = os.path.getsize(args.output) / 1e6
+    logger.success(
+        f"Exported {num_entries} entries ({num_rows} rows) to {args.output} in {elapsed:.1f}s: "
+        f"{num_entries / elapsed:.0f} entries/s, {size_mb / elapsed:.1f} MB/s, {size_mb:.1f} MB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the history of QA pairs to Parquet or JSONL"
+    )
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument(
+        "--format",
+        choices=["parquet", "jsonl"],
+        default=None,
+        help="Defaults to the extension of --output",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["redis", "sqlite"],
+        default=None,
+        help="Cache backend to export from, defaults to CACHE_BACKEND",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=128,
+        help="History entries per page, also the Parquet row group size",
+    )
+    parser.add_argument("--compression", type=str, default="zstd")
+    parser.add_argument("--topic", type=str, default=None)
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--strategy", type=str, default=None)
+    parser.add_argument("--since", type=float, default=None, help="Unix timestamp")
+    parser.add_argument("--until", type=float, default=None, help="Unix timestamp")
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = "jsonl" if args.output.endswith(".jsonl") else "parquet"
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,238 @@
+import argparse
+import bisect
+import mmap
+import os
 import random
+import struct
+import tempfile
 
-from datasets import load_dataset
+import numpy as np
+from loguru import logger
+
+from commons.config import get_settings
 
-persona_dataset = None
-persona_length = None
 """
 personas.py
 
 this file loads persona data from huggingface. The personas are randomly selected and used in prompt generation.
+
+The personas are kept inside of a `PersonaStore`, which references the UTF-8 bytes and offsets of the
+dataset's Arrow column directly. Since huggingface datasets memory-maps its Arrow cache files, the
+persona strings are never materialized as python objects, and the pages are shared between processes.
+
+To avoid downloading the dataset on startup, the personas can be exported to a local snapshot file:
+    python -m commons.dataset.personas --output commons/dataset/personas.bin
+
+Snapshot format (little-endian):
+    header: magic (8 bytes) | version (u32) | reserved (u32) | number of personas N (u64)
+    offsets: N + 1 x u64, byte offsets of each persona into the data section
+    data: UTF-8 encoded personas, concatenated
 """
 
+HF_DATASET_PATH = "sasuke-uchiha-13/phub"
+HF_DATASET_NAME = "persona"
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SNAPSHOT_PATH = os.path.join(FILE_DIR, "personas.bin")
+
+SNAPSHOT_MAGIC = b"DOJOPERS"
+SNAPSHOT_VERSION = 1
+_snapshot_header = struct.Struct("<8sIIQ")
 
-def load_persona_dataset():
-    global persona_dataset, persona_length
-    if persona_dataset is None:
-        ds = load_dataset(
-            "sasuke-uchiha-13/phub", "persona", split="train", streaming=False
-        )
-        persona_dataset = list(ds)
-    persona_length = len(persona_dataset)
-    # print(persona_dataset["persona"][0], persona_length)
-    return list(persona_dataset)
 
+class PersonaStore:
+    """Read-only store of strings, backed by chunks of (offsets, UTF-8 data) buffers,
+    which is the same layout as an Arrow string column.
+    """
 
-def get_random_persona():
+    def __init__(self, chunks: list[tuple[np.ndarray, memoryview]]):
+        self._chunks = chunks
+        # index of the first string of each chunk, used to find the chunk of an index
+        self._chunk_starts: list[int] = []
+        num_strings = 0
+        for offsets, _ in chunks:
+            self._chunk_starts.append(num_strings)
+            num_strings += len(offsets) - 1
+        self._length = num_strings
+
+    @classmethod
+    def from_arrow(cls, column) -> "PersonaStore":
+        """Build the store from a pyarrow (Chunked)Array of strings without copying the data.
+
+        Args:
+            column (pyarrow.ChunkedArray | pyarrow.Array): Column of type string or large_string.
+
+        Returns:
+            PersonaStore: Store referencing the column's buffers.
+        """
+        arrays = column.chunks if hasattr(column, "chunks") else [column]
+        chunks: list[tuple[np.ndarray, memoryview]] = []
+        for array in arrays:
+            if len(array) == 0:
+                continue
+            offset_dtype = np.int64 if "large" in str(array.type) else np.int32
+            _, offsets_buf, data_buf = array.buffers()
+            offsets = np.frombuffer(
+                offsets_buf,
+                dtype=offset_dtype,
+                count=len(array) + 1,
+                offset=array.offset * np.dtype(offset_dtype).itemsize,
+            )
+            data = memoryview(data_buf) if data_buf is not None else memoryview(b"")
+            chunks.append((offsets, data))
+        return cls(chunks)
+
+    @classmethod
+    def from_snapshot(cls, path: str) -> "PersonaStore":
+        """Memory-map a snapshot file written by `write_snapshot`.
+
+        Args:
+            path (str): Path to the snapshot file.
+
+        Raises:
+            ValueError: If the file is not a persona snapshot, or has an unsupported version.
+
+        Returns:
+            PersonaStore: Store referencing the memory-mapped file.
+        """
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, num_personas = _snapshot_header.unpack_from(mapped, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a persona snapshot file: {path}")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported persona snapshot version: {version}")
+
+        offsets = np.frombuffer(
+            mapped, dtype="<u8", count=num_personas + 1, offset=_snapshot_header.size
+        )
+        data_start = _snapshot_header.size + offsets.nbytes
+        data = memoryview(mapped)[data_start:]
+        return cls([(offsets, data)])
+
+    def write_snapshot(self, path: str):
+        """Write all personas into a snapshot file, the file is replaced atomically."""
+        # unique per writer, so that processes writing the same snapshot do not interleave
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path) or ".",
+            prefix=f"{os.path.basename(path)}.",
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            try:
+                f.write(
+                    _snapshot_header.pack(
+                        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, self._length
+                    )
+                )
+                # rebase the offsets of each chunk onto the concatenated data section
+                base = 0
+                f.write(np.zeros(1, dtype="<u8").tobytes())
+                for offsets, _ in self._chunks:
+                    rebased = offsets[1:].astype("<u8") - int(offsets[0]) + base
+                    f.write(rebased.tobytes())
+                    base += int(offsets[-1]) - int(offsets[0])
+                for offsets, data in self._chunks:
+                    f.write(data[int(offsets[0]) : int(offsets[-1])])
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                os.remove(f.name)
+                raise
+        # temporary files are only readable by their owner
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(f"Persona index out of range: {index}")
+
+        chunk_idx = bisect.bisect_right(self._chunk_starts, index) - 1
+        offsets, data = self._chunks[chunk_idx]
+        local_idx = index - self._chunk_starts[chunk_idx]
+        start, end = int(offsets[local_idx]), int(offsets[local_idx + 1])
+        return str(data[start:end], "utf-8")
+
+    def random(self, rng: random.Random | None = None) -> str:
+        return self[(rng or random).randrange(self._length)]
+
+
+persona_store: PersonaStore | None = None
+
+
+def _get_snapshot_path() -> str:
+    return get_settings().generation.persona_snapshot_path or DEFAULT_SNAPSHOT_PATH
+
+
+def _load_hf_persona_store() -> PersonaStore:
+    # only import datasets when needed, since it is slow to import
+    from datasets import load_dataset
+
+    ds = load_dataset(HF_DATASET_PATH, HF_DATASET_NAME, split="train", streaming=False)
+    # reference the underlying Arrow column instead of converting each row to a dict
+    return PersonaStore.from_arrow(ds.data.table.column("persona"))
+
+
+def load_persona_dataset() -> PersonaStore:
+    global persona_store
+    if persona_store is not None:
+        return persona_store
+
+    snapshot_path = _get_snapshot_path()
+    if os.path.exists(snapshot_path):
+        persona_store = PersonaStore.from_snapshot(snapshot_path)
+        logger.info(f"Loaded {len(persona_store)} personas from {snapshot_path}")
+        return persona_store
+
+    logger.info(f"No persona snapshot at {snapshot_path}, loading from huggingface")
+    persona_store = _load_hf_persona_store()
+    logger.info(f"Loaded {len(persona_store)} personas")
+    try:
+        # write the snapshot so that subsequent startups don't need the network
+        persona_store.write_snapshot(snapshot_path)
+        logger.info(f"Wrote persona snapshot to {snapshot_path}")
+    except OSError as exc:
+        logger.warning(f"Failed to write persona snapshot to {snapshot_path}: {exc}")
+    return persona_store
+
+
+def get_random_persona(rng: random.Random | None = None):
     """
     Return a random persona from the given persona dataset as a string.
 
+    Args:
+        rng (random.Random | None, optional): RNG to sample with. Defaults to the `random` module.
+
     Returns:
         str: A randomly selected persona as a string of traits.
     """
-    global persona_dataset, persona_length
-
-    if persona_dataset is None or persona_length is None:
+    if persona_store is None or len(persona_store) == 0:
         raise ValueError("Persona dataset not loaded.")
 
-    random_index = random.randint(0, persona_length - 1)
-
-    persona = persona_dataset[random_index]
-
-    return persona["persona"]
+    return persona_store.random(rng)
 
 
-# # main function for testing
-# async def main():
-#     # load persona dataset then print a random persona
-#     load_persona_dataset()
-#     random_persona = get_random_persona()
-#     print("Random Persona:", random_persona)
-#     # print(random_persona)
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the huggingface persona dataset into a local snapshot file"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=_get_snapshot_path(),
+        help="Path to write the snapshot file to",
+    )
+    args = parser.parse_args()
 
+    store = _load_hf_persona_store()
+    store.write_snapshot(args.output)
+    logger.info(f"Exported {len(store)} personas to {args.output}")
 
-# if __name__ == "__main__":
-#     import asyncio
 
-#     asyncio.run(main())
+if __name__ == "__main__":
+    main()
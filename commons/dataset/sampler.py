@@ -0,0 +1,249 @@
+"""
+sampler.py
+
+Diversity aware sampling of personas and topics, used in prompt generation.
+
+Instead of sampling with replacement, which produces repeated personas and topics across
+QA pairs, items are picked by cycling through a shuffled permutation without replacement.
+The position in the permutation is a shared counter in the cache, so that all workers and
+processes walk the same permutation, and each epoch through the items uses a new shuffle.
+
+Sampling modes (`generation.sampling_mode` in settings):
+- "random": sample with replacement, the previous behaviour
+- "cycle": cycle through a shuffled permutation of all personas
+- "cluster": round-robin between persona clusters, cycling through the personas within each cluster.
+    Cluster labels are computed offline from persona embeddings:
+    python -m commons.dataset.sampler --num-clusters 64
+
+Random choices, and the shuffle seeds of new permutations, are drawn from `get_sampling_rng`, so
+they are the same when recording and replaying LLM responses.
+"""
+
+import argparse
+import os
+import random
+
+import numpy as np
+from loguru import logger
+
+from commons.cache import get_cache
+from commons.config import get_settings
+from commons.dataset.personas import (
+    FILE_DIR,
+    PersonaStore,
+    get_random_persona,
+    load_persona_dataset,
+)
+from commons.llm.response_cache import get_sampling_rng
+from commons.types import Topics
+
+# change weights accordingly to choose what topic of Tasks to generate.
+TOPIC_WEIGHTS: dict[Topics, float] = {
+    Topics.ANIMATION: 0.45,
+    Topics.SCIENCE: 0.3,
+    Topics.GAMES: 0.25,
+}
+# number of slots in one cycle of topics, each topic gets a share of slots based on its weight
+TOPIC_CYCLE_SIZE = 20
+DEFAULT_CLUSTERS_PATH = os.path.join(FILE_DIR, "persona_clusters.npy")
+
+
+class PermutationCycler:
+    """Cycles through the indices [0, size) in a shuffled order without replacement.
+
+    The shuffle seed and cursor are stored in the cache so that the same permutation is shared
+    by all workers, only the cursor needs to be incremented to pick the next item.
+    """
+
+    def __init__(self, name: str, size: int):
+        if size <= 0:
+            raise ValueError(f"Cannot cycle through {size} items")
+        self.size = size
+        cache = get_cache()
+        # include the size in the key, so that a different dataset starts a new cycle
+        self._cursor_key = cache.build_key("sampler", name, str(size), "cursor")
+        self._seed_key = cache.build_key("sampler", name, str(size), "seed")
+        self._seed: int | None = None
+        self._epoch: int | None = None
+        self._permutation: np.ndarray | None = None
+
+    async def _get_seed(self) -> int:
+        if self._seed is None:
+            cache = get_cache()
+            seed = get_sampling_rng("sampler", self._seed_key).getrandbits(32)
+            await cache.set_value(self._seed_key, seed, nx=True)
+            self._seed = int(await cache.get_value(self._seed_key))  # type: ignore
+        return self._seed
+
+    def _get_permutation(self, seed: int, epoch: int) -> np.ndarray:
+        if self._epoch != epoch or self._permutation is None:
+            rng = np.random.default_rng([seed, epoch])
+            self._permutation = rng.permutation(self.size)
+            self._epoch = epoch
+        return self._permutation
+
+    async def next(self) -> int:
+        seed = await self._get_seed()
+        cursor = await get_cache().incr(self._cursor_key) - 1
+        epoch, position = divmod(cursor, self.size)
+        return int(self._get_permutation(seed, epoch)[position])
+
+
+class DiversitySampler:
+    def __init__(
+        self,
+        store: PersonaStore,
+        mode: str,
+        cluster_labels: np.ndarray | None = None,
+    ):
+        self.store = store
+        self.mode = mode
+
+        topics = list(TOPIC_WEIGHTS.keys())
+        slot_counts = [
+            max(1, round(weight * TOPIC_CYCLE_SIZE))
+            for weight in TOPIC_WEIGHTS.values()
+        ]
+        self._topic_slots: list[Topics] = [
+            topic
+            for topic, count in zip(topics, slot_counts, strict=True)
+            for _ in range(count)
+        ]
+        self._topic_cycler = PermutationCycler("topic", len(self._topic_slots))
+        self._persona_cycler = PermutationCycler("persona", len(store))
+
+        self._cluster_members: list[np.ndarray] = []
+        if mode == "cluster":
+            if cluster_labels is None or len(cluster_labels) != len(store):
+                raise ValueError(
+                    "Cluster sampling requires one cluster label per persona"
+                )
+            self._cluster_members = [
+                np.flatnonzero(cluster_labels == label)
+                for label in np.unique(cluster_labels)
+            ]
+            self._cluster_cycler = PermutationCycler(
+                "persona_cluster", len(self._cluster_members)
+            )
+            self._member_cyclers = [
+                PermutationCycler(f"persona_cluster_{i}", len(members))
+                for i, members in enumerate(self._cluster_members)
+            ]
+
+    async def next_persona(self) -> str:
+        if self.mode == "cycle":
+            return self.store[await self._persona_cycler.next()]
+        if self.mode == "cluster":
+            cluster = await self._cluster_cycler.next()
+            member = await self._member_cyclers[cluster].next()
+            return self.store[int(self._cluster_members[cluster][member])]
+        return self.store.random(_get_rng())
+
+    async def next_topic(self) -> Topics:
+        if self.mode in ("cycle", "cluster"):
+            return self._topic_slots[await self._topic_cycler.next()]
+        return _random_topic()
+
+
+_sampler: DiversitySampler | None = None
+_rng: random.Random | None = None
+
+
+def _get_rng() -> random.Random:
+    global _rng
+    if _rng is None:
+        _rng = get_sampling_rng("sampler")
+    return _rng
+
+
+def _random_topic() -> Topics:
+    return _get_rng().choices(
+        list(TOPIC_WEIGHTS.keys()), weights=list(TOPIC_WEIGHTS.values()), k=1
+    )[0]
+
+
+def _get_clusters_path() -> str:
+    return get_settings().generation.persona_clusters_path or DEFAULT_CLUSTERS_PATH
+
+
+def get_sampler() -> DiversitySampler:
+    global _sampler
+    if _sampler is None:
+        mode = get_settings().generation.sampling_mode
+        cluster_labels = None
+        if mode == "cluster":
+            clusters_path = _get_clusters_path()
+            if os.path.exists(clusters_path):
+                cluster_labels = np.load(clusters_path, mmap_mode="r")
+            else:
+                logger.warning(
+                    f"No persona clusters found at {clusters_path}, falling back to cycle sampling"
+                )
+                mode = "cycle"
+        _sampler = DiversitySampler(load_persona_dataset(), mode, cluster_labels)
+        logger.info(f"Using {mode} sampling for personas and topics")
+    return _sampler
+
+
+async def sample_persona() -> str:
+    """Sample the next persona, falls back to random sampling if the cache is unavailable."""
+    try:
+        return await get_sampler().next_persona()
+    except Exception as exc:
+        logger.warning(f"Failed to sample persona, using a random persona: {exc}")
+        return get_random_persona(_get_rng())
+
+
+async def sample_topic() -> Topics:
+    """Sample the next topic, falls back to random sampling if the cache is unavailable."""
+    try:
+        return await get_sampler().next_topic()
+    except Exception as exc:
+        logger.warning(f"Failed to sample topic, using a random topic: {exc}")
+        return _random_topic()
+
+
+def build_persona_clusters(
+    store: PersonaStore, num_clusters: int, batch_size: int = 1024
+) -> np.ndarray:
+    """Cluster the personas based on their sentence embeddings.
+
+    Args:
+        store (PersonaStore): Personas to cluster.
+        num_clusters (int): Number of clusters.
+        batch_size (int, optional): Number of personas to encode at a time. Defaults to 1024.
+
+    Returns:
+        np.ndarray: Cluster label of each persona.
+    """
+    # offline only dependencies, same as data_analysis
+    from sentence_transformers import SentenceTransformer
+    from sklearn.cluster import MiniBatchKMeans
+
+    model = SentenceTransformer("all-MiniLM-L6-v2")
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, batch_size=batch_size)
+    embeddings = []
+    for start in range(0, len(store), batch_size):
+        batch = [store[i] for i in range(start, min(start + batch_size, len(store)))]
+        embeddings.append(model.encode(batch, normalize_embeddings=True))
+        logger.info(f"Encoded {start + len(batch)}/{len(store)} personas")
+
+    kmeans.fit(np.concatenate(embeddings))
+    return kmeans.labels_.astype(np.int32)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cluster personas by embeddings for cluster sampling"
+    )
+    parser.add_argument("--num-clusters", type=int, default=64)
+    parser.add_argument("--output", type=str, default=_get_clusters_path())
+    args = parser.parse_args()
+
+    labels = build_persona_clusters(load_persona_dataset(), args.num_clusters)
+    np.save(args.output, labels)
+    logger.info(f"Saved {args.num_clusters} persona clusters to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ linter.py:
 
 import subprocess
 
+from bs4 import BeautifulSoup
 from loguru import logger
 from pydantic import BaseModel, Field
 
@@ -32,9 +33,10 @@ def setup_linting():
         return False
 
 
-def lint_code(code: str, id: str) -> LintResult:
+def lint_code(code: str, id: str, source_type: str | None = None) -> LintResult:
     """
     calls ESLint on the input code and returns the result as a LintResult object.
+    source_type can be set to "module" to lint ES modules, which allow import statements.
     """
     try:
         # Check if eslint is installed
@@ -46,13 +48,16 @@ def lint_code(code: str, id: str) -> LintResult:
         )
         if npm_check.returncode != 0:
             setup_linting()
+        eslint_cmd = [
+            "npx",
+            "eslint",
+            "--quiet",  # only report errors, ignore warnings
+            "--stdin",  # read from stdin instead of default behaviour of files
+        ]
+        if source_type:
+            eslint_cmd.append(f"--parser-options=sourceType:{source_type}")
         result = subprocess.run(
-            [
-                "npx",
-                "eslint",
-                "--quiet",  # only report errors, ignore warnings
-                "--stdin",  # read from stdin instead of default behaviour of files
-            ],
+            eslint_cmd,
             input=code,
             capture_output=True,
             text=True,
@@ -75,6 +80,30 @@ def lint_code(code: str, id: str) -> LintResult:
         )
 
 
+def lint_html_scripts(html_code: str, id: str) -> LintResult:
+    """
+    calls ESLint on each inline script of an HTML file, combining the results into a single LintResult.
+    import maps, JSON data and external scripts are skipped.
+    """
+    soup = BeautifulSoup(html_code, "html.parser")
+    results: list[LintResult] = []
+    for script in soup.find_all("script"):
+        script_type = (script.get("type") or "").lower()
+        if script.get("src") or not script.string:
+            continue
+        if script_type in ("importmap", "application/json", "application/ld+json"):
+            continue
+        source_type = "module" if script_type == "module" else None
+        results.append(lint_code(script.string, id, source_type=source_type))
+
+    return LintResult(
+        return_code=max((result.return_code for result in results), default=0),
+        output="\n".join(result.output for result in results if result.output),
+        error="\n".join(result.error for result in results if result.error),
+        input=html_code,
+    )
+
+
 def main():
     """
     main function used to for isolated testing of linter.py
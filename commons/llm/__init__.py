@@ -1,5 +1,15 @@
+from .hedging import hedged_call as hedged_call
 from .llm_api import Provider as Provider
 from .llm_api import _get_llm_api_kwargs as _get_llm_api_kwargs
+from .llm_api import build_http_client as build_http_client
+from .llm_api import get_async_openai_client as get_async_openai_client
 from .llm_api import get_llm_api_client as get_llm_api_client
 
-__all__ = ["Provider", "_get_llm_api_kwargs", "get_llm_api_client"]
+__all__ = [
+    "Provider",
+    "_get_llm_api_kwargs",
+    "build_http_client",
+    "get_async_openai_client",
+    "get_llm_api_client",
+    "hedged_call",
+]
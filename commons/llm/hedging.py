@@ -0,0 +1,236 @@
+"""
+hedging.py
+
+Hedged and fallback LLM requests, to cut the tail latency of slow providers.
+
+A request is sent to its primary (provider, model). If it has not finished after a delay based
+on the recent latency percentile of that (provider, model), a duplicate request is sent to an
+alternate (provider, model), and whichever succeeds first wins, the other is cancelled.
+If the primary fails before the delay, the alternate is used as a fallback straight away.
+
+Hedges are limited by a budget, where each request earns `budget_ratio` of a hedge, and by a
+maximum number of hedges in flight, so that a slow provider cannot double the load.
+"""
+
+import asyncio
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+import instructor
+import numpy as np
+from loguru import logger
+
+from commons.config import HedgeSettings, get_settings
+from commons.llm.llm_api import Provider, get_llm_api_client
+from commons.metrics import LLM_HEDGES
+
+T = TypeVar("T")
+
+# number of recent latencies kept per (provider, model)
+_LATENCY_WINDOW = 200
+
+
+@dataclass
+class HedgeTarget:
+    provider: Provider
+    model: str
+
+    @classmethod
+    def parse(cls, value: str) -> "HedgeTarget":
+        """Parse "provider:model", e.g. "openrouter:anthropic/claude-3.5-sonnet"."""
+        provider, _, model = value.partition(":")
+        if not model:
+            raise ValueError(
+                f"Invalid hedge alternate: {value}, expected provider:model"
+            )
+        return cls(Provider(provider), model)
+
+    def __str__(self) -> str:
+        return f"{self.provider}:{self.model}"
+
+
+@dataclass
+class HedgeStats:
+    requests: int = 0
+    # duplicate requests sent because the primary was slow
+    hedges: int = 0
+    # hedges that finished before the primary
+    hedge_wins: int = 0
+    # alternate requests sent because the primary failed
+    fallbacks: int = 0
+    fallback_wins: int = 0
+    # hedges that were not sent because the budget was used up
+    skipped: int = 0
+
+    @property
+    def hedge_win_rate(self) -> float:
+        return self.hedge_wins / self.hedges if self.hedges else 0.0
+
+
+class HedgePolicy:
+    def __init__(self, settings: HedgeSettings):
+        self.settings = settings
+        self.alternates = [HedgeTarget.parse(a) for a in settings.alternates]
+        self.stats: dict[str, HedgeStats] = defaultdict(HedgeStats)
+        self._latencies: dict[str, deque[float]] = defaultdict(
+            lambda: deque(maxlen=_LATENCY_WINDOW)
+        )
+        self._budget = settings.budget_burst
+        self._hedges_in_flight = 0
+
+    def hedge_delay(self, target: HedgeTarget) -> float:
+        """Seconds to wait for the primary before sending a hedge."""
+        latencies = self._latencies[str(target)]
+        if len(latencies) < self.settings.min_samples:
+            return self.settings.default_delay_sec
+        delay = float(np.percentile(latencies, self.settings.latency_percentile))
+        return max(self.settings.min_delay_sec, delay)
+
+    def _pick_alternate(self, primary: HedgeTarget) -> HedgeTarget | None:
+        for alternate in self.alternates:
+            if alternate != primary:
+                return alternate
+        return None
+
+    def _take_budget(self) -> bool:
+        if self._budget < 1 or self._hedges_in_flight >= self.settings.max_in_flight:
+            return False
+        self._budget -= 1
+        return True
+
+    async def _timed(
+        self,
+        target: HedgeTarget,
+        client: instructor.AsyncInstructor,
+        fn: Callable[[instructor.AsyncInstructor, str], Awaitable[T]],
+    ) -> T:
+        start_time = time.perf_counter()
+        result = await fn(client, target.model)
+        self._latencies[str(target)].append(time.perf_counter() - start_time)
+        return result
+
+    async def _run_alternate(
+        self,
+        target: HedgeTarget,
+        fn: Callable[[instructor.AsyncInstructor, str], Awaitable[T]],
+    ) -> T:
+        self._hedges_in_flight += 1
+        try:
+            return await self._timed(target, get_llm_api_client(target.provider), fn)
+        finally:
+            self._hedges_in_flight -= 1
+
+    async def run(
+        self,
+        operation: str,
+        client: instructor.AsyncInstructor,
+        primary: HedgeTarget,
+        fn: Callable[[instructor.AsyncInstructor, str], Awaitable[T]],
+    ) -> T:
+        """Run `fn(client, model)` on the primary, hedging or falling back to an alternate.
+
+        Args:
+            operation (str): Name of the operation, used for metrics.
+            client (instructor.AsyncInstructor): Client of the primary provider.
+            primary (HedgeTarget): Primary provider and model.
+            fn (Callable[[instructor.AsyncInstructor, str], Awaitable[T]]): Sends the request
+                with the given client and model, raises if the response is invalid.
+
+        Returns:
+            T: Result of the first request that succeeds.
+
+        Raises:
+            Exception: The error of the primary request, if all requests fail.
+        """
+        stats = self.stats[operation]
+        stats.requests += 1
+        self._budget = min(
+            self.settings.budget_burst, self._budget + self.settings.budget_ratio
+        )
+        alternate = self._pick_alternate(primary)
+        primary_task = asyncio.create_task(self._timed(primary, client, fn))
+        if alternate is None:
+            return await primary_task
+
+        alternate_task: asyncio.Task[T] | None = None
+        try:
+            done, _ = await asyncio.wait(
+                {primary_task}, timeout=self.hedge_delay(primary)
+            )
+            primary_failed = bool(done) and primary_task.exception() is not None
+            if done and not primary_failed:
+                return primary_task.result()
+
+            if primary_failed:
+                stats.fallbacks += 1
+                LLM_HEDGES.labels(operation, "fallback").inc()
+                logger.warning(
+                    f"{operation} failed on {primary}, falling back to {alternate}: {primary_task.exception()}"
+                )
+            elif self._take_budget():
+                stats.hedges += 1
+                LLM_HEDGES.labels(operation, "hedge").inc()
+                logger.info(
+                    f"{operation} on {primary} is slow, hedging with {alternate}"
+                )
+            else:
+                stats.skipped += 1
+                LLM_HEDGES.labels(operation, "skipped").inc()
+                return await primary_task
+
+            alternate_task = asyncio.create_task(self._run_alternate(alternate, fn))
+            pending = {t for t in (primary_task, alternate_task) if not t.done()}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        continue
+                    if task is alternate_task:
+                        if primary_failed:
+                            stats.fallback_wins += 1
+                            LLM_HEDGES.labels(operation, "fallback_win").inc()
+                        else:
+                            stats.hedge_wins += 1
+                            LLM_HEDGES.labels(operation, "hedge_win").inc()
+                    if not primary_failed:
+                        logger.info(
+                            f"{operation} hedge win rate: {stats.hedge_win_rate:.2%} "
+                            f"({stats.hedge_wins}/{stats.hedges} hedges, {stats.requests} requests)"
+                        )
+                    return task.result()
+
+            raise primary_task.exception()  # type: ignore
+        finally:
+            # cancel the loser, or both requests if we were cancelled
+            for task in (primary_task, alternate_task):
+                if task is not None and not task.done():
+                    task.cancel()
+
+
+_hedge_policy: HedgePolicy | None = None
+
+
+def get_hedge_policy() -> HedgePolicy:
+    global _hedge_policy
+    if _hedge_policy is None:
+        _hedge_policy = HedgePolicy(get_settings().hedge)
+    return _hedge_policy
+
+
+async def hedged_call(
+    operation: str,
+    client: instructor.AsyncInstructor,
+    model: str,
+    fn: Callable[[instructor.AsyncInstructor, str], Awaitable[T]],
+    provider: Provider = Provider.OPENROUTER,
+) -> T:
+    """Call `fn(client, model)`, hedged with an alternate provider or model if enabled in settings."""
+    if not get_settings().hedge.enabled:
+        return await fn(client, model)
+    return await get_hedge_policy().run(
+        operation, client, HedgeTarget(provider, model), fn
+    )
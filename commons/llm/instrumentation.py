@@ -0,0 +1,68 @@
+import json
+import time
+
+import httpx
+
+from commons.metrics import LLM_REQUEST_DURATION, LLM_TOKENS
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """httpx transport that records the duration and token usage of LLM API requests.
+
+    Streamed responses do not report usage, so only their duration until the response
+    headers is recorded.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, provider: str):
+        self._transport = transport
+        self._provider = provider
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            body = json.loads(request.content)
+            model = body["model"]
+        except (ValueError, KeyError, TypeError):
+            return await self._transport.handle_async_request(request)
+
+        start_time = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            LLM_REQUEST_DURATION.labels(self._provider, model, "error").observe(
+                time.perf_counter() - start_time
+            )
+            raise
+        if body.get("stream"):
+            LLM_REQUEST_DURATION.labels(
+                self._provider, model, str(response.status_code)
+            ).observe(time.perf_counter() - start_time)
+            return response
+
+        try:
+            raw = b"".join([chunk async for chunk in response.stream])  # type: ignore
+        finally:
+            await response.aclose()
+        LLM_REQUEST_DURATION.labels(
+            self._provider, model, str(response.status_code)
+        ).observe(time.perf_counter() - start_time)
+        response = httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            content=raw,
+            request=request,
+            extensions=response.extensions,
+        )
+        try:
+            usage = json.loads(await response.aread()).get("usage") or {}
+        except (ValueError, AttributeError):
+            usage = {}
+        for token_type, key in (
+            ("input", "prompt_tokens"),
+            ("output", "completion_tokens"),
+        ):
+            if usage.get(key):
+                LLM_TOKENS.labels(self._provider, model, token_type).inc(usage[key])
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
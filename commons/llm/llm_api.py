@@ -1,11 +1,16 @@
+import httpx
 import instructor
 from dotenv import load_dotenv
 from instructor import Mode
 from loguru import logger
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai._constants import DEFAULT_CONNECTION_LIMITS
 from strenum import StrEnum
 
 from commons.config import get_settings
+from commons.llm.instrumentation import InstrumentedTransport
+from commons.llm.rate_limiter import build_rate_limited_transport
+from commons.llm.response_cache import build_cached_transport
 
 load_dotenv()
 
@@ -60,6 +65,52 @@ def _get_llm_api_kwargs(provider: Provider) -> dict[str, str]:
     return kwargs
 
 
+def build_http_client(provider: Provider, **kwargs) -> httpx.AsyncClient:
+    """build the http client used by AsyncOpenAI, where every request is sent
+    through the response cache and the rate limiter of the provider
+
+    Args:
+        provider (Provider): the provider of the llm api
+        **kwargs: additional kwargs for httpx.AsyncClient, e.g. event_hooks
+
+    Returns:
+        httpx.AsyncClient: the http client
+    """
+    # cache hits are served before the rate limiter, so they do not use the rate limits
+    transport = build_cached_transport(
+        build_rate_limited_transport(
+            provider,
+            InstrumentedTransport(
+                httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS), provider
+            ),
+        )
+    )
+    return DefaultAsyncHttpxClient(transport=transport, **kwargs)
+
+
+_http_clients: dict[Provider, httpx.AsyncClient] = {}
+
+
+def get_async_openai_client(provider: Provider = Provider.OPENROUTER) -> AsyncOpenAI:
+    """instantiate an AsyncOpenAI client for raw completions, the underlying http
+    client is shared per provider so that connections are reused
+
+    Args:
+        provider (Provider): the provider of the llm api
+
+    Returns:
+        AsyncOpenAI: the openai client
+    """
+    if provider not in _http_clients:
+        _http_clients[provider] = build_http_client(provider)
+    kwargs = _get_llm_api_kwargs(provider)
+    return AsyncOpenAI(
+        api_key=kwargs["api_key"],
+        base_url=kwargs["base_url"],
+        http_client=_http_clients[provider],
+    )
+
+
 def get_llm_api_client(
     provider: Provider = Provider.OPENROUTER,
 ) -> instructor.AsyncInstructor:
@@ -73,8 +124,4 @@ def get_llm_api_client(
     Returns:
         instructor.AsyncInstructor: the llm api client
     """
-    kwargs = _get_llm_api_kwargs(provider)
-    return instructor.from_openai(
-        AsyncOpenAI(api_key=kwargs["api_key"], base_url=kwargs["base_url"]),
-        mode=Mode.MD_JSON,
-    )
+    return instructor.from_openai(get_async_openai_client(provider), mode=Mode.MD_JSON)
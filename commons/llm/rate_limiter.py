@@ -0,0 +1,460 @@
+"""
+rate_limiter.py
+
+Token bucket rate limiting and concurrency limiting of LLM API requests, per (provider, model).
+
+Each (provider, model) has two token buckets, one for requests per minute and one for tokens per
+minute, and a maximum number of in flight requests. The state lives in redis and is updated by
+lua scripts, so the limits are shared by all workers and uvicorn processes.
+
+- a request is charged the estimated prompt tokens up front. Once the response arrives, the
+  bucket is corrected with the actual usage, and may go into debt which delays later requests.
+  Streamed requests are charged their `max_tokens` as well, and corrected once the stream is
+  closed, with the usage of its last chunk or else the length of the streamed content.
+- while too many requests are in flight, waiters back off exponentially with jitter.
+- rate limit headers from the provider (`x-ratelimit-remaining-*`, `x-ratelimit-reset*`,
+  `retry-after`) lower the buckets or pause the (provider, model) until the limit resets.
+- requests are limited in `RateLimitedTransport`, so every client built by `commons.llm` is limited
+  without changes to the call sites.
+"""
+
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+import httpx
+from loguru import logger
+
+from commons.cache import RedisCache
+from commons.config import RateLimitSettings, get_settings
+
+# wait time in ms returned by the acquire script when too many requests are in flight
+_IN_FLIGHT_FULL = -1
+# how long to wait before checking again for a free in flight slot, doubled on every check
+_IN_FLIGHT_MIN_WAIT_SEC = 0.05
+_IN_FLIGHT_MAX_WAIT_SEC = 1.0
+# pause after a 429 without any header that says when to retry
+_DEFAULT_RETRY_AFTER_SEC = 1.0
+# rough number of characters per token, used to estimate prompt tokens before sending
+_CHARS_PER_TOKEN = 4
+
+_ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local max_in_flight = tonumber(ARGV[3])
+local cost = math.min(tonumber(ARGV[4]), tpm)
+local lease_timeout_ms = tonumber(ARGV[6])
+
+local blocked_until = tonumber(redis.call('HGET', KEYS[1], 'blocked_until') or '0')
+if blocked_until > now then
+    return blocked_until - now
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= max_in_flight then
+    return -1
+end
+
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated_at')
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+local requests = math.min(rpm, (tonumber(state[1]) or rpm) + elapsed * rpm / 60000)
+local tokens = math.min(tpm, (tonumber(state[2]) or tpm) + elapsed * tpm / 60000)
+
+local wait = 0
+if requests < 1 then
+    wait = math.max(wait, (1 - requests) * 60000 / rpm)
+end
+if tokens < cost then
+    wait = math.max(wait, (cost - tokens) * 60000 / tpm)
+end
+if wait == 0 then
+    requests = requests - 1
+    tokens = tokens - cost
+    redis.call('ZADD', KEYS[2], now + lease_timeout_ms, ARGV[5])
+    redis.call('PEXPIRE', KEYS[2], lease_timeout_ms)
+end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'updated_at', now)
+redis.call('PEXPIRE', KEYS[1], math.max(120000, lease_timeout_ms))
+return math.ceil(wait)
+"""
+
+_RELEASE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local debit = tonumber(ARGV[3])
+local remaining_requests = tonumber(ARGV[4])
+local remaining_tokens = tonumber(ARGV[5])
+local pause_ms = tonumber(ARGV[6])
+
+redis.call('ZREM', KEYS[2], ARGV[7])
+
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated_at', 'blocked_until')
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+local requests = math.min(rpm, (tonumber(state[1]) or rpm) + elapsed * rpm / 60000)
+local tokens = math.min(tpm, (tonumber(state[2]) or tpm) + elapsed * tpm / 60000) - debit
+if remaining_requests >= 0 then
+    requests = math.min(requests, remaining_requests)
+end
+if remaining_tokens >= 0 then
+    tokens = math.min(tokens, remaining_tokens)
+end
+local blocked_until = tonumber(state[4]) or 0
+if pause_ms > 0 then
+    blocked_until = math.max(blocked_until, now + pause_ms)
+end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'updated_at', now,
+    'blocked_until', blocked_until)
+return 0
+"""
+
+_duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_duration_units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_reset(value: str | None) -> float | None:
+    """Parse a rate limit reset header into seconds from now.
+
+    Supports durations like "6m0s" or "20ms" (OpenAI, Together), plain seconds,
+    and unix timestamps in seconds or milliseconds (OpenRouter).
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        number = float(value)
+    except ValueError:
+        matches = _duration_pattern.findall(value)
+        if not matches:
+            return None
+        return sum(float(amount) * _duration_units[unit] for amount, unit in matches)
+
+    now = time.time()
+    if number > 1e12:
+        return max(0.0, number / 1000 - now)
+    if number > 1e9:
+        return max(0.0, number - now)
+    return number
+
+
+def _parse_int_header(headers: httpx.Headers, *names: str) -> int:
+    """First header of `names` parsed as an int, -1 if none is present."""
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return int(float(value))
+            except ValueError:
+                continue
+    return -1
+
+
+def _pause_seconds(response: httpx.Response) -> float:
+    """How long the provider asks us to stop sending requests, 0 if it does not."""
+    headers = response.headers
+    remaining_requests = _parse_int_header(
+        headers, "x-ratelimit-remaining-requests", "x-ratelimit-remaining"
+    )
+    if response.status_code != 429 and remaining_requests != 0:
+        return 0.0
+
+    for name in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset"):
+        seconds = _parse_reset(headers.get(name))
+        if seconds is not None:
+            return seconds
+    return _DEFAULT_RETRY_AFTER_SEC
+
+
+def _estimate_prompt_tokens(body: dict) -> int:
+    messages = body.get("messages") or []
+    num_chars = sum(len(str(message.get("content") or "")) for message in messages)
+    return num_chars // _CHARS_PER_TOKEN + 1
+
+
+def _used_tokens(usage: dict, prompt_tokens: int) -> int:
+    """Tokens used by a request according to its usage, `prompt_tokens` is the estimate
+    used if the usage has no prompt tokens.
+    """
+    return (usage.get("prompt_tokens") or prompt_tokens) + (
+        usage.get("completion_tokens") or 0
+    )
+
+
+class RateLimiter:
+    """Limits requests per (provider, model), with state shared through redis."""
+
+    def __init__(self, provider: str, settings: RateLimitSettings):
+        self.provider = provider
+        self.settings = settings
+        redis = RedisCache().redis
+        self._acquire_script = redis.register_script(_ACQUIRE_SCRIPT)
+        self._release_script = redis.register_script(_RELEASE_SCRIPT)
+
+    def _limits(self, model: str) -> tuple[int, int, int]:
+        override = self.settings.overrides.get(model, {})
+        return (
+            override.get("requests_per_minute", self.settings.requests_per_minute),
+            override.get("tokens_per_minute", self.settings.tokens_per_minute),
+            override.get("max_in_flight", self.settings.max_in_flight),
+        )
+
+    def _keys(self, model: str) -> list[str]:
+        cache = RedisCache()
+        return [
+            cache.build_key("ratelimit", self.provider, model, "bucket"),
+            cache.build_key("ratelimit", self.provider, model, "in_flight"),
+        ]
+
+    async def acquire(self, model: str, tokens: int) -> str | None:
+        """Wait until a request for `model` costing `tokens` is allowed.
+
+        Returns:
+            str | None: Lease id to pass to `release`, None if redis is unavailable
+                and the request was let through without limiting.
+        """
+        rpm, tpm, max_in_flight = self._limits(model)
+        lease_id = uuid.uuid4().hex
+        start_time = time.monotonic()
+        in_flight_wait_sec = _IN_FLIGHT_MIN_WAIT_SEC
+        while True:
+            try:
+                wait_ms = await self._acquire_script(
+                    keys=self._keys(model),
+                    args=[
+                        rpm,
+                        tpm,
+                        max_in_flight,
+                        tokens,
+                        lease_id,
+                        self.settings.lease_timeout_sec * 1000,
+                    ],
+                )
+            except Exception as exc:
+                logger.warning(
+                    f"Rate limiter unavailable, sending request to {model} without limits: {exc}"
+                )
+                return None
+
+            if wait_ms == 0:
+                waited = time.monotonic() - start_time
+                if waited > 1:
+                    logger.debug(f"Rate limited request to {model} for {waited:.2f}s")
+                return lease_id
+
+            # jitter so that waiting workers do not all retry at the same time
+            if wait_ms == _IN_FLIGHT_FULL:
+                # nothing says when a slot frees up, so back off instead of polling redis
+                await asyncio.sleep(
+                    random.uniform(in_flight_wait_sec / 2, in_flight_wait_sec)
+                )
+                in_flight_wait_sec = min(
+                    in_flight_wait_sec * 2, _IN_FLIGHT_MAX_WAIT_SEC
+                )
+            else:
+                await asyncio.sleep(wait_ms / 1000 * random.uniform(1.0, 1.1))
+
+    async def release(
+        self,
+        model: str,
+        lease_id: str | None,
+        debit_tokens: int = 0,
+        response: httpx.Response | None = None,
+    ):
+        """Free the in flight slot and update the buckets from the usage and response headers.
+
+        Args:
+            model (str): Model of the request.
+            lease_id (str | None): Lease id returned by `acquire`.
+            debit_tokens (int, optional): Tokens used in addition to what was charged on acquire,
+                negative if fewer were used. Defaults to 0.
+            response (httpx.Response | None, optional): Response with rate limit headers.
+        """
+        if lease_id is None:
+            return
+        rpm, tpm, _ = self._limits(model)
+        remaining_requests, remaining_tokens, pause_sec = -1, -1, 0.0
+        if response is not None:
+            remaining_requests = _parse_int_header(
+                response.headers, "x-ratelimit-remaining-requests"
+            )
+            remaining_tokens = _parse_int_header(
+                response.headers, "x-ratelimit-remaining-tokens"
+            )
+            pause_sec = _pause_seconds(response)
+            if pause_sec > 0:
+                logger.warning(
+                    f"Rate limit reached for {self.provider} {model}, pausing for {pause_sec:.2f}s"
+                )
+        try:
+            await self._release_script(
+                keys=self._keys(model),
+                args=[
+                    rpm,
+                    tpm,
+                    debit_tokens,
+                    remaining_requests,
+                    remaining_tokens,
+                    int(pause_sec * 1000),
+                    lease_id,
+                ],
+            )
+        except Exception as exc:
+            logger.warning(f"Failed to release rate limiter lease for {model}: {exc}")
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Holds the in flight slot of a streamed response until the stream is closed, then
+    releases it with the tokens used by the stream.
+
+    The tokens used are read from the usage in the last chunk of the stream, or estimated
+    from the length of the streamed content if there is none. Streams with a
+    `Content-Encoding` are not parsed, they stay charged what was charged up front.
+    """
+
+    def __init__(
+        self,
+        stream: httpx.AsyncByteStream,
+        release,
+        prompt_tokens: int,
+        parse: bool = True,
+    ):
+        self._stream = stream
+        self._release = release
+        self._prompt_tokens = prompt_tokens
+        self._parse = parse
+        # the incomplete line at the end of the chunks read so far
+        self._pending = b""
+        self._usage: dict | None = None
+        self._num_content_chars = 0
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            if self._parse:
+                self._parse_events(chunk)
+            yield chunk
+
+    def _parse_events(self, chunk: bytes):
+        lines = (self._pending + chunk).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            if not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:") :].strip()
+            if data == b"[DONE]":
+                continue
+            try:
+                event = json.loads(data)
+                if event.get("usage"):
+                    self._usage = event["usage"]
+                for choice in event.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    self._num_content_chars += len(content or "")
+            except (ValueError, AttributeError):
+                continue
+
+    def _used_tokens(self) -> int:
+        if not self._parse:
+            return 0
+        if self._usage is not None:
+            return _used_tokens(self._usage, self._prompt_tokens)
+        return self._prompt_tokens + self._num_content_chars // _CHARS_PER_TOKEN + 1
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                release, self._release = self._release, None
+                await release(self._used_tokens())
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """httpx transport that sends chat completion requests through a `RateLimiter`.
+
+    Requests without a JSON body containing a "model" (e.g. listing models) are not limited.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: RateLimiter):
+        self._transport = transport
+        self._limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            body = json.loads(request.content)
+            model = body["model"]
+        except (ValueError, KeyError, TypeError):
+            return await self._transport.handle_async_request(request)
+
+        is_stream = bool(body.get("stream"))
+        prompt_tokens = _estimate_prompt_tokens(body)
+        charged = prompt_tokens + ((body.get("max_tokens") or 0) if is_stream else 0)
+        lease_id = await self._limiter.acquire(model, charged)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            await self._limiter.release(model, lease_id)
+            raise
+
+        if is_stream and response.status_code == 200:
+
+            async def _release(used_tokens: int):
+                debit = used_tokens - charged if used_tokens else 0
+                await self._limiter.release(model, lease_id, debit, response=response)
+
+            response.stream = _ReleasingStream(  # type: ignore
+                response.stream,  # type: ignore
+                _release,
+                prompt_tokens,
+                parse="content-encoding" not in response.headers,
+            )
+            return response
+
+        # read the body to correct the token bucket with the actual usage
+        try:
+            raw = b"".join([chunk async for chunk in response.stream])  # type: ignore
+        except BaseException:
+            await self._limiter.release(model, lease_id, response=response)
+            raise
+        finally:
+            await response.aclose()
+        response = httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            content=raw,
+            request=request,
+            extensions=response.extensions,
+        )
+        used_tokens = 0
+        try:
+            usage = json.loads(await response.aread()).get("usage") or {}
+            used_tokens = _used_tokens(usage, prompt_tokens)
+        except (ValueError, AttributeError):
+            pass
+        debit = used_tokens - charged if used_tokens else 0
+        await self._limiter.release(model, lease_id, debit, response=response)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def build_rate_limited_transport(
+    provider: str, transport: httpx.AsyncBaseTransport
+) -> httpx.AsyncBaseTransport:
+    """Wrap `transport` with rate limiting if it is enabled in settings."""
+    settings = get_settings().rate_limit
+    if not settings.enabled:
+        return transport
+    if get_settings().cache.backend != "redis":
+        logger.warning(
+            f"Rate limits are shared through redis, requests to {provider} are not limited "
+            f"with the {get_settings().cache.backend} cache backend"
+        )
+        return transport
+    return RateLimitedTransport(transport, RateLimiter(provider, settings))
@@ -0,0 +1,255 @@
+"""
+response_cache.py
+
+Content addressed cache of LLM responses, keyed on the request (model, messages, sampling params).
+
+Modes (`llm_cache.mode` in settings):
+- "off": no caching
+- "cache": deterministic requests (temperature 0) are served from the cache, and stored for
+  `ttl_sec` on a miss
+- "record": every request is sent, and its response is stored without expiry
+- "replay": every request is served from the recorded responses, a miss raises
+  `CacheMissError` instead of calling the provider
+
+Every request param is part of the key. The randomised parts of the pipeline, such as the
+sampled persona and topic, the models, the temperature, `top_p` and `seed` of requests, are drawn
+from `get_sampling_rng`, which is seeded in "record" and "replay" modes, so a replay sends the same
+requests as the recording.
+
+The cache sits in front of `RateLimitedTransport`, so cache hits do not use
+any rate limit. Streamed responses are stored only if the stream was read to the end.
+"""
+
+import hashlib
+import json
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+
+import httpx
+from loguru import logger
+
+from commons.cache import RedisCache
+from commons.config import LlmCacheSettings, get_settings
+from commons.metrics import LLM_CACHE_HITS
+
+# response headers stored with the body, enough for the openai client to parse it
+_STORED_HEADERS = ("content-type", "content-encoding")
+
+
+class CacheMissError(httpx.TransportError):
+    """Raised in replay mode when a request was not recorded."""
+
+
+def _encode_entry(status_code: int, headers: dict[str, str], body: bytes) -> bytes:
+    meta = json.dumps({"status_code": status_code, "headers": headers})
+    return meta.encode("utf-8") + b"\n" + body
+
+
+def _decode_entry(value: bytes) -> tuple[int, dict[str, str], bytes]:
+    meta, _, body = value.partition(b"\n")
+    decoded = json.loads(meta)
+    return decoded["status_code"], decoded["headers"], body
+
+
+class ResponseCacheBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl_sec: int | None): ...
+
+
+class DiskBackend(ResponseCacheBackend):
+    """One file per response, the expiry is checked against the file modification time."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        # shard by prefix to keep directories small
+        return os.path.join(self.directory, key[:2], key)
+
+    async def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                ttl_line, _, value = f.read().partition(b"\n")
+        except FileNotFoundError:
+            return None
+        ttl_sec = int(ttl_line)
+        if ttl_sec > 0 and time.time() - os.path.getmtime(path) > ttl_sec:
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl_sec: int | None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(f"{ttl_sec or 0}\n".encode() + value)
+        os.replace(tmp_path, path)
+
+
+class RedisBackend(ResponseCacheBackend):
+    async def get(self, key: str) -> bytes | None:
+        cache = RedisCache()
+        return await cache.redis.get(cache.build_key("llm_cache", key))
+
+    async def set(self, key: str, value: bytes, ttl_sec: int | None):
+        cache = RedisCache()
+        await cache.redis.set(cache.build_key("llm_cache", key), value, ex=ttl_sec)
+
+
+def get_sampling_rng(*inputs: object) -> random.Random:
+    """RNG for the randomised parts of a request. In "record" and "replay" modes it is seeded
+    with `llm_cache.seed` and `inputs`, so a replay builds the same request as the recording
+    whatever else used the RNG in between, otherwise it is seeded randomly.
+    """
+    settings = get_settings().llm_cache
+    if settings.mode in ("record", "replay"):
+        return random.Random(":".join(str(i) for i in (settings.seed, *inputs)))
+    return random.Random()
+
+
+def build_cache_key(request: httpx.Request, body: dict) -> str:
+    """sha256 of the endpoint and the request body, with sorted keys."""
+    canonical = json.dumps(
+        {"url": f"{request.url.host}{request.url.path}", "body": body},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """Passes a streamed response through, storing it once it has been read to the end."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_complete):
+        self._stream = stream
+        self._on_complete = on_complete
+
+    async def __aiter__(self):
+        chunks = []
+        async for chunk in self._stream:
+            chunks.append(chunk)
+            yield chunk
+        await self._on_complete(b"".join(chunks))
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+
+class ResponseCacheTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        backend: ResponseCacheBackend,
+        settings: LlmCacheSettings,
+    ):
+        self._transport = transport
+        self._backend = backend
+        self.settings = settings
+
+    def _is_cacheable(self, body: dict) -> bool:
+        if self.settings.mode == "cache":
+            return body.get("temperature") == 0
+        return self.settings.mode in ("record", "replay")
+
+    async def _store(self, key: str, response: httpx.Response, raw: bytes):
+        headers = {
+            name: response.headers[name]
+            for name in _STORED_HEADERS
+            if name in response.headers
+        }
+        ttl_sec = self.settings.ttl_sec if self.settings.mode == "cache" else None
+        try:
+            await self._backend.set(
+                key, _encode_entry(response.status_code, headers, raw), ttl_sec
+            )
+        except Exception as exc:
+            logger.warning(f"Failed to store LLM response in cache: {exc}")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            body = json.loads(request.content)
+        except (ValueError, TypeError):
+            body = None
+        if not isinstance(body, dict) or not self._is_cacheable(body):
+            return await self._transport.handle_async_request(request)
+
+        key = build_cache_key(request, body)
+        if self.settings.mode != "record":
+            try:
+                value = await self._backend.get(key)
+            except Exception as exc:
+                logger.warning(f"Failed to read LLM response from cache: {exc}")
+                value = None
+            if value is not None:
+                status_code, headers, raw = _decode_entry(value)
+                logger.debug(f"LLM cache hit for {body.get('model')}, key: {key}")
+                LLM_CACHE_HITS.labels(str(body.get("model"))).inc()
+                return httpx.Response(
+                    status_code=status_code,
+                    headers=headers,
+                    content=raw,
+                    request=request,
+                    extensions={"llm_cache_hit": True},
+                )
+            if self.settings.mode == "replay":
+                raise CacheMissError(
+                    f"No recorded response for {body.get('model')}, key: {key}",
+                    request=request,
+                )
+
+        response = await self._transport.handle_async_request(request)
+        if response.status_code != 200:
+            return response
+
+        if body.get("stream"):
+
+            async def _on_complete(raw: bytes):
+                await self._store(key, response, raw)
+
+            response.stream = _RecordingStream(response.stream, _on_complete)  # type: ignore
+            return response
+
+        try:
+            raw = b"".join([chunk async for chunk in response.stream])  # type: ignore
+        finally:
+            await response.aclose()
+        await self._store(key, response, raw)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            content=raw,
+            request=request,
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def build_cached_transport(
+    transport: httpx.AsyncBaseTransport,
+) -> httpx.AsyncBaseTransport:
+    """Wrap `transport` with the response cache if it is enabled in settings."""
+    settings = get_settings().llm_cache
+    if settings.mode == "off":
+        return transport
+    if settings.mode not in ("cache", "record", "replay"):
+        raise ValueError(f"Unknown LLM cache mode: {settings.mode}")
+
+    backend: ResponseCacheBackend
+    if settings.backend == "redis":
+        backend = RedisBackend()
+    elif settings.backend == "disk":
+        backend = DiskBackend(settings.directory)
+    else:
+        raise ValueError(f"Unknown LLM cache backend: {settings.backend}")
+    logger.info(f"Using LLM response cache in {settings.mode} mode, {settings.backend}")
+    return ResponseCacheTransport(transport, backend, settings)
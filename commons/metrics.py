@@ -0,0 +1,110 @@
+"""
+metrics.py
+
+Prometheus metrics of the QA pair pipeline, exposed on `/metrics` by `commons/routes/metrics.py`.
+
+Stage durations are labelled with the model, topic and augment strategy of the QA pair being built.
+The topic and augment strategy are set once per QA pair with `set_pipeline_labels` and read from a
+context variable, so nested stages like linting do not need them passed down.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# stages take from milliseconds (merge, lint) up to minutes (answer generation)
+_DURATION_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    20,
+    30,
+    60,
+    120,
+    180,
+    300,
+    600,
+)
+_STAGE_LABELS = ["stage", "model", "topic", "augment_strategy"]
+
+STAGE_DURATION = Histogram(
+    "synthetic_stage_duration_seconds",
+    "Duration of each stage of building a QA pair",
+    _STAGE_LABELS,
+    buckets=_DURATION_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "synthetic_stage_errors_total",
+    "Number of stages of building a QA pair that raised an error",
+    _STAGE_LABELS,
+)
+QUEUE_DEPTH = Gauge("synthetic_queue_depth", "Number of QA pairs buffered in the queue")
+PARTITION_QUEUE_DEPTH = Gauge(
+    "synthetic_partition_queue_depth",
+    "Number of QA pairs buffered in the queue of each partition, topic:augment_type",
+    ["partition"],
+)
+ACTIVE_WORKERS = Gauge(
+    "synthetic_active_workers", "Number of workers currently building a QA pair"
+)
+DEQUEUE_WAIT = Histogram(
+    "synthetic_dequeue_wait_seconds",
+    "Time a request waited for a QA pair to be available",
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300),
+)
+LLM_REQUEST_DURATION = Histogram(
+    "llm_request_duration_seconds",
+    "Duration of LLM API requests sent to a provider, until the response headers for streams",
+    ["provider", "model", "status"],
+    buckets=_DURATION_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens used by LLM API requests that were not streamed",
+    ["provider", "model", "type"],
+)
+LLM_CACHE_HITS = Counter(
+    "llm_cache_hits_total", "LLM responses served from the response cache", ["model"]
+)
+LLM_HEDGES = Counter(
+    "llm_hedges_total",
+    "Hedged and fallback LLM requests, by outcome",
+    ["operation", "outcome"],
+)
+
+_pipeline_labels: contextvars.ContextVar[dict[str, str]] = contextvars.ContextVar(
+    "pipeline_labels", default={}
+)
+
+
+def set_pipeline_labels(**labels: str):
+    """Set labels, e.g. topic and augment_strategy, for all stages in the current context."""
+    _pipeline_labels.set({**_pipeline_labels.get(), **labels})
+
+
+@contextmanager
+def track_stage(stage: str, model: str = ""):
+    """Record the duration of a stage, and count it as an error if it raises."""
+    labels = _pipeline_labels.get()
+    label_values = (
+        stage,
+        model,
+        labels.get("topic", ""),
+        labels.get("augment_strategy", ""),
+    )
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(*label_values).inc()
+        raise
+    finally:
+        STAGE_DURATION.labels(*label_values).observe(time.perf_counter() - start_time)
@@ -1,12 +1,22 @@
+import argparse
 import asyncio
+import contextvars
+import json
 import os
 import time
+from collections import defaultdict
 
+import httpx
+import instructor
+import numpy as np
 from dotenv import load_dotenv
+from instructor import Mode
 from loguru import logger
+from openai import AsyncOpenAI
 
 from commons.dataset.personas import get_random_persona, load_persona_dataset
-from commons.llm import get_llm_api_client
+from commons.linter.linter import lint_html_scripts
+from commons.llm import Provider, _get_llm_api_kwargs, build_http_client
 from commons.synthetic import (
     _merge_js_and_html,
     generate_answer,
@@ -18,116 +28,307 @@ load_dotenv()
 
 """
     model_lab.py
-    1. generate a question from each topic
-    2. send each question to each model
-    3. save all results as a json file
+    benchmark harness to compare answer models on throughput and quality
+    1. generate questions for each topic
+    2. send each question to each model concurrently, limited per provider
+    3. stream every result to a JSONL file as soon as it finishes
+    4. report latency percentiles, tokens per second, lint failure rate and error rate per model
 
     instructions
-    - edit the question_model and answer_models variables with the desired models
-    - question_model will be used to generate the question
-    - each answer model will generate code for that question.
-    - to run the script: python -m commons.model_lab.model_lab
-    - output will be saved to whatever is defined in the OUTPUT_FILE variable
+    - pass the desired models with --question-model and --answer-models
+    - question_model will be used to generate the questions
+    - each answer model will generate code for each question.
+    - to run the script: python -m commons.model_lab.model_lab --answer-models anthropic/claude-3.5-sonnet
+    - re-running with the same --output resumes from the results already in the file, and retries
+      the jobs that failed
+    - use --report-only to print the report of an existing output file
 """
 
 # get model names from openrouter website
 
-question_model = "anthropic/claude-3.5-sonnet"
-question_model = "deepseek/deepseek-r1:free"
-answer_models = [
+DEFAULT_QUESTION_MODEL = "anthropic/claude-3.5-sonnet"
+DEFAULT_ANSWER_MODELS = [
+    "anthropic/claude-3.5-sonnet",
     # "deepseek/deepseek-r1",
-    "deepseek/deepseek-r1:free",
-    # "deepseek/deepseek-chat-v3-0324:free",
+    # "deepseek/deepseek-r1:free",
     # "qwen/qwen2.5-32b-instruct",  # 0.79/M
     # "qwen/qwq-32b",  # 0.12/M in 0.18/M out
-    # # "anthropic/claude-3.7-sonnet",
-    # # "anthropic/claude-3.5-sonnet",
     # "anthropic/claude-3.5-haiku",
-    # "anthropic/claude-3.5-haiku:beta",
 ]
-OUTPUT_FILE = "syn-gen-trials.json"
+OUTPUT_FILE = "syn-gen-trials.jsonl"
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# token usage of the job running in the current task, populated by the http response hook
+_job_usage: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "job_usage", default=None
+)
 
-async def main():
-    logger.info("Starting standalone synthetic data generation")
 
-    load_persona_dataset()
+async def _record_usage(response: httpx.Response):
+    usage = _job_usage.get()
+    if usage is None or "text/event-stream" in response.headers.get("content-type", ""):
+        return
+    await response.aread()
+    try:
+        body_usage = response.json().get("usage") or {}
+    except (json.JSONDecodeError, AttributeError):
+        return
+    usage["num_completions"] += 1
+    usage["input_tokens"] += body_usage.get("prompt_tokens") or 0
+    usage["output_tokens"] += body_usage.get("completion_tokens") or 0
 
-    client = get_llm_api_client()
 
-    try:
-        # 1. generate a question from each topic
-        questions = []
-        for topic in Topics:
-            logger.info(f"generating {topic.name} question ...")
-            persona = get_random_persona()
-            question = await generate_question(client, question_model, topic, persona)
-            questions.append({"topic": topic, "question": question})
-            # break  # gen 1 question only.
-
-        # 2. for each question, generate an answer from each model.
-        answers = []
-        for model in answer_models:
-            for q in questions:
-                logger.info(
-                    f"generating {q['topic'].name} answer with model: {model} ..."
-                )
-                start_time = time.time()
+def _get_benchmark_client() -> instructor.AsyncInstructor:
+    """llm api client that records the token usage of each completion"""
+    http_client = build_http_client(
+        Provider.OPENROUTER, event_hooks={"response": [_record_usage]}
+    )
+    return instructor.from_openai(
+        AsyncOpenAI(
+            **_get_llm_api_kwargs(Provider.OPENROUTER), http_client=http_client
+        ),  # type: ignore
+        mode=Mode.MD_JSON,
+    )
+
+
+def _get_provider(model: str) -> str:
+    return model.split("/")[0]
+
+
+class ResultWriter:
+    """Appends results to a JSONL file as they finish, so a crash loses at most one line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = asyncio.Lock()
+
+    def read(self) -> list[dict]:
+        """Latest record of each key, a job that is retried on resume appends a record that
+        supersedes its failed one.
+        """
+        if not os.path.exists(self.path):
+            return []
+        records: dict[str, dict] = {}
+        with open(self.path) as f:
+            for line in f:
                 try:
-                    _, ans = await generate_answer(
-                        client,
-                        model,
-                        q["question"],
-                        q["topic"],
-                        f"{model}_{q['topic']}",
-                    )
-                except Exception as e:
-                    # keep going if an error occurs
-                    logger.error(
-                        f"Error generating {q['topic'].name} answer with model: {model}: {e}"
-                    )
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be truncated if the previous run crashed
+                    logger.warning(f"Skipping invalid line in {self.path}")
                     continue
-                logger.success(
-                    f"Generated {q['topic'].name} answer with model: {model} in {time.time() - start_time:.2f} seconds"
-                )
-                # merge generated index.js into index.html
-                ans = _merge_js_and_html(ans)
-
-                answers.append(
-                    {
-                        "name": f"{model}_{q['topic'].name}",
-                        "answer": ans,
-                        "question": q["question"],
-                    }
-                )
-
-        # 3. save answers to file
-        result = []
-        for ans in answers:
-            # Convert each CodeAnswer to dict and add to result list
-            result.append(
-                {
-                    "files": [
-                        {
-                            "tag": ans["name"],
-                            "filename": file.filename,
-                            "content": file.content,
-                            "language": file.language,
-                            "question": ans["question"],
-                        }
-                        for file in ans["answer"].files
-                    ]
-                }
+                records.pop(record["key"], None)
+                records[record["key"]] = record
+        return list(records.values())
+
+    async def write(self, record: dict):
+        async with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+
+
+async def _generate_questions(
+    client: instructor.AsyncInstructor,
+    question_model: str,
+    questions_per_topic: int,
+    existing: dict[str, dict],
+    writer: ResultWriter,
+) -> list[dict]:
+    async def _generate(key: str, topic: Topics) -> dict | None:
+        if key in existing:
+            return existing[key]
+        logger.info(f"generating {topic.name} question ...")
+        try:
+            question = await generate_question(
+                client, question_model, topic, get_random_persona()
+            )
+        except Exception as e:
+            logger.error(f"Error generating {topic.name} question: {e}")
+            return None
+        record = {
+            "type": "question",
+            "key": key,
+            "topic": topic.name,
+            "question_model": question_model,
+            "question": question,
+        }
+        await writer.write(record)
+        return record
+
+    results = await asyncio.gather(
+        *[
+            _generate(f"{topic.name}_{i}", topic)
+            for topic in Topics
+            for i in range(questions_per_topic)
+        ]
+    )
+    return [r for r in results if r is not None]
+
+
+async def _answer_question(
+    client: instructor.AsyncInstructor,
+    model: str,
+    question: dict,
+    semaphore: asyncio.Semaphore,
+    writer: ResultWriter,
+):
+    key = f"{model}|{question['key']}"
+    async with semaphore:
+        usage = {"num_completions": 0, "input_tokens": 0, "output_tokens": 0}
+        _job_usage.set(usage)
+        logger.info(f"generating {question['key']} answer with model: {model} ...")
+        start_time = time.perf_counter()
+        record = {
+            "type": "answer",
+            "key": key,
+            "model": model,
+            "question_key": question["key"],
+            "topic": question["topic"],
+        }
+        try:
+            _, ans = await generate_answer(
+                client,
+                model,
+                question["question"],
+                Topics[question["topic"]],
+                key,
             )
+            latency = time.perf_counter() - start_time
+            # merge generated index.js into index.html
+            ans = _merge_js_and_html(ans)
+            html = next(f.content for f in ans.files if f.filename == "index.html")
+            lint_result = await asyncio.to_thread(lint_html_scripts, html, key)
+            record |= {
+                "status": "ok",
+                "latency_s": latency,
+                "lint_failed": lint_result.return_code != 0,
+                "files": [file.model_dump() for file in ans.files],
+            }
+            logger.success(
+                f"Generated {question['key']} answer with model: {model} in {latency:.2f} seconds"
+            )
+        except Exception as e:
+            # keep going if an error occurs
+            record |= {
+                "status": "error",
+                "latency_s": time.perf_counter() - start_time,
+                "error": str(e),
+            }
+            logger.error(
+                f"Error generating {question['key']} answer with model: {model}: {e}"
+            )
+
+        await writer.write(record | usage)
+
+
+def build_report(records: list[dict]) -> dict[str, dict]:
+    """Aggregate answer records into latency percentiles, throughput, lint failure and error rates per model"""
+    by_model: dict[str, list[dict]] = defaultdict(list)
+    for record in records:
+        if record.get("type") == "answer":
+            by_model[record["model"]].append(record)
+
+    report = {}
+    for model, answers in by_model.items():
+        ok = [a for a in answers if a["status"] == "ok"]
+        latencies = np.array([a["latency_s"] for a in ok])
+        total_latency = float(latencies.sum()) if len(ok) else 0.0
+        output_tokens = sum(a.get("output_tokens", 0) for a in ok)
+        report[model] = {
+            "num_jobs": len(answers),
+            "error_rate": 1 - len(ok) / len(answers),
+            "lint_failure_rate": (
+                sum(a["lint_failed"] for a in ok) / len(ok) if ok else None
+            ),
+            "p50_latency_s": float(np.percentile(latencies, 50)) if len(ok) else None,
+            "p95_latency_s": float(np.percentile(latencies, 95)) if len(ok) else None,
+            "p99_latency_s": float(np.percentile(latencies, 99)) if len(ok) else None,
+            "output_tokens_per_s": (
+                output_tokens / total_latency if total_latency else None
+            ),
+        }
+    return report
+
+
+def print_report(report: dict[str, dict]):
+    def _fmt(value, spec: str) -> str:
+        return "-" if value is None else format(value, spec)
+
+    header = f"{'model':<45} {'jobs':>5} {'err%':>6} {'lint%':>6} {'p50':>7} {'p95':>7} {'p99':>7} {'tok/s':>7}"
+    print(header)
+    print("-" * len(header))
+    for model, stats in sorted(report.items()):
+        print(
+            f"{model:<45} {stats['num_jobs']:>5} "
+            f"{_fmt(stats['error_rate'] * 100, '.1f'):>6} "
+            f"{_fmt(stats['lint_failure_rate'] and stats['lint_failure_rate'] * 100, '.1f'):>6} "
+            f"{_fmt(stats['p50_latency_s'], '.1f'):>7} "
+            f"{_fmt(stats['p95_latency_s'], '.1f'):>7} "
+            f"{_fmt(stats['p99_latency_s'], '.1f'):>7} "
+            f"{_fmt(stats['output_tokens_per_s'], '.1f'):>7}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark answer models")
+    parser.add_argument("--question-model", type=str, default=DEFAULT_QUESTION_MODEL)
+    parser.add_argument("--answer-models", nargs="+", default=DEFAULT_ANSWER_MODELS)
+    parser.add_argument("--questions-per-topic", type=int, default=1)
+    parser.add_argument(
+        "--max-concurrency-per-provider",
+        type=int,
+        default=4,
+        help="Maximum number of concurrent answer generations per provider, e.g. anthropic",
+    )
+    parser.add_argument(
+        "--output", type=str, default=os.path.join(CURRENT_DIR, OUTPUT_FILE)
+    )
+    parser.add_argument("--report-only", action="store_true")
+    args = parser.parse_args()
+
+    writer = ResultWriter(args.output)
+    records = writer.read()
+    if args.report_only:
+        print_report(build_report(records))
+        return
+
+    logger.info("Starting standalone synthetic data generation")
+    load_persona_dataset()
+    client = _get_benchmark_client()
+
+    try:
+        # 1. generate questions for each topic, reusing questions from a previous run
+        existing_questions = {r["key"]: r for r in records if r["type"] == "question"}
+        questions = await _generate_questions(
+            client,
+            args.question_model,
+            args.questions_per_topic,
+            existing_questions,
+            writer,
+        )
 
-        # Save to file in the current directory
-        output_path = os.path.join(CURRENT_DIR, OUTPUT_FILE)
-        import json
+        # 2. for each question, generate an answer from each model, skipping finished jobs,
+        # jobs that failed are run again
+        finished = {
+            r["key"] for r in records if r["type"] == "answer" and r["status"] == "ok"
+        }
+        semaphores: dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(args.max_concurrency_per_provider)
+        )
+        jobs = [
+            _answer_question(client, model, q, semaphores[_get_provider(model)], writer)
+            for model in args.answer_models
+            for q in questions
+            if f"{model}|{q['key']}" not in finished
+        ]
+        logger.info(f"Running {len(jobs)} jobs, {len(finished)} already finished")
+        await asyncio.gather(*jobs)
 
-        with open(output_path, "w") as f:
-            json.dump(result, f, indent=2)
-        logger.info(f"Results saved to {output_path}")
+        # 3. report on all results in the file
+        report = build_report(writer.read())
+        print_report(report)
+        logger.info(f"Results saved to {args.output}")
 
     except Exception as e:
         logger.error(f"Error running model_lab.py: {e}")
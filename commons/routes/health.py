@@ -1,6 +1,13 @@
-from fastapi import APIRouter, status
+import time
+
+from fastapi import APIRouter, Request, Response, status
+from loguru import logger
 from pydantic import BaseModel
 
+from commons.cache import get_cache
+from commons.config import get_settings
+from commons.worker import WorkerManager
+
 health_router = APIRouter()
 
 
@@ -10,19 +17,106 @@ class HealthCheck(BaseModel):
     status: str = "OK"
 
 
+class PipelineStatus(BaseModel):
+    """Detailed status of the QA pair pipeline, returned by `/ready` and `/health?verbose=1`."""
+
+    status: str = "OK"
+    redis_ok: bool = False
+    redis_ping_ms: float | None = None
+    queue_length: int | None = None
+    # workers currently building a QA pair, each holds a lease on one unit of work
+    active_workers: int | None = None
+    # QA pairs dequeued but not acknowledged yet, only tracked by the stream queue backend
+    in_flight_deliveries: int | None = None
+    last_enqueue_age_sec: float | None = None
+    worker_task_alive: bool = False
+    running_workers: int = 0
+    errors: list[str] = []
+
+
+async def get_pipeline_status(request: Request) -> PipelineStatus:
+    pipeline_status = PipelineStatus()
+    cache = get_cache()
+    try:
+        pipeline_status.redis_ping_ms = await cache.ping() * 1000
+        pipeline_status.redis_ok = True
+        pipeline_status.queue_length = await cache.get_queue_length()
+        pipeline_status.active_workers = await cache.get_num_workers_active()
+        pipeline_status.in_flight_deliveries = await cache.get_num_in_flight()
+        last_enqueue_time = await cache.get_last_enqueue_time()
+        if last_enqueue_time is not None:
+            pipeline_status.last_enqueue_age_sec = time.time() - last_enqueue_time
+    except Exception as exc:
+        logger.warning(f"Health check failed to query redis: {exc}")
+        pipeline_status.errors.append(f"redis: {exc}")
+
+    worker_task = getattr(request.app.state, "worker_task", None)
+    pipeline_status.worker_task_alive = (
+        worker_task is not None and not worker_task.done()
+    )
+    if WorkerManager._instance is not None:
+        pipeline_status.running_workers = WorkerManager._instance.num_running_workers()
+    if not pipeline_status.worker_task_alive:
+        pipeline_status.errors.append("worker task is not running")
+    return pipeline_status
+
+
 @health_router.get(
     "/health",
     tags=["healthcheck"],
     summary="Perform a Health Check",
     response_description="Return HTTP Status Code 200 (OK)",
     status_code=status.HTTP_200_OK,
-    response_model=HealthCheck,
+    response_model=HealthCheck | PipelineStatus,
 )
-def get_health() -> HealthCheck:
+async def get_health(
+    request: Request, response: Response, verbose: bool = False
+) -> HealthCheck | PipelineStatus:
     """
     Perform a health check on the service.
 
+    Args:
+        verbose (bool): Also check redis and the workers, returning 503 if either is down.
+
+    Returns:
+        HealthCheck | PipelineStatus: A simple health check response, or the pipeline status if verbose.
+    """
+    if not verbose:
+        return HealthCheck(status="OK")
+
+    pipeline_status = await get_pipeline_status(request)
+    if pipeline_status.errors:
+        pipeline_status.status = "UNHEALTHY"
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return pipeline_status
+
+
+@health_router.get(
+    "/ready",
+    tags=["healthcheck"],
+    summary="Perform a Readiness Check",
+    response_description="Return HTTP Status Code 200 (OK) if QA pairs are buffered, otherwise 503",
+    status_code=status.HTTP_200_OK,
+    response_model=PipelineStatus,
+)
+async def get_ready(request: Request, response: Response) -> PipelineStatus:
+    """
+    Check if the service can serve QA pairs without waiting, so load balancers only
+    route requests to instances with buffered QA pairs.
+
     Returns:
-        HealthCheck: A simple health check response.
+        PipelineStatus: The pipeline status, with status code 503 if not ready.
     """
-    return HealthCheck(status="OK")
+    pipeline_status = await get_pipeline_status(request)
+    min_queue_length = get_settings().generation.ready_min_queue_length
+    if (
+        pipeline_status.queue_length is not None
+        and pipeline_status.queue_length < min_queue_length
+    ):
+        pipeline_status.errors.append(
+            f"queue has {pipeline_status.queue_length} QA pairs, need at least {min_queue_length}"
+        )
+    if pipeline_status.errors:
+        pipeline_status.status = "NOT_READY"
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return pipeline_status
@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Response
+from loguru import logger
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from commons.cache import get_cache
+from commons.metrics import ACTIVE_WORKERS, PARTITION_QUEUE_DEPTH, QUEUE_DEPTH
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics", tags=["metrics"], include_in_schema=False)
+async def get_metrics() -> Response:
+    """Expose metrics in the Prometheus text format."""
+    cache = get_cache()
+    try:
+        QUEUE_DEPTH.set(await cache.get_queue_length())
+        ACTIVE_WORKERS.set(await cache.get_num_workers_active())
+        for partition, length in (await cache.get_partition_queue_lengths()).items():
+            PARTITION_QUEUE_DEPTH.labels(partition).set(length)
+    except Exception as exc:
+        # still serve the other metrics, the gauges keep the values set by the workers
+        logger.warning(f"Failed to read queue metrics from redis: {exc}")
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,18 +1,24 @@
 import asyncio
 import functools
-import json
+import time
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Query, Request, Response
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
-from commons.cache import RedisCache
+from commons.cache import QueueItem, get_cache
+from commons.cache.codec import get_codec
+from commons.metrics import DEQUEUE_WAIT
 from commons.synthetic import (
+    AugmentStrategy,
     build_prompt_responses_pair,
 )
+from commons.types import Topics
+from commons.utils.serialization import dumps, loads
 from commons.worker import WorkerManager
 
 synthetic_gen_router = APIRouter(prefix="/api")
-cache = RedisCache()
+cache = get_cache()
 worker = WorkerManager(
     do_work=functools.partial(
         build_prompt_responses_pair,
@@ -26,27 +32,277 @@ class SyntheticGenResponse(BaseModel):
     error: str | None = None
 
 
-@synthetic_gen_router.get("/synthetic-gen")
-async def generate_synthetic_data():
-    try:
-        num_elems = await cache.get_queue_length()
-        if num_elems == 0:
-            for _ in range(100):
-                await asyncio.sleep(3)
-                num_elems = await cache.get_queue_length()
-                if num_elems > 0:
-                    break
-            else:
-                raise Exception("Cache population timeout after 300 seconds")
-
-        qa_pair = await cache.dequeue()
-        if qa_pair is None:
-            raise Exception("Failed to get QA pair from cache")
+class SyntheticGenBatchResponse(BaseModel):
+    success: bool
+    body: list[dict] = []
+    error: str | None = None
+
+
+# interval between checks of the queue while waiting for QA pairs
+POLL_INTERVAL_SEC = 3
+# maximum number of QA pairs returned by one request
+MAX_BATCH_SIZE = 32
+# maximum number of history entries returned by one request
+MAX_HISTORY_PAGE_SIZE = 500
+
+
+# the response envelope around QA pairs, which are already JSON encoded in the queue
+_ENVELOPE_PREFIX = b'{"success":true,"body":'
+_ENVELOPE_SUFFIX = b',"error":null}'
+
+
+def _accepts_zstd(accept_encoding: str) -> bool:
+    return any(
+        encoding.split(";")[0].strip() == "zstd"
+        for encoding in accept_encoding.split(",")
+    )
+
+
+def _passthrough_response(
+    qa_pairs: list[bytes], batch: bool, accept_encoding: str = ""
+) -> Response:
+    """Stitch the stored JSON bytes of QA pairs into the response envelope, so that the
+    payload is never parsed and re-encoded on the serving path.
+
+    If the client accepts zstd, the body is compressed as a single zstd frame. Stored
+    frames are not passed through as is, as clients that decode `Content-Encoding: zstd`
+    do not all read past the first frame of a body.
+
+    Equivalent to `SyntheticGenResponse(success=True, body=...)`, or
+    `SyntheticGenBatchResponse(success=True, body=[...])` if `batch` is set.
+    """
+    # the JSON between QA pairs, there is one more than the number of QA pairs
+    literals = [_ENVELOPE_PREFIX, _ENVELOPE_SUFFIX]
+    if batch:
+        literals = [
+            _ENVELOPE_PREFIX + b"[",
+            *[b","] * (len(qa_pairs) - 1),
+            b"]" + _ENVELOPE_SUFFIX,
+        ]
+
+    codec = get_codec()
+    parts = [literals[0]]
+    for qa_pair, literal in zip(qa_pairs, literals[1:], strict=True):
+        parts += [codec.decode(qa_pair), literal]
+    if _accepts_zstd(accept_encoding):
+        return Response(
+            content=codec.compress_response(parts),
+            media_type="application/json",
+            headers={"Content-Encoding": "zstd", "Vary": "Accept-Encoding"},
+        )
+    return Response(content=b"".join(parts), media_type="application/json")
+
+
+def _error_response(body: dict | list, error: str) -> Response:
+    return Response(
+        content=dumps({"success": False, "body": body, "error": error}),
+        media_type="application/json",
+    )
+
+
+def _validate_partition_filters(
+    topic: str | None, augment_type: str | None, augment_type_param="augment_type"
+) -> str | None:
+    if topic is not None and topic not in Topics.__members__:
+        return f"Unknown topic: {topic}, expected one of {list(Topics.__members__)}"
+    if augment_type is not None and augment_type not in AugmentStrategy.__members__:
+        return (
+            f"Unknown {augment_type_param}: {augment_type}, "
+            f"expected one of {list(AugmentStrategy.__members__)}"
+        )
+    return None
+
+
+async def _dequeue_batch(
+    count: int,
+    wait_for_all: bool,
+    timeout: float,
+    topic: str | None = None,
+    augment_type: str | None = None,
+) -> list[QueueItem]:
+    """Dequeue up to `count` QA pairs, waiting up to `timeout` seconds for them.
+
+    Args:
+        count (int): Number of QA pairs wanted.
+        wait_for_all (bool): Wait until `count` QA pairs are available, instead of
+            returning as soon as at least one is available.
+        timeout (float): Maximum time to wait.
+        topic (str | None): Only dequeue QA pairs of this topic.
+        augment_type (str | None): Only dequeue QA pairs of this augment strategy.
+
+    Raises:
+        Exception: If no QA pairs, or fewer than `count` when `wait_for_all` is set,
+            were available before the timeout.
+
+    Returns:
+        list[QueueItem]: The dequeued QA pairs.
+    """
+    if wait_for_all:
+        return await _dequeue_all(count, timeout, topic, augment_type)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        poll_start = time.monotonic()
+        qa_pairs = await cache.dequeue_many(
+            count,
+            block_sec=min(POLL_INTERVAL_SEC, max(deadline - poll_start, 0)),
+            topic=topic,
+            augment_type=augment_type,
+        )
+        if qa_pairs:
+            return qa_pairs
+        if time.monotonic() + POLL_INTERVAL_SEC > deadline:
+            raise Exception(
+                f"Cache population timeout after {timeout} seconds, no QA pairs available"
+            )
+        # backends that cannot block return immediately, wait for the rest of the interval
+        await asyncio.sleep(max(POLL_INTERVAL_SEC - (time.monotonic() - poll_start), 0))
+
+
+async def _dequeue_all(
+    count: int,
+    timeout: float,
+    topic: str | None = None,
+    augment_type: str | None = None,
+) -> list[QueueItem]:
+    """Wait until `count` QA pairs are queued, then dequeue them at once, so that nothing is
+    held by this request while it waits, see `_dequeue_batch`.
+    """
+    deadline = time.monotonic() + timeout
+    queue_length = 0
+    while True:
+        queue_length = await cache.get_queue_length(topic, augment_type)
+        if queue_length >= count:
+            qa_pairs = await cache.dequeue_many(
+                count, topic=topic, augment_type=augment_type
+            )
+            if len(qa_pairs) == count:
+                return qa_pairs
+            # taken by another consumer in the meantime, put back what we took
+            await cache.requeue(qa_pairs)
+        if time.monotonic() + POLL_INTERVAL_SEC > deadline:
+            break
+        await asyncio.sleep(POLL_INTERVAL_SEC)
+
+    raise Exception(
+        f"Cache population timeout after {timeout} seconds, {min(queue_length, count)}/{count} QA pairs available"
+    )
+
+
+@synthetic_gen_router.get(
+    "/synthetic-gen", response_model=SyntheticGenResponse | SyntheticGenBatchResponse
+)
+async def generate_synthetic_data(
+    request: Request,
+    count: int | None = Query(default=None, ge=1, le=MAX_BATCH_SIZE),
+    wait_for_all: bool = False,
+    timeout: float = Query(default=300, ge=0, le=300),
+    topic: str | None = None,
+    augment_type: str | None = None,
+):
+    """Get a QA pair, or a batch of `count` QA pairs as a list.
+
+    With `count`, returns as soon as any QA pairs are available, unless `wait_for_all`
+    is set, in which case it waits until all `count` QA pairs are available.
+
+    `topic` (e.g. `GAMES`) and `augment_type` (e.g. `CHANGE_ANSWERS`) only return QA
+    pairs of that topic and augment strategy. Set `PARTITION_BUFFER_SIZES` to keep QA
+    pairs of the filtered partitions buffered.
+
+    Responses are zstd compressed if the client sends `Accept-Encoding: zstd`. QA pairs
+    are acknowledged once the response has been sent.
+    """
+    accept_encoding = request.headers.get("accept-encoding", "")
+    error = _validate_partition_filters(topic, augment_type)
+    if error:
+        return _error_response([] if count is not None else {}, error)
+
+    start_time = time.perf_counter()
+    if count is not None:
         try:
-            result = json.loads(qa_pair)
-        except json.JSONDecodeError:
-            result = {}
+            qa_pairs = await _dequeue_batch(
+                count, wait_for_all, timeout, topic, augment_type
+            )
+            DEQUEUE_WAIT.observe(time.perf_counter() - start_time)
+            response = _passthrough_response(
+                [qa_pair.value for qa_pair in qa_pairs], True, accept_encoding
+            )
+            response.background = BackgroundTask(cache.ack, qa_pairs)
+            return response
+        except Exception as e:
+            return _error_response([], str(e))
 
-        return SyntheticGenResponse(success=True, body=result, error=None)
+    try:
+        qa_pairs = await _dequeue_batch(1, False, timeout, topic, augment_type)
+        DEQUEUE_WAIT.observe(time.perf_counter() - start_time)
+        response = _passthrough_response([qa_pairs[0].value], False, accept_encoding)
+        response.background = BackgroundTask(cache.ack, qa_pairs)
+        return response
+    except Exception as e:
+        return _error_response({}, str(e))
+
+
+@synthetic_gen_router.get("/history", response_model=SyntheticGenResponse)
+async def get_history(
+    limit: int = Query(default=50, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+    cursor: str | None = None,
+    topic: str | None = None,
+    model: str | None = None,
+    strategy: str | None = None,
+    since: float | None = None,
+    until: float | None = None,
+    include_payload: bool = False,
+):
+    """Page through the QA pairs generated so far, newest first.
+
+    `topic`, `model` (the question or any answer model) and `strategy` (e.g.
+    `CHANGE_ANSWERS`) filter the QA pairs, `since` and `until` are unix timestamps. Pass
+    the `next_cursor` of a page as `cursor` to get the next page, it is null after the
+    last page. QA pairs are only returned until their history expires, and only if they
+    were queued since the history index was added.
+    """
+    error = _validate_partition_filters(topic, strategy, "strategy")
+    if error:
+        return _error_response({}, error)
+
+    codec = get_codec()
+    try:
+        entries, next_cursor = await cache.query_history(
+            limit=limit,
+            cursor=cursor,
+            topic=topic,
+            model=model,
+            strategy=strategy,
+            since=since,
+            until=until,
+            with_values=include_payload,
+        )
+    except Exception as e:
+        return _error_response({}, str(e))
+
+    items = []
+    for entry in entries:
+        item = {"id": entry.id, "created_at": entry.created_at}
+        if entry.value is not None:
+            item["qa_pair"] = loads(codec.decode(entry.value))
+        items.append(item)
+    return Response(
+        content=dumps(
+            {
+                "success": True,
+                "body": {"items": items, "next_cursor": next_cursor},
+                "error": None,
+            }
+        ),
+        media_type="application/json",
+    )
+
+
+@synthetic_gen_router.get("/history/facets", response_model=SyntheticGenResponse)
+async def get_history_facets():
+    """Number of QA pairs in the history index with each topic, model and strategy."""
+    try:
+        facets = await cache.get_history_facets()
     except Exception as e:
-        return SyntheticGenResponse(success=False, body={}, error=str(e))
+        return _error_response({}, str(e))
+    return SyntheticGenResponse(success=True, body=facets)
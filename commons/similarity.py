@@ -0,0 +1,63 @@
+"""
+similarity.py
+
+Online near-duplicate detection for generated questions.
+
+Questions are embedded with a hashing vectorizer over word unigrams and bigrams, which needs
+no model download and takes microseconds per question. The embeddings of recently generated
+questions are kept in a fixed size ring buffer, so a nearest neighbour query is a single
+matrix-vector product.
+"""
+
+import re
+import zlib
+
+import numpy as np
+
+_token_pattern = re.compile(r"\w+")
+
+
+def hash_embed(text: str, dim: int = 2048) -> np.ndarray:
+    """Embed text into a L2 normalized vector using signed feature hashing.
+
+    Args:
+        text (str): Text to embed.
+        dim (int, optional): Number of dimensions of the embedding. Defaults to 2048.
+
+    Returns:
+        np.ndarray: Embedding of shape (dim,), all zeros if the text has no words.
+    """
+    tokens = _token_pattern.findall(text.lower())
+    features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:], strict=False)]
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in features:
+        # crc32 is deterministic across processes, unlike python's hash()
+        h = zlib.crc32(feature.encode("utf-8"))
+        vector[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class RecentQuestionIndex:
+    """Nearest neighbour index over the embeddings of the most recent questions."""
+
+    def __init__(self, window: int = 2048, dim: int = 2048):
+        self.dim = dim
+        self._vectors = np.zeros((window, dim), dtype=np.float32)
+        self._num_added = 0
+
+    def __len__(self) -> int:
+        return min(self._num_added, len(self._vectors))
+
+    def max_similarity(self, text: str) -> float:
+        """Cosine similarity of the most similar recent question, 0 if the index is empty."""
+        if len(self) == 0:
+            return 0.0
+        similarities = self._vectors[: len(self)] @ hash_embed(text, self.dim)
+        return float(similarities.max())
+
+    def add(self, text: str):
+        # overwrite the oldest question once the window is full
+        self._vectors[self._num_added % len(self._vectors)] = hash_embed(text, self.dim)
+        self._num_added += 1
@@ -1,6 +1,5 @@
 import asyncio
 import os
-import random
 import uuid
 from enum import Enum
 from typing import List, Tuple, cast
@@ -18,19 +17,25 @@ from tenacity import (
     stop_after_attempt,
 )
 
-from commons.config import ANSWER_MODELS, GENERATOR_MODELS
-from commons.dataset.personas import get_random_persona
+from commons.config import ANSWER_MODELS, GENERATOR_MODELS, get_settings
+from commons.dataset.sampler import sample_persona, sample_topic
 from commons.linter.linter import lint_code
-from commons.llm import get_llm_api_client
+from commons.llm import get_llm_api_client, hedged_call
+from commons.llm.response_cache import get_sampling_rng
+from commons.metrics import set_pipeline_labels, track_stage
 from commons.prompt_builders import (
     additional_notes_for_question_prompt,
     build_code_answer_prompt,
     build_code_generation_question_prompt,
 )
+from commons.similarity import RecentQuestionIndex
 from commons.types import Topics
 
 load_dotenv()
 
+# recently generated questions, used to detect near-duplicate questions
+question_index = RecentQuestionIndex(window=get_settings().generation.dedup_window)
+
 
 def _get_llm_usage(completion):
     usage: ModelUsage = {
@@ -104,6 +109,8 @@ async def generate_question(
 ):
     global used_models
     used_models = set()
+    # seeded when recording or replaying LLM responses, so the replayed request is the same
+    rng = get_sampling_rng(model, _topic, persona)
     try:
         kwargs = {
             "response_model": None,
@@ -112,20 +119,21 @@ async def generate_question(
                 {
                     "role": "system",
                     "content": build_code_generation_question_prompt(
-                        random.choices([2, 3], weights=[0.5, 0.5])[0],
+                        rng.choices([2, 3], weights=[0.5, 0.5])[0],
                         topic=_topic,
                         persona=persona,
                     ),
                 }
             ],
-            "temperature": random.uniform(0.5, 0.75),
+            "temperature": rng.uniform(0.5, 0.75),
             "max_tokens": 8192,
             "max_retries": AsyncRetrying(stop=stop_after_attempt(1), reraise=True),
-            "top_p": random.uniform(0.9, 1.0),
-            "seed": random.randint(0, int(1e9)),  # needed for OpenAI
+            "top_p": rng.uniform(0.9, 1.0),
+            "seed": rng.randint(0, int(1e9)),  # needed for OpenAI
         }
 
-        response_model = await client.chat.completions.create(**kwargs)
+        with track_stage("question_generation", model):
+            response_model = await client.chat.completions.create(**kwargs)
         coding_question = response_model.choices[0].message.content
         coding_question = additional_notes_for_question_prompt(coding_question)
 
@@ -165,13 +173,15 @@ async def lint_and_fix_code(
     )
 
     # lint index.js, if there are errors (return_code is 1), then fix them with _fix_syntax_errors()
-    lint_response = lint_code(answer.files[js_index].content, id)
+    with track_stage("lint", model):
+        lint_response = lint_code(answer.files[js_index].content, id)
     if lint_response.return_code == 1:
         # logger.info(f"{id} linter err: {lint_response.output}")
         # logger.info(f"{id} linter input: {lint_response.input}")
-        fixed_answer = await _fix_syntax_errors(
-            client, model, answer, lint_response.output, id
-        )
+        with track_stage("lint_fix", model):
+            fixed_answer = await _fix_syntax_errors(
+                client, model, answer, lint_response.output, id
+            )
         return fixed_answer
     else:
         # if linting failed, or if there are no errors, then do nothing which will return the unmodified answer.
@@ -197,6 +207,8 @@ async def generate_answer(
     # this is a hack because CodeAnswer.model_json_schema cannot be imported by prompt_builders without a ciruclar import error.add()
     # need to move where these types are declared during refactor.
     _answer_format = CodeAnswer.model_json_schema()
+    # seeded when recording or replaying LLM responses, so the replayed request is the same
+    rng = get_sampling_rng(model, question, err, code)
     messages = [
         {
             "role": "system",
@@ -215,17 +227,18 @@ async def generate_answer(
         "messages": messages,
         "max_retries": AsyncRetrying(stop=stop_after_attempt(2), reraise=True),
         "temperature": 0.0,
-        "max_tokens": 16384,
-        "top_p": random.uniform(0.9, 1.0),
+        "max_tokens": get_settings().generation.max_tokens,
+        "top_p": rng.uniform(0.9, 1.0),
     }
     if model.startswith("openai"):
-        kwargs["seed"] = random.randint(0, cast(int, 1e9))  # needed for OpenAI
+        kwargs["seed"] = rng.randint(0, cast(int, 1e9))  # needed for OpenAI
 
     try:
-        (
-            response_model,
-            completion,
-        ) = await client.chat.completions.create_with_completion(**kwargs)
+        with track_stage("answer_generation", model):
+            (
+                response_model,
+                completion,
+            ) = await client.chat.completions.create_with_completion(**kwargs)
 
         kwargs_clone = kwargs.copy()
         kwargs_clone["response_model"] = kwargs["response_model"].model_json_schema()
@@ -305,9 +318,12 @@ async def augment_question(
     }
 
     if model.startswith("openai"):
-        kwargs["seed"] = random.randint(0, int(1e9))  # needed for OpenAI
+        # seeded when recording or replaying LLM responses, so the replayed request is the same
+        rng = get_sampling_rng(model, question, augmentation_level)
+        kwargs["seed"] = rng.randint(0, int(1e9))  # needed for OpenAI
     try:
-        response_model = await client.chat.completions.create(**kwargs)
+        with track_stage("question_augmentation", model):
+            response_model = await client.chat.completions.create(**kwargs)
         kwargs_clone = kwargs.copy()
         langfuse_context.update_current_observation(
             input=kwargs_clone.pop("messages"),
@@ -395,6 +411,7 @@ def build_single_index_html(ans: CodeAnswer) -> CodeAnswer:
 # def _execute_rewoo():
 #     # iteration_state = await debug_initial_code(
 #     #     initial_html_code=html_file.content,
+#     #     num_candidates=get_settings().rewoo.num_candidates,
 #     # )
 
 #     # num_errors_total = sum(
@@ -547,6 +564,8 @@ async def _augment_answer(
     """
     id = str(uuid.uuid4())
     answer_format = CodeAnswer.model_json_schema()
+    # seeded when recording or replaying LLM responses, so the replayed request is the same
+    rng = get_sampling_rng(model, question, augmentation)
     messages = [
         {
             "role": "system",
@@ -562,16 +581,17 @@ async def _augment_answer(
         "messages": messages,
         "temperature": 0.0,
         "max_tokens": 8192,
-        "top_p": random.uniform(0.9, 1.0),
+        "top_p": rng.uniform(0.9, 1.0),
     }
 
     if model.startswith("openai"):
-        kwargs["seed"] = random.randint(0, cast(int, 1e9))  # needed for OpenAI
+        kwargs["seed"] = rng.randint(0, cast(int, 1e9))  # needed for OpenAI
 
     try:
-        result, completion = await client.chat.completions.create_with_completion(
-            **kwargs
-        )
+        with track_stage("answer_augmentation", model):
+            result, completion = await client.chat.completions.create_with_completion(
+                **kwargs
+            )
         kwargs_clone = kwargs.copy()
         langfuse_context.update_current_observation(
             input=kwargs_clone.pop("messages"),
@@ -596,7 +616,8 @@ async def _augment_answer(
 
 # merges output index.js into index.html
 def _merge_js_and_html(result):
-    ans_with_index_html = build_single_index_html(result)
+    with track_stage("merge"):
+        ans_with_index_html = build_single_index_html(result)
     html_file = next(
         (file for file in ans_with_index_html.files if file.filename == "index.html"),
         None,
@@ -623,11 +644,12 @@ def _merge_js_and_html(result):
 
 # use trace to avoid double dipping cost logging on nested observations
 @observe(as_type="trace")
-async def build_prompt_responses_pair():
-    augment_strategy = random.choices(
-        population=[AugmentStrategy.CHANGE_QUESTIONS, AugmentStrategy.CHANGE_ANSWERS],
-        weights=[0.5, 0.5],
-    )[0]
+async def build_prompt_responses_pair(
+    topic: str | None = None, augment_type: str | None = None
+):
+    """Build a QA pair, of the given topic and augment strategy names if set, e.g. to
+    fill the queue of a partition, otherwise they are sampled.
+    """
     client = get_llm_api_client()
     results: list[
         tuple[
@@ -637,8 +659,6 @@ async def build_prompt_responses_pair():
             str,
         ]
     ] = []
-    question_model = random.choice(GENERATOR_MODELS)
-    answer_models = random.choice(ANSWER_MODELS)
     tasks = []
 
     async def _generate_response(
@@ -649,8 +669,16 @@ async def build_prompt_responses_pair():
         level: QuestionAugmentation | None = None,
     ):
         try:
+            # hedged with an alternate provider or model if enabled, see `commons/llm/hedging.py`
             model, result = await asyncio.wait_for(
-                generate_answer(client, model, question, topic=topic, qa_id=qa_id),
+                hedged_call(
+                    "generate_answer",
+                    client,
+                    model,
+                    lambda client, model: generate_answer(
+                        client, model, question, topic=topic, qa_id=qa_id
+                    ),
+                ),
                 timeout=600,
             )
 
@@ -665,11 +693,29 @@ async def build_prompt_responses_pair():
             raise
 
     ##### START OF FUNCTION LOGIC #####
-    # 1. get random persona from hugging face
-    persona = get_random_persona()
+    # 1. get the next persona, cycling through the dataset to avoid repeats
+    persona = await sample_persona()
+
+    # 2. select a topic, weights are defined in `commons/dataset/sampler.py`
+    selected_topic = Topics[topic] if topic is not None else await sample_topic()
 
-    # 2. randomly select a topic. change weights accordingly to choose what topic of Tasks to generate.
-    selected_topic = random.choices(list(Topics), weights=[0.45, 0.3, 0.25], k=1)[0]
+    # seeded when recording or replaying LLM responses, so the replayed pipeline is the same
+    rng = get_sampling_rng(persona, selected_topic)
+    if augment_type is not None:
+        augment_strategy = AugmentStrategy[augment_type]
+    else:
+        augment_strategy = rng.choices(
+            population=[
+                AugmentStrategy.CHANGE_QUESTIONS,
+                AugmentStrategy.CHANGE_ANSWERS,
+            ],
+            weights=[0.5, 0.5],
+        )[0]
+    question_model = rng.choice(GENERATOR_MODELS)
+    answer_models = rng.choice(ANSWER_MODELS)
+    set_pipeline_labels(
+        topic=selected_topic.name, augment_strategy=augment_strategy.name
+    )
     try:
         # 3. generate a question using the topic
         question_prompt = await generate_question(
@@ -679,6 +725,23 @@ async def build_prompt_responses_pair():
         if question_prompt is None:
             raise ValueError("generate_question() returned null")
 
+        # 4. regenerate near-duplicates of recent questions, before generating any answers
+        generation_settings = get_settings().generation
+        for _ in range(generation_settings.dedup_max_regenerations):
+            similarity = question_index.max_similarity(question_prompt)
+            if similarity < generation_settings.dedup_threshold:
+                break
+            logger.info(
+                f"Question is a near-duplicate of a recent question, similarity: {similarity:.3f}, regenerating"
+            )
+            persona = await sample_persona()
+            question_prompt = await generate_question(
+                client, question_model, selected_topic, persona
+            )
+            if question_prompt is None:
+                raise ValueError("generate_question() returned null")
+        question_index.add(question_prompt)
+
         augmented_prompts = []
         ### Augments Answer ###
         if augment_strategy == AugmentStrategy.CHANGE_ANSWERS:
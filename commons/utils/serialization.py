@@ -0,0 +1,37 @@
+"""
+serialization.py
+
+JSON encoding of QA pair payloads, which are often 100+ KB of HTML.
+Uses orjson when it is installed, and falls back to the standard library json module otherwise.
+"""
+
+import json
+from collections.abc import Callable
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    # anything that is not plain JSON, e.g. pydantic models
+    return jsonable_encoder(obj)
+
+
+def dumps(obj: Any, default: Callable[[Any], Any] | None = _default) -> bytes:
+    """Serialize `obj` to compact UTF-8 encoded JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(
+        obj, default=default, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -4,8 +4,14 @@ from typing import Any, Awaitable, Callable
 from loguru import logger
 from openai import AuthenticationError, PermissionDeniedError
 
-from commons.cache import RedisCache
+from commons.cache import get_cache
 from commons.config import get_settings
+from commons.metrics import (
+    ACTIVE_WORKERS,
+    PARTITION_QUEUE_DEPTH,
+    QUEUE_DEPTH,
+    track_stage,
+)
 
 
 class WorkerManager:
@@ -16,10 +22,12 @@ class WorkerManager:
     The workers will also constantly replenish the queue with new QA pairs.
 
     Algorithm:
-    1. calculate number of QA pairs needed i.e. buffer size - current queue length - number of workers currently working (in redis)
-    2. for each unit of work needed, update the number of workers currently working (in redis) and spawn a new worker
-    3. each worker will try to generate a QA pair and put it in the shared buffer (redis)
-    4. the router will consume the QA pairs from the shared buffer (redis)
+    1. calculate number of QA pairs needed i.e. buffer size - current queue length - number of workers currently working (in the cache),
+       for each partition (topic and augment type) with a target buffer size, and for QA pairs of any partition
+    2. for each unit of work needed, update the number of workers currently working (in the cache) and spawn a new worker,
+       partitions with the most work needed first
+    3. each worker will try to generate a QA pair and put it in the shared buffer (the cache)
+    4. the router will consume the QA pairs from the shared buffer (the cache)
     5. the router will return the QA pairs to the caller
     6. repeat steps 1-5
     """
@@ -28,9 +36,18 @@ class WorkerManager:
     # we want to ensure that the number of workers is in sync with number of uvicorn workers
     _num_workers = get_settings().uvicorn.num_workers
     _buffer_size = get_settings().generation.buffer_size
+    # target buffer sizes of partitions "<topic>:<augment_type>"
+    _partition_buffer_sizes = get_settings().generation.partition_buffer_sizes
     # callable function to allow other functions to be passed in
     _do_work: Callable[..., Awaitable[Any]]
     _running_workers: list = []
+    # spilled QA pairs are only moved back into redis by the process that spilled them, so
+    # each process does it on a timer, also when its routes are not being called
+    _refill_interval_sec: float = 1.0
+    _refill_task: "asyncio.Task[None] | None" = None
+    # entries older than the history expiry are removed from the history index this often
+    _trim_interval_sec: float = 60.0
+    _trim_task: "asyncio.Task[None] | None" = None
 
     def __new__(cls, do_work: Callable) -> "WorkerManager":
         if cls._instance is None:
@@ -43,15 +60,44 @@ class WorkerManager:
 
     async def run(self):
         # ensure to reset number of workers active to 0 upon startup
-        cache = RedisCache()
+        cache = get_cache()
         await cache.update_num_workers_active(-self._num_workers)
+        await cache.reset_num_workers_active_by_partition()
 
         workers: list[asyncio.Task[None]] = [
             asyncio.create_task(self.worker()) for _ in range(self._num_workers)
         ]
         self._running_workers = workers
+        self._refill_task = asyncio.create_task(self.refill_spilled())
+        self._trim_task = asyncio.create_task(self.trim_history_index())
         await asyncio.gather(*workers)
 
+    async def refill_spilled(self):
+        """Periodically move QA pairs spilled by this process back into the queue."""
+        cache = get_cache()
+        while True:
+            try:
+                await cache.refill_spilled()
+            except Exception as exc:
+                logger.opt(exception=True).error(
+                    f"Error refilling spilled QA pairs: {exc}"
+                )
+            await asyncio.sleep(self._refill_interval_sec)
+
+    async def trim_history_index(self):
+        """Periodically remove entries older than the history expiry from the history index."""
+        cache = get_cache()
+        while True:
+            try:
+                num_trimmed = await cache.trim_history_index()
+                if num_trimmed:
+                    logger.info(f"Trimmed {num_trimmed} entries from the history index")
+            except Exception as exc:
+                logger.opt(exception=True).error(
+                    f"Error trimming the history index: {exc}"
+                )
+            await asyncio.sleep(self._trim_interval_sec)
+
     async def worker(self):
         """Continuously check for work to do, and do it.
         Allows for worker to be cancelled using asyncio.Task.cancel()
@@ -60,8 +106,9 @@ class WorkerManager:
             while True:
                 try:
                     work_todo = await self.calc_work_todo()
-                    if work_todo > 0:
-                        await self.advertise_and_do_work()
+                    partition = max(work_todo, key=lambda p: work_todo[p])
+                    if work_todo[partition] > 0:
+                        await self.advertise_and_do_work(partition)
                     else:
                         await asyncio.sleep(3)
                 except asyncio.CancelledError:
@@ -74,27 +121,60 @@ class WorkerManager:
         finally:
             logger.info("Worker is shutting down")
 
+    def num_running_workers(self) -> int:
+        """Number of worker tasks that have not exited, e.g. due to a fatal error."""
+        return sum(1 for worker in self._running_workers if not worker.done())
+
     async def stop(self):
         for worker in self._running_workers:
             worker.cancel()
+        for task in (self._refill_task, self._trim_task):
+            if task is not None:
+                task.cancel()
 
-    async def calc_work_todo(self) -> int:
+    async def calc_work_todo(self) -> dict[str | None, int]:
         """Calculate number of units of work needed to be done, based on
         the desired buffer size, current buffer size, and number of active
         workers.
+
+        Returns:
+            dict[str | None, int]: Units of work needed for each partition with a
+                target buffer size, and for QA pairs of any partition under None.
         """
-        cache = RedisCache()
+        cache = get_cache()
         current_buffer_size = await cache.get_queue_length()
         num_active_workers = await cache.get_num_workers_active()
-        num_work_todo = max(
+        QUEUE_DEPTH.set(current_buffer_size)
+        ACTIVE_WORKERS.set(num_active_workers)
+
+        work_todo: dict[str | None, int] = {}
+        if self._partition_buffer_sizes:
+            partition_buffer_sizes = await cache.get_partition_queue_lengths()
+            partition_active_workers = await cache.get_num_workers_active_by_partition()
+            for partition, target in self._partition_buffer_sizes.items():
+                PARTITION_QUEUE_DEPTH.labels(partition).set(
+                    partition_buffer_sizes.get(partition, 0)
+                )
+                work_todo[partition] = max(
+                    target
+                    - partition_buffer_sizes.get(partition, 0)
+                    - partition_active_workers.get(partition, 0),
+                    0,
+                )
+        work_todo[None] = max(
             self._buffer_size - current_buffer_size - num_active_workers, 0
         )
-        return num_work_todo
+        return work_todo
 
-    async def advertise_and_do_work(self):
-        """Tell other workers that I (current worker) am picking up some work"""
-        cache = RedisCache()
-        await cache.update_num_workers_active(1)
+    async def advertise_and_do_work(self, partition: str | None = None):
+        """Tell other workers that I (current worker) am picking up some work
+
+        Args:
+            partition (str | None): Partition "<topic>:<augment_type>" of the QA pair to
+                build, any partition if None.
+        """
+        cache = get_cache()
+        await cache.update_num_workers_active(1, partition)
 
         # Find the parent task in self._running_workers
         worker_id = next(
@@ -107,9 +187,15 @@ class WorkerManager:
         )
 
         try:
-            logger.debug(f"Worker-{worker_id} doing work")
-            value = await self._do_work()
-            await cache.enqueue(value)
+            logger.debug(f"Worker-{worker_id} doing work, partition: {partition}")
+            kwargs = {}
+            if partition is not None:
+                topic, _, augment_type = partition.partition(":")
+                kwargs = {"topic": topic, "augment_type": augment_type}
+            with track_stage("qa_pair"):
+                value = await self._do_work(**kwargs)
+            with track_stage("enqueue"):
+                await cache.enqueue(value)
         except (AuthenticationError, PermissionDeniedError):
             raise
         except Exception as exc:
@@ -117,4 +203,4 @@ class WorkerManager:
                 f"Error processing one unit of work: {exc}"
             )
         finally:
-            await cache.update_num_workers_active(-1)
+            await cache.update_num_workers_active(-1, partition)
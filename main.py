@@ -12,6 +12,7 @@ from rich.traceback import install
 from commons.config import get_settings, parse_cli_args
 from commons.dataset.personas import load_persona_dataset
 from commons.routes.health import health_router
+from commons.routes.metrics import metrics_router
 from commons.routes.synthetic_gen import cache, synthetic_gen_router, worker
 
 load_dotenv()
@@ -24,6 +25,7 @@ async def _lifespan_context(app: FastAPI):  # noqa: ARG001 #pyright: ignore[repo
     app.state.persona_dataset = load_persona_dataset()
     # create workers to concurrently generate question-answer pairs; wrap worker.run in a task so it can be cancelled
     worker_task = asyncio.create_task(worker.run())
+    app.state.worker_task = worker_task
     # check that generation did not raise any fatal errors.
     worker_task.add_done_callback(_check_fatal_errors)
     logger.info("Performed startup tasks")
@@ -51,6 +53,7 @@ app.add_middleware(
 
 # Include the code_gen router
 app.include_router(health_router)
+app.include_router(metrics_router)
 app.include_router(synthetic_gen_router)
 
 
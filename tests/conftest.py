@@ -0,0 +1,47 @@
+import pytest
+from fakeredis import aioredis as fakeredis
+
+from commons.cache.base import CacheBackend
+from commons.cache.memory import MemoryCache
+from commons.cache.redis import RedisCache
+from commons.cache.spill import SpillStore
+from commons.cache.sqlite import SQLiteCache
+
+# "spill" is redis with a memory budget of a few QA pairs, so that most of them are spilled
+CACHE_BACKENDS = ["memory", "sqlite", "redis", "spill"]
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def _new_cache(backend: str, tmp_path) -> CacheBackend:
+    if backend == "memory":
+        MemoryCache._instance = None
+        return MemoryCache()
+    if backend == "sqlite":
+        SQLiteCache._instance = None
+        cache = SQLiteCache()
+        cache.path = str(tmp_path / "cache.db")
+        return cache
+    RedisCache._instance = None
+    cache = RedisCache()
+    cache.redis = fakeredis.FakeRedis()
+    if backend == "spill":
+        cache._memory_budget_bytes = 300
+        cache._spill = SpillStore(str(tmp_path / "spill"), 4096)
+    return cache
+
+
+@pytest.fixture(params=CACHE_BACKENDS)
+async def cache(request, tmp_path):
+    """Every cache backend, redis runs against fakeredis. History never expires unless a
+    test sets `history_ttl_ms`, and the CLI args of the service are not parsed.
+    """
+    cache = _new_cache(request.param, tmp_path)
+    cache.history_ttl_ms = 0
+    await cache.clear()
+    yield cache
+    await cache.clear()
+    await cache.close()
@@ -0,0 +1,296 @@
+import asyncio
+import time
+
+import pytest
+
+from commons.cache.base import CacheBackend, HistoryEntry, QueueItem
+from commons.cache.codec import get_codec
+from commons.utils.serialization import loads
+
+pytestmark = pytest.mark.anyio
+
+
+def _qa_pair(i: int, topic: str | None = None, augment_type: str | None = None):
+    data = {"i": i, "responses": []}
+    if topic is not None and augment_type is not None:
+        data |= {"topic": topic, "metadata": {"augment_type": augment_type}}
+    return data
+
+
+def _numbers(items: list[QueueItem] | list[HistoryEntry]) -> list[int]:
+    return [loads(get_codec().decode(item.value))["i"] for item in items]
+
+
+async def test_fifo(cache: CacheBackend):
+    lengths = [await cache.enqueue(_qa_pair(i)) for i in range(3)]
+    assert lengths == [1, 2, 3], lengths
+    assert await cache.get_queue_length() == 3
+    items = await cache.dequeue_many(2)
+    assert _numbers(items) == [0, 1], _numbers(items)
+    await cache.ack(items)
+    assert await cache.get_queue_length() == 1
+    assert loads(await cache.dequeue() or "null")["i"] == 2
+    assert await cache.dequeue_many(5) == []
+    assert await cache.dequeue() is None
+
+
+async def test_partitions(cache: CacheBackend):
+    await cache.enqueue(_qa_pair(0, "GAMES", "CHANGE_ANSWERS"))
+    await cache.enqueue(_qa_pair(1, "SCIENCE", "CHANGE_ANSWERS"))
+    await cache.enqueue(_qa_pair(2, "GAMES", "CHANGE_QUESTIONS"))
+    await cache.enqueue(_qa_pair(3))
+    assert await cache.get_partitions() == [
+        "GAMES:CHANGE_ANSWERS",
+        "GAMES:CHANGE_QUESTIONS",
+        "SCIENCE:CHANGE_ANSWERS",
+    ]
+    assert await cache.get_partitions(augment_type="CHANGE_ANSWERS") == [
+        "GAMES:CHANGE_ANSWERS",
+        "SCIENCE:CHANGE_ANSWERS",
+    ]
+    assert await cache.get_partition_queue_lengths() == {
+        "GAMES:CHANGE_ANSWERS": 1,
+        "GAMES:CHANGE_QUESTIONS": 1,
+        "SCIENCE:CHANGE_ANSWERS": 1,
+    }
+    assert await cache.get_queue_length() == 4
+    assert await cache.get_queue_length(topic="GAMES") == 2
+    assert await cache.get_queue_length("SCIENCE", "CHANGE_QUESTIONS") == 0
+
+    items = await cache.dequeue_many(5, topic="GAMES")
+    assert sorted(_numbers(items)) == [0, 2], _numbers(items)
+    await cache.ack(items)
+    items = await cache.dequeue_many(5, topic="GAMES")
+    assert items == [], items
+    items = await cache.dequeue_many(5, topic="SCIENCE", augment_type="CHANGE_ANSWERS")
+    assert _numbers(items) == [1]
+    await cache.ack(items)
+    # unfiltered dequeues include QA pairs without a partition
+    items = await cache.dequeue_many(5)
+    assert _numbers(items) == [3]
+    await cache.ack(items)
+
+
+async def test_requeue(cache: CacheBackend):
+    await cache.enqueue(_qa_pair(0, "GAMES", "CHANGE_ANSWERS"))
+    await cache.enqueue(_qa_pair(1, "SCIENCE", "CHANGE_ANSWERS"))
+    await cache.enqueue(_qa_pair(2))
+    items = await cache.dequeue_many(3)
+    assert await cache.get_queue_length() == 0
+    assert await cache.requeue(items) == 3
+    assert await cache.requeue([]) == 0
+    # back in the queue of their partition
+    assert await cache.get_partition_queue_lengths() == {
+        "GAMES:CHANGE_ANSWERS": 1,
+        "SCIENCE:CHANGE_ANSWERS": 1,
+    }
+    items = await cache.dequeue_many(3)
+    assert sorted(_numbers(items)) == [0, 1, 2], _numbers(items)
+    await cache.ack(items)
+
+
+async def test_requeue_order(cache: CacheBackend):
+    for i in range(4):
+        await cache.enqueue(_qa_pair(i))
+    items = await cache.dequeue_many(2)
+    await cache.requeue(items)
+    items = await cache.dequeue_many(4)
+    numbers = _numbers(items)
+    # the stream backend appends requeued items, the others put them back in front
+    assert numbers in ([0, 1, 2, 3], [2, 3, 0, 1]), numbers
+    await cache.ack(items)
+
+
+async def test_blocking(cache: CacheBackend):
+    start_time = time.monotonic()
+    assert await cache.dequeue_many(1, block_sec=0.2) == []
+    assert time.monotonic() - start_time >= 0.15
+
+    async def enqueue_later():
+        await asyncio.sleep(0.1)
+        await cache.enqueue(_qa_pair(0, "GAMES", "CHANGE_ANSWERS"))
+
+    start_time = time.monotonic()
+    task = asyncio.create_task(enqueue_later())
+    items = await cache.dequeue_many(1, 2, "GAMES", "CHANGE_ANSWERS")
+    await task
+    assert _numbers(items) == [0], items
+    assert time.monotonic() - start_time < 1.5
+    await cache.ack(items)
+
+
+async def test_history_ttl(cache: CacheBackend):
+    cache.history_ttl_ms = 100
+    try:
+        # history does not expire while queued
+        await cache.enqueue(_qa_pair(0))
+        await asyncio.sleep(0.2)
+        items = await cache.dequeue_many(1)
+        assert _numbers(items) == [0]
+        # requeued items stop expiring
+        await cache.requeue(items)
+        await asyncio.sleep(0.2)
+        items = await cache.dequeue_many(1)
+        assert _numbers(items) == [0]
+        await cache.ack(items)
+        # delivered items expire, and are skipped if they are requeued after expiring
+        await asyncio.sleep(0.2)
+        await cache.requeue(items)
+        assert await cache.dequeue_many(1) == []
+    finally:
+        cache.history_ttl_ms = 0
+
+
+async def test_in_flight(cache: CacheBackend):
+    await cache.enqueue(_qa_pair(0))
+    await cache.enqueue(_qa_pair(1))
+    items = await cache.dequeue_many(2)
+    in_flight = await cache.get_num_in_flight()
+    if in_flight is None:
+        # deliveries are not tracked by this backend
+        return
+    assert in_flight == 2, in_flight
+    await cache.ack(items)
+    assert await cache.get_num_in_flight() == 0
+
+
+async def test_workers_active(cache: CacheBackend):
+    assert await cache.get_num_workers_active() == 0
+    assert await cache.update_num_workers_active(3) == 3
+    assert await cache.update_num_workers_active(-5) == 0
+    await cache.update_num_workers_active(1, "GAMES:CHANGE_ANSWERS")
+    await cache.update_num_workers_active(1, "GAMES:CHANGE_ANSWERS")
+    await cache.update_num_workers_active(-1, "SCIENCE:CHANGE_ANSWERS")
+    assert await cache.get_num_workers_active() == 1
+    assert await cache.get_num_workers_active_by_partition() == {
+        "GAMES:CHANGE_ANSWERS": 2,
+        "SCIENCE:CHANGE_ANSWERS": 0,
+    }
+    await cache.reset_num_workers_active_by_partition()
+    assert await cache.get_num_workers_active_by_partition() == {}
+
+
+async def test_shared_values(cache: CacheBackend):
+    key = cache.build_key("sampler", "check")
+    assert await cache.get_value(key) is None
+    assert await cache.set_value(key, 7, nx=True)
+    assert not await cache.set_value(key, 8, nx=True)
+    assert await cache.get_value(key) == b"7"
+    assert await cache.set_value(key, "9")
+    assert await cache.get_value(key) == b"9"
+    counter_key = cache.build_key("sampler", "counter")
+    assert [await cache.incr(counter_key) for _ in range(3)] == [1, 2, 3]
+
+
+async def test_last_enqueue_time(cache: CacheBackend):
+    assert await cache.get_last_enqueue_time() is None
+    await cache.enqueue(_qa_pair(0))
+    last_enqueue_time = await cache.get_last_enqueue_time()
+    assert last_enqueue_time is not None
+    assert abs(time.time() - last_enqueue_time) < 5
+    assert await cache.ping() >= 0
+
+
+async def test_history_index(cache: CacheBackend):
+    for i, (topic, augment_type) in enumerate(
+        [
+            ("GAMES", "CHANGE_ANSWERS"),
+            ("SCIENCE", "CHANGE_ANSWERS"),
+            ("GAMES", "CHANGE_QUESTIONS"),
+            (None, None),
+            ("GAMES", "CHANGE_ANSWERS"),
+        ]
+    ):
+        data = _qa_pair(i, topic, augment_type)
+        data["question_model"] = "model-a"
+        data["responses"] = [{"model": f"model-{'b' if i % 2 else 'c'}", "cid": str(i)}]
+        await cache.enqueue(data)
+        # spread the entries over different ms, ties are checked by the cursor
+        await asyncio.sleep(0.002 if i != 2 else 0)
+
+    # newest first, paged with the cursor
+    pages = []
+    cursor = None
+    while True:
+        entries, cursor = await cache.query_history(limit=2, cursor=cursor)
+        pages.append(entries)
+        if cursor is None:
+            break
+    ids = [entry.id for page in pages for entry in page]
+    assert ids == sorted(ids, reverse=True) and len(ids) == 5, ids
+    assert all(entry.value is None for page in pages for entry in page)
+    assert [len(page) for page in pages if page] == [2, 2, 1], pages
+
+    entries, _ = await cache.query_history(topic="GAMES", with_values=True)
+    assert _numbers(entries) == [4, 2, 0], _numbers(entries)
+    entries, _ = await cache.query_history(
+        topic="GAMES", strategy="CHANGE_ANSWERS", with_values=True
+    )
+    assert _numbers(entries) == [4, 0], _numbers(entries)
+    entries, _ = await cache.query_history(model="model-b", with_values=True)
+    assert _numbers(entries) == [3, 1], _numbers(entries)
+    entries, cursor = await cache.query_history(model="model-z")
+    assert entries == [] and cursor is None
+
+    # time bounds are inclusive
+    newest_first = [entry for page in pages for entry in page]
+    entries, _ = await cache.query_history(
+        since=newest_first[-1].created_at, until=newest_first[0].created_at
+    )
+    assert len(entries) == 5, entries
+    entries, _ = await cache.query_history(
+        until=newest_first[-2].created_at, with_values=True
+    )
+    assert _numbers(entries) == [1, 0], _numbers(entries)
+    entries, _ = await cache.query_history(
+        since=newest_first[0].created_at, with_values=True
+    )
+    assert _numbers(entries) == [4], _numbers(entries)
+    entries, _ = await cache.query_history(until=time.time() - 3600)
+    assert entries == []
+
+    assert await cache.get_history_facets() == {
+        "topic": {"GAMES": 3, "SCIENCE": 1},
+        "model": {"model-a": 5, "model-b": 2, "model-c": 3},
+        "strategy": {"CHANGE_ANSWERS": 3, "CHANGE_QUESTIONS": 1},
+    }
+
+    # expired entries are skipped
+    cache.history_ttl_ms = 100
+    try:
+        items = await cache.dequeue_many(5, topic="SCIENCE")
+        await cache.ack(items)
+        await asyncio.sleep(0.2)
+        entries, _ = await cache.query_history(topic="SCIENCE")
+        assert entries == [], entries
+        entries, _ = await cache.query_history()
+        assert len(entries) == 4, entries
+    finally:
+        cache.history_ttl_ms = 0
+
+
+async def test_trim_history_index(cache: CacheBackend):
+    for i, (topic, model) in enumerate([("GAMES", "model-a"), ("SCIENCE", "model-b")]):
+        data = _qa_pair(i, topic, "CHANGE_ANSWERS")
+        data["question_model"] = model
+        await cache.enqueue(data)
+        await asyncio.sleep(0.2 if i == 0 else 0)
+    # nothing is trimmed while history never expires
+    assert await cache.trim_history_index() == 0
+
+    cache.history_ttl_ms = 100
+    try:
+        assert await cache.trim_history_index() == 1
+        entries, _ = await cache.query_history(with_values=True)
+        assert _numbers(entries) == [1], _numbers(entries)
+        assert await cache.get_history_facets() == {
+            "topic": {"SCIENCE": 1},
+            "model": {"model-b": 1},
+            "strategy": {"CHANGE_ANSWERS": 1},
+        }
+        # trimmed entries are still queued
+        items = await cache.dequeue_many(2)
+        assert sorted(_numbers(items)) == [0, 1], _numbers(items)
+        await cache.ack(items)
+    finally:
+        cache.history_ttl_ms = 0
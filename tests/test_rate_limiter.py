@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fakeredis import aioredis as fakeredis
+
+from commons.cache.redis import RedisCache
+from commons.config import RateLimitSettings
+from commons.llm.rate_limiter import RateLimitedTransport, RateLimiter
+
+pytestmark = pytest.mark.anyio
+
+MODEL = "model-a"
+TOKENS_PER_MINUTE = 6000
+
+
+@pytest.fixture
+def limiter():
+    RedisCache._instance = None
+    RedisCache().redis = fakeredis.FakeRedis()
+    settings = RateLimitSettings(
+        requests_per_minute=1000, tokens_per_minute=TOKENS_PER_MINUTE, max_in_flight=1
+    )
+    yield RateLimiter("openrouter", settings)
+    RedisCache._instance = None
+
+
+async def _bucket_tokens(limiter: RateLimiter) -> float:
+    bucket_key = limiter._keys(MODEL)[0]
+    return float(await RedisCache().redis.hget(bucket_key, "tokens"))
+
+
+def _sse(*events: dict) -> list[bytes]:
+    return [f"data: {json.dumps(event)}\n\n".encode() for event in events] + [
+        b"data: [DONE]\n\n"
+    ]
+
+
+def _content(text: str) -> dict:
+    return {"choices": [{"delta": {"content": text}, "finish_reason": None}]}
+
+
+async def _read_stream(limiter: RateLimiter, events: list[bytes]) -> bytes:
+    async def _chunks():
+        for event in events:
+            await asyncio.sleep(0)
+            yield event
+
+    transport = RateLimitedTransport(
+        httpx.MockTransport(lambda _request: httpx.Response(200, content=_chunks())),
+        limiter,
+    )
+    async with httpx.AsyncClient(transport=transport) as client:
+        body = {"model": MODEL, "messages": [], "max_tokens": 1000, "stream": True}
+        async with client.stream("POST", "http://llm/chat", json=body) as response:
+            return b"".join([chunk async for chunk in response.aiter_bytes()])
+
+
+async def test_stream_is_settled_with_usage(limiter: RateLimiter):
+    usage = {"choices": [], "usage": {"prompt_tokens": 10, "completion_tokens": 20}}
+    events = _sse(_content("<html>"), usage)
+    assert await _read_stream(limiter, events) == b"".join(events)
+
+    # charged 1001 tokens up front, refunded all but the 30 used
+    assert await _bucket_tokens(limiter) == pytest.approx(TOKENS_PER_MINUTE - 30, abs=5)
+
+
+async def test_stream_without_usage_is_settled_with_content(limiter: RateLimiter):
+    await _read_stream(limiter, _sse(_content("x" * 400), _content("x" * 400)))
+
+    # 1 estimated prompt token and 800 characters of content
+    assert await _bucket_tokens(limiter) == pytest.approx(
+        TOKENS_PER_MINUTE - 201, abs=5
+    )
+
+
+async def test_waiter_gets_released_slot(limiter: RateLimiter):
+    lease_id = await limiter.acquire(MODEL, 1)
+    waiter = asyncio.create_task(limiter.acquire(MODEL, 1))
+    await asyncio.sleep(0.2)
+    assert not waiter.done()
+
+    await limiter.release(MODEL, lease_id)
+    assert await asyncio.wait_for(waiter, 2)
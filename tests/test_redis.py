@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from commons.cache.codec import get_codec
+from commons.cache.redis import RedisCache
+from commons.utils.serialization import dumps
+from tests.test_cache import _numbers, _qa_pair
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.parametrize("cache", ["redis"], indirect=True),
+]
+
+
+async def test_legacy_queue_entries(cache: RedisCache):
+    # versions before queues held ids pushed the whole QA pair, plain or encoded
+    queue_key = cache._partition_queue_key(None)
+    await cache.redis.rpush(queue_key, dumps(_qa_pair(0)))
+    await cache.redis.rpush(queue_key, get_codec().encode(dumps(_qa_pair(1))))
+    await cache.enqueue(_qa_pair(2))
+
+    items = await cache.dequeue_many(5)
+    assert _numbers(items) == [0, 1, 2], _numbers(items)
+    # they are stored as history entries, so they can be requeued like the others
+    await cache.requeue(items)
+    items = await cache.dequeue_many(5)
+    assert _numbers(items) == [0, 1, 2], _numbers(items)
+    await cache.ack(items)
+    entries, _ = await cache.query_history()
+    assert len(entries) == 3, entries
+
+
+async def test_legacy_queue_entry_while_blocked(cache: RedisCache):
+    async def push_later():
+        await asyncio.sleep(0.1)
+        await cache.redis.rpush(cache._partition_queue_key(None), dumps(_qa_pair(0)))
+
+    task = asyncio.create_task(push_later())
+    items = await cache.dequeue_many(1, block_sec=2)
+    await task
+    assert _numbers(items) == [0], items
+
+
+async def test_concurrent_dequeues(cache: RedisCache):
+    for i in range(20):
+        await cache.enqueue(_qa_pair(i))
+    # consumers read the same heads, those that lose the race read them again
+    batches = await asyncio.gather(*[cache.dequeue_many(2) for _ in range(15)])
+    numbers = sorted(number for batch in batches for number in _numbers(batch))
+    assert numbers == list(range(20)), numbers
+    assert await cache._queued_bytes() == 0
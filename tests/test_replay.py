@@ -0,0 +1,103 @@
+import random
+import time
+import uuid
+
+import httpx
+import instructor
+import pytest
+from instructor import Mode
+from openai import AsyncOpenAI
+
+from commons.config import LlmCacheSettings, Settings
+from commons.dataset import sampler
+from commons.llm import response_cache
+from commons.synthetic import QuestionAugmentation, augment_question, generate_question
+from commons.types import Topics
+
+pytestmark = pytest.mark.anyio
+
+# an OpenAI model, so that requests also have a sampled seed
+MODEL = "openai/gpt-4o"
+PERSONA = "A retired lighthouse keeper who restores mechanical clocks"
+
+
+def _recording_provider(_request: httpx.Request) -> httpx.Response:
+    completion = {
+        "id": f"gen-{uuid.uuid4()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": MODEL,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": f"Question {uuid.uuid4()}"},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+    return httpx.Response(200, json=completion)
+
+
+def _replaying_provider(_request: httpx.Request) -> httpx.Response:
+    raise httpx.ConnectError("the provider must not be called when replaying")
+
+
+@pytest.fixture
+def set_mode(monkeypatch, tmp_path):
+    """Sets the LLM cache mode, responses are stored in a temporary directory."""
+
+    def _set_mode(mode: str):
+        settings = Settings().model_copy(
+            update={
+                "llm_cache": LlmCacheSettings(
+                    mode=mode, backend="disk", directory=str(tmp_path)
+                )
+            }
+        )
+        monkeypatch.setattr(response_cache, "get_settings", lambda: settings)
+
+    return _set_mode
+
+
+def _client(mode: str) -> instructor.AsyncInstructor:
+    provider = _recording_provider if mode == "record" else _replaying_provider
+    transport = response_cache.build_cached_transport(httpx.MockTransport(provider))
+    return instructor.from_openai(
+        AsyncOpenAI(
+            api_key="replay-test",
+            base_url="http://provider.invalid/v1",
+            http_client=httpx.AsyncClient(transport=transport),
+            max_retries=0,
+        ),
+        mode=Mode.MD_JSON,
+    )
+
+
+async def _generate(mode: str) -> tuple[str, str]:
+    client = _client(mode)
+    question = await generate_question(client, MODEL, Topics.GAMES, PERSONA)
+    augmented, _ = await augment_question(
+        client, MODEL, question, QuestionAugmentation.ADD_REQUIREMENTS, Topics.GAMES
+    )
+    return question, augmented
+
+
+async def test_replay(set_mode):
+    set_mode("record")
+    recorded = await _generate("record")
+
+    set_mode("replay")
+    # other users of the RNG run in between in a real pipeline
+    random.random()
+    assert await _generate("replay") == recorded
+
+
+def test_random_sampling_is_seeded(set_mode, monkeypatch):
+    set_mode("record")
+
+    def _sample_topics() -> list[Topics]:
+        monkeypatch.setattr(sampler, "_rng", None)
+        return [sampler._random_topic() for _ in range(10)]
+
+    assert _sample_topics() == _sample_topics()
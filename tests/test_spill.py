@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from commons.cache.redis import RedisCache
+from tests.test_cache import _numbers, _qa_pair
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.parametrize("cache", ["spill"], indirect=True),
+]
+
+
+async def _enqueue(cache: RedisCache, i: int, topic: str) -> None:
+    data = _qa_pair(i, topic, "CHANGE_ANSWERS")
+    data["question_model"] = "model-a"
+    await cache.enqueue(data)
+
+
+async def test_spilled_entries_are_indexed(cache: RedisCache):
+    for i in range(4):
+        await _enqueue(cache, i, "GAMES")
+    await _enqueue(cache, 4, "SCIENCE")
+    assert cache._spill is not None and cache._spill.num_records_of(
+        "SCIENCE:CHANGE_ANSWERS"
+    )
+
+    entries, _ = await cache.query_history(with_values=True)
+    assert _numbers(entries) == [4, 3, 2, 1, 0], _numbers(entries)
+    entries, _ = await cache.query_history(topic="SCIENCE")
+    assert len(entries) == 1, entries
+    facets = await cache.get_history_facets()
+    assert facets["topic"] == {"GAMES": 4, "SCIENCE": 1}, facets
+
+
+async def test_partition_is_not_held_back(cache: RedisCache):
+    # the QA pairs of one partition fill the budget
+    for i in range(4):
+        await _enqueue(cache, i, "GAMES")
+    await _enqueue(cache, 4, "SCIENCE")
+
+    items = await cache.dequeue_many(5, topic="SCIENCE")
+    assert _numbers(items) == [4], _numbers(items)
+    await cache.ack(items)
+    assert await cache.get_queue_length(topic="GAMES") == 4
+
+
+async def test_refill_when_queue_is_empty(cache: RedisCache):
+    for i in range(5):
+        await _enqueue(cache, i, "GAMES")
+    assert cache._spill is not None and cache._spill.num_records
+
+    # dequeues that find the queue empty in redis do not wait for the refill backoff
+    numbers = []
+    while True:
+        cache._refill_after = time.monotonic() + 3600
+        items = await cache.dequeue_many(5)
+        if not items:
+            break
+        numbers += _numbers(items)
+        await cache.ack(items)
+    assert numbers == [0, 1, 2, 3, 4], numbers
+    assert not cache._spill.num_records
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from commons.code_iterator import streaming
+
+pytestmark = pytest.mark.anyio
+
+_HTML = "<!DOCTYPE html><html><body>Hello</body></html>"
+
+
+class _FailingStream:
+    """Streams `parts`, then fails with `error` if set, and fails to close."""
+
+    def __init__(self, parts: list[str], error: Exception | None = None):
+        self._parts = parts
+        self._error = error
+
+    async def __aiter__(self):
+        for part in self._parts:
+            delta = SimpleNamespace(content=part)
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=delta, finish_reason=None)]
+            )
+        if self._error is not None:
+            raise self._error
+
+    async def close(self):
+        raise RuntimeError("connection already closed")
+
+
+def _use_stream(monkeypatch, stream: _FailingStream):
+    # create is awaited, and returns the stream
+    create = lambda **_kwargs: asyncio.sleep(0, stream)  # noqa: E731
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+    )
+    monkeypatch.setattr(streaming, "get_async_openai_client", lambda _provider: client)
+
+
+async def test_close_error_does_not_hide_stream_error(monkeypatch):
+    _use_stream(
+        monkeypatch, _FailingStream([_HTML[:30]], httpx.ReadError("connection reset"))
+    )
+    with pytest.raises(httpx.ReadError):
+        await streaming._stream_html_code([], "model", 100)
+
+
+async def test_close_error_after_complete_document(monkeypatch):
+    _use_stream(monkeypatch, _FailingStream([_HTML[:30], _HTML[30:]]))
+    assert await streaming._stream_html_code([], "model", 100) == _HTML
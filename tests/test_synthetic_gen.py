@@ -0,0 +1,43 @@
+import json
+
+import zstandard
+
+from commons.cache.codec import get_codec
+from commons.routes.synthetic_gen import _passthrough_response
+from commons.utils.serialization import dumps
+from tests.test_cache import _qa_pair
+
+
+def _values(count: int) -> tuple[list[dict], list[bytes]]:
+    qa_pairs = [_qa_pair(i, "GAMES", "CHANGE_ANSWERS") for i in range(count)]
+    return qa_pairs, [get_codec().encode(dumps(qa_pair)) for qa_pair in qa_pairs]
+
+
+def test_batch_response():
+    qa_pairs, values = _values(3)
+    response = _passthrough_response(values, True)
+    assert "content-encoding" not in response.headers
+    assert json.loads(response.body) == {
+        "success": True,
+        "body": qa_pairs,
+        "error": None,
+    }
+
+
+def test_zstd_batch_response():
+    qa_pairs, values = _values(3)
+    response = _passthrough_response(values, True, "gzip, zstd;q=1.0")
+    assert response.headers["content-encoding"] == "zstd"
+
+    # clients may only decompress the first frame of the body
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    body = decompressor.decompress(bytes(response.body))
+    assert decompressor.eof and not decompressor.unused_data
+    assert json.loads(body) == {"success": True, "body": qa_pairs, "error": None}
+
+
+def test_zstd_response():
+    qa_pairs, values = _values(1)
+    response = _passthrough_response(values, False, "zstd")
+    body = zstandard.ZstdDecompressor().decompress(bytes(response.body))
+    assert json.loads(body) == {"success": True, "body": qa_pairs[0], "error": None}